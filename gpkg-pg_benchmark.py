@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   This script benchmarks loading, dumping, and dropping a SQLite
+#   GeoPackage with the PostgreSQL-GeoPackage scripts.
+#
+#   Each phase runs the script as a child process and records its wall
+#   time, tiles and megabytes per second, peak resident set size, and the
+#   execution time spent in the server according to pg_stat_statements if
+#   that extension is installed. Results are written as JSON so runs with
+#   different load and export modes or releases can be compared.
+#
+#------------------------------------------------------------------------------
+
+import sys
+import os
+import time
+import json
+import shlex
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+import psycopg2
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def source_statistics(gpkg_filename):
+    #Number of tiles and bytes of tile data per tiles table
+    with sqlite3.connect(gpkg_filename) as conn_in:
+        cursor_in = conn_in.cursor()
+        cursor_in.execute(
+            "SELECT table_name FROM gpkg_contents WHERE data_type = 'tiles';"
+        )
+        table_names = [table_name[0] for table_name in cursor_in.fetchall()]
+        tiles = 0
+        tile_bytes = 0
+        for table_name in table_names:
+            cursor_in.execute(
+                "SELECT count(*), coalesce(sum(length(tile_data)), 0) FROM "
+                "\"%s\";" % table_name
+            )
+            count, size = cursor_in.fetchone()
+            tiles += count
+            tile_bytes += size
+    return table_names, tiles, tile_bytes
+
+
+def server_time(pg_connection_string):
+    #Total execution time of all statements in seconds or None without
+    #pg_stat_statements
+    with psycopg2.connect(pg_connection_string) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('pg_stat_statements');")
+            if cursor.fetchone()[0] is None:
+                return None
+            cursor.execute(
+                "SELECT coalesce(sum(%s), 0) FROM pg_stat_statements;" % (
+                    "total_exec_time" if conn.server_version >= 130000
+                    else "total_time"
+                )
+            )
+            return float(cursor.fetchone()[0])/1000
+
+
+def run_script(arguments, cwd=None):
+    #Run a script and return its wall time and peak resident set size in KiB
+    #including the worker processes it waited for
+    start = time.time()
+    process = subprocess.Popen(
+        [sys.executable] + arguments, cwd=cwd, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT
+    )
+    output = process.stdout.read()
+    status, rusage = os.wait4(process.pid, 0)[1:3]
+    process.returncode = status
+    seconds = time.time() - start
+    process.stdout.close()
+    if status != 0:
+        sys.stderr.write(
+            "ERROR: '%s' failed. Output was:\n%s\n" % (
+                " ".join(arguments), output.decode("utf-8", "replace")
+            )
+        )
+        sys.exit(1)
+    return seconds, rusage.ru_maxrss
+
+
+def run_phase(phase, commands, pg_connection_string, tiles, tile_bytes,
+              cwd=None):
+    server_start = server_time(pg_connection_string)
+    seconds = 0.0
+    peak_rss = 0
+    for arguments in commands:
+        command_seconds, command_rss = run_script(arguments, cwd)
+        seconds += command_seconds
+        peak_rss = max(peak_rss, command_rss)
+    server_end = server_time(pg_connection_string)
+    return {
+        "phase": phase,
+        "seconds": round(seconds, 3),
+        "tiles_per_second": round(tiles/seconds, 1),
+        "mb_per_second": round(tile_bytes/1048576.0/seconds, 3),
+        "peak_rss_kb": peak_rss,
+        "server_seconds": None if server_start is None else
+        round(server_end-server_start, 3)
+    }
+
+
+def summarize(results):
+    #Minimum and median of each phase over all runs
+    summary = {}
+    for phase in sorted(set(result["phase"] for result in results)):
+        seconds = sorted(
+            result["seconds"] for result in results
+            if result["phase"] == phase
+        )
+        summary[phase] = {
+            "min_seconds": seconds[0],
+            "median_seconds": seconds[len(seconds)//2] if len(seconds) % 2
+            else round((seconds[len(seconds)//2-1] +
+                        seconds[len(seconds)//2])/2, 3)
+        }
+    return summary
+
+
+def benchmark_gpkg(gpkg_filename, pg_connection_string, runs=3,
+                   load_options=[], dump_options=[], dump=True, label=None):
+    if not os.path.exists(gpkg_filename):
+        sys.stderr.write("ERROR: GeoPackage '%s' not found\n" % gpkg_filename)
+        sys.exit(1)
+    gpkg_filename = os.path.abspath(gpkg_filename)
+    table_names, tiles, tile_bytes = source_statistics(gpkg_filename)
+    with psycopg2.connect(pg_connection_string) as conn:
+        server_version = conn.server_version
+
+    results = []
+    for run in range(1, runs+1):
+        phases = [(
+            "load", [[os.path.join(SCRIPT_DIR, "gpkg-pg_loadpkg.py"),
+                      gpkg_filename, pg_connection_string] + load_options]
+        )]
+        if dump:
+            phases.append((
+                "dump", [[os.path.join(SCRIPT_DIR, "gpkg-pg_dump.py"),
+                          pg_connection_string, table_name] + dump_options
+                         for table_name in table_names]
+            ))
+        phases.append((
+            "drop", [[os.path.join(SCRIPT_DIR, "gpkg-pg_drop.py"),
+                      pg_connection_string] + table_names]
+        ))
+
+        #dumps are written into a scratch directory removed after each run
+        scratch = tempfile.mkdtemp(prefix="gpkg-pg_benchmark")
+        try:
+            for phase, commands in phases:
+                result = run_phase(phase, commands, pg_connection_string,
+                                   tiles, tile_bytes, scratch)
+                result["run"] = run
+                results.append(result)
+                sys.stderr.write(
+                    "run %i %s: %.3f s, %.1f tiles/s, %.3f MB/s\n" % (
+                        run, phase, result["seconds"],
+                        result["tiles_per_second"], result["mb_per_second"]
+                    )
+                )
+        finally:
+            shutil.rmtree(scratch)
+
+    return {
+        "label": label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "postgresql": server_version,
+        "gpkg": {
+            "filename": os.path.basename(gpkg_filename),
+            "tables": table_names,
+            "tiles": tiles,
+            "bytes": tile_bytes
+        },
+        "load_options": load_options,
+        "dump_options": dump_options if dump else None,
+        "results": results,
+        "summary": summarize(results)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="This script benchmarks loading, dumping, and dropping a "
+        "SQLite GeoPackage with the PostgreSQL-GeoPackage scripts."
+    )
+    parser.add_argument(
+        "gpkg_filename",
+        help="Filename of the SQLite GeoPackage to load, e.g. generated by "
+        "gpkg-pg_synthetic.py."
+    )
+    parser.add_argument(
+        "pg_connection_string",
+        help="Connection string for PostgreSQL e.g. \"dbname='gpkg' "
+        "user='gpkg'\". The GeoPackage must not be loaded yet."
+    )
+    parser.add_argument(
+        "-runs", type=int, default=3, metavar="N",
+        help="Number of load, dump, and drop rounds. Defaults to 3."
+    )
+    parser.add_argument(
+        "-load_options", default="", metavar="OPTIONS",
+        help="Options passed to gpkg-pg_loadpkg.py, e.g. \"-copy -jobs 4\"."
+    )
+    parser.add_argument(
+        "-dump_options", default="", metavar="OPTIONS",
+        help="Options passed to gpkg-pg_dump.py, e.g. \"-bulk\"."
+    )
+    parser.add_argument(
+        "-skip_dump", action="store_true",
+        help="Only load and drop, e.g. where GDAL is not available."
+    )
+    parser.add_argument(
+        "-label",
+        help="Label stored with the results, e.g. a release or commit."
+    )
+    parser.add_argument(
+        "-output", metavar="FILE",
+        help="Write the JSON results to FILE instead of standard output."
+    )
+
+    args = parser.parse_args()
+
+    if args.runs < 1:
+        parser.error("-runs must be at least 1")
+
+    report = benchmark_gpkg(
+        args.gpkg_filename, args.pg_connection_string, args.runs,
+        shlex.split(args.load_options), shlex.split(args.dump_options),
+        not args.skip_dump, args.label
+    )
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+            output.write("\n")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
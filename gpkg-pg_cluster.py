@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   This script rewrites the tiles tables of PostgreSQL-GeoPackages in Morton
+#   order within each zoom level, so windows of tiles are stored in few
+#   contiguous pages.
+#
+#   Tables are clustered online. The tiles are copied in Morton order into a
+#   new table while the GeoPackage stays readable and writable, changes made
+#   meanwhile are applied from the change tracking, and the new table replaces
+#   the old one under a short lock. Owner, privileges, comments, storage
+#   parameters, constraints, indexes, triggers, and foreign keys referencing
+#   the table are carried over, other dependent objects like views prevent
+#   the replacement.
+#
+#   Partitioned tables are clustered one partition after the other with
+#   CLUSTER instead, which blocks reading and writing the zoom level of the
+#   partition while it is rewritten.
+#
+#------------------------------------------------------------------------------
+
+import sys
+import argparse
+import psycopg2
+import gpkg_pg_metrics
+import gpkg_pg_store
+from gpkg_pg_metrics import metrics
+
+
+#Default number of milliseconds to wait for the lock replacing a table
+LOCK_TIMEOUT = 5000
+#Passes applying concurrent changes before the table is locked
+CATCH_UP_PASSES = 3
+
+
+def quote_ident(name):
+    return "\"%s\"" % name.replace("\"", "\"\"")
+
+
+def snapshot_watermark(cursor):
+    #Transactions from this one on may not be visible in the snapshot
+    cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot());")
+    return cursor.fetchone()[0]
+
+
+def copy_ordered(conn, table_name, copy_name):
+    #Copy the tiles in Morton order into a new table, return the watermark
+    #of the snapshot copied
+    conn.set_session(isolation_level="REPEATABLE READ")
+    with conn:
+        with conn.cursor() as cursor:
+            watermark = snapshot_watermark(cursor)
+            #the storage parameters, e.g. fillfactor, apply to the copy
+            cursor.execute(
+                "SELECT array_to_string(reloptions, ', ') FROM pg_class "
+                "WHERE oid = to_regclass(%s);", (quote_ident(table_name),)
+            )
+            options = cursor.fetchone()[0]
+            cursor.execute(
+                "CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING "
+                "CONSTRAINTS INCLUDING STORAGE INCLUDING COMMENTS)%s;" % (
+                    quote_ident(copy_name), quote_ident(table_name),
+                    "" if not options else " WITH (%s)" % options
+                )
+            )
+            query = "INSERT INTO %s SELECT * FROM %s ORDER BY %s;" % (
+                quote_ident(copy_name), quote_ident(table_name),
+                gpkg_pg_store.MORTON_ORDER
+            )
+            metrics.explain(cursor, table_name, query)
+            cursor.execute(query)
+            metrics.count(cursor.rowcount)
+    return watermark
+
+
+def copy_indexes(conn, table_name, copy_name):
+    #Create the constraints, including foreign keys, and indexes of the table
+    #on the copy with temporary names, return the statements restoring the
+    #names
+    renames = []
+    with conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT conname, pg_get_constraintdef(oid) FROM "
+                "pg_constraint WHERE conrelid = to_regclass(%s) AND (contype "
+                "IN ('p', 'u', 'x') OR contype = 'f' AND confrelid <> "
+                "conrelid) ORDER BY conname;", (quote_ident(table_name),)
+            )
+            for name, definition in cursor.fetchall():
+                temporary = "%s_%i" % (copy_name, len(renames))
+                cursor.execute(
+                    "ALTER TABLE %s ADD CONSTRAINT %s %s;"
+                    % (quote_ident(copy_name), quote_ident(temporary),
+                       definition)
+                )
+                renames.append(
+                    "ALTER TABLE %s RENAME CONSTRAINT %s TO %s;"
+                    % (quote_ident(table_name), quote_ident(temporary),
+                       quote_ident(name))
+                )
+            cursor.execute(
+                "SELECT c.relname, pg_get_indexdef(i.indexrelid), "
+                "i.indisunique FROM pg_index i JOIN pg_class c ON c.oid = "
+                "i.indexrelid WHERE i.indrelid = to_regclass(%s) AND NOT "
+                "EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = "
+                "i.indexrelid) ORDER BY c.relname;", (quote_ident(table_name),)
+            )
+            indexes = cursor.fetchall()
+            for name, definition, unique in indexes:
+                temporary = "%s_%i" % (copy_name, len(renames))
+                cursor.execute(
+                    "CREATE %sINDEX %s ON %s USING %s;" % (
+                        "UNIQUE " if unique else "", quote_ident(temporary),
+                        quote_ident(copy_name),
+                        definition.split(" USING ", 1)[1]
+                    )
+                )
+                renames.append(
+                    "ALTER INDEX %s RENAME TO %s;"
+                    % (quote_ident(temporary), quote_ident(name))
+                )
+            #tables loaded without -morton get the index on the Morton key
+            if "%s_morton" % table_name not in [index[0] for index in indexes]:
+                cursor.execute(
+                    "CREATE INDEX %s ON %s (%s);" % (
+                        quote_ident("%s_morton" % table_name),
+                        quote_ident(copy_name), gpkg_pg_store.MORTON_ORDER
+                    )
+                )
+    return renames
+
+
+def apply_changes(cursor, table_name, copy_name, watermark):
+    #Apply the deletions and writes of transactions since the watermark to
+    #the copy
+    cursor.execute(
+        "DELETE FROM %s c USING gpkg_tile_deletions d WHERE d.table_name = "
+        "%%s AND d.deleted_txid >= %%s AND c.zoom_level = d.zoom_level AND "
+        "c.tile_column = d.tile_column AND c.tile_row = d.tile_row;"
+        % quote_ident(copy_name), (table_name, watermark)
+    )
+    cursor.execute(
+        "SELECT attname FROM pg_attribute WHERE attrelid = to_regclass(%s) "
+        "AND attnum > 0 AND NOT attisdropped ORDER BY attnum;",
+        (quote_ident(table_name),)
+    )
+    columns = [
+        column[0] for column in cursor.fetchall() if column[0] not in
+        ("zoom_level", "tile_column", "tile_row")
+    ]
+    cursor.execute(
+        "INSERT INTO %s SELECT * FROM %s WHERE change_txid >= %%s ORDER BY "
+        "%s ON CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE SET "
+        "%s;" % (
+            quote_ident(copy_name), quote_ident(table_name),
+            gpkg_pg_store.MORTON_ORDER,
+            ", ".join("%s = EXCLUDED.%s" % ((quote_ident(column),)*2)
+                      for column in columns)
+        ), (watermark,)
+    )
+
+
+def table_privileges(cursor, table_name):
+    #Statements granting the privileges on the table and its columns again
+    cursor.execute(
+        "SELECT x.privilege_type, NULL, x.grantee, x.is_grantable FROM "
+        "pg_class c, aclexplode(c.relacl) x WHERE c.oid = to_regclass(%s) "
+        "UNION ALL SELECT x.privilege_type, a.attname, x.grantee, "
+        "x.is_grantable FROM pg_attribute a, aclexplode(a.attacl) x WHERE "
+        "a.attrelid = to_regclass(%s) AND NOT a.attisdropped ORDER BY 3, 2, "
+        "1;", (quote_ident(table_name),)*2
+    )
+    privileges = cursor.fetchall()
+    cursor.execute(
+        "SELECT oid, rolname FROM pg_roles WHERE oid = ANY(%s);",
+        (list(set(privilege[2] for privilege in privileges)),)
+    )
+    roles = dict(cursor.fetchall())
+    return [
+        "GRANT %s%s ON %s TO %s%s;" % (
+            privilege, "" if column is None else " (%s)" % quote_ident(column),
+            quote_ident(table_name),
+            "PUBLIC" if grantee == 0 else quote_ident(roles[grantee]),
+            " WITH GRANT OPTION" if grantable else ""
+        ) for privilege, column, grantee, grantable in privileges
+    ]
+
+
+def replace_table(cursor, table_name, copy_name, renames):
+    #Replace the table by the copy keeping names, owner, privileges, comment,
+    #sequence, triggers, and the foreign keys of other tables referencing it,
+    #return the statements validating the latter
+    cursor.execute(
+        "SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = "
+        "to_regclass(%s) AND NOT tgisinternal ORDER BY tgname;",
+        (quote_ident(table_name),)
+    )
+    triggers = [trigger[0] for trigger in cursor.fetchall()]
+    cursor.execute(
+        "SELECT pg_get_userbyid(relowner), relacl IS NOT NULL, "
+        "obj_description(oid, 'pg_class') FROM pg_class WHERE oid = "
+        "to_regclass(%s);", (quote_ident(table_name),)
+    )
+    owner, granted, comment = cursor.fetchone()
+    privileges = table_privileges(cursor, table_name)
+    #foreign keys are restored without checking the existing rows under the
+    #lock, they are validated afterwards
+    cursor.execute(
+        "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid), "
+        "convalidated FROM pg_constraint WHERE confrelid = to_regclass(%s) "
+        "AND conrelid <> confrelid AND contype = 'f' ORDER BY 1, 2;",
+        (quote_ident(table_name),)
+    )
+    references = cursor.fetchall()
+    for relation, name, definition, validated in references:
+        cursor.execute(
+            "ALTER TABLE %s DROP CONSTRAINT %s;"
+            % (relation, quote_ident(name))
+        )
+
+    cursor.execute(
+        "ALTER TABLE %s OWNER TO %s;"
+        % (quote_ident(copy_name), quote_ident(owner))
+    )
+    cursor.execute(
+        "SELECT pg_get_serial_sequence(%s, 'id');", (quote_ident(table_name),)
+    )
+    sequence = cursor.fetchone()[0]
+    if sequence is not None:
+        cursor.execute(
+            "ALTER SEQUENCE %s OWNED BY %s.id;"
+            % (sequence, quote_ident(copy_name))
+        )
+    cursor.execute("DROP TABLE %s;" % quote_ident(table_name))
+    cursor.execute(
+        "ALTER TABLE %s RENAME TO %s;"
+        % (quote_ident(copy_name), quote_ident(table_name))
+    )
+    for rename in renames:
+        cursor.execute(rename)
+    cursor.execute(
+        "ALTER TABLE %s CLUSTER ON %s;" % (
+            quote_ident(table_name), quote_ident("%s_morton" % table_name)
+        )
+    )
+    #explicit privileges include those of the owner
+    if granted:
+        cursor.execute(
+            "REVOKE ALL ON %s FROM %s;" % (quote_ident(table_name),
+                                            quote_ident(owner))
+        )
+    for privilege in privileges:
+        cursor.execute(privilege)
+    if comment is not None:
+        cursor.execute(
+            "COMMENT ON TABLE %s IS %%s;" % quote_ident(table_name),
+            (comment,)
+        )
+    for trigger in triggers:
+        cursor.execute(trigger + ";")
+    validations = []
+    for relation, name, definition, validated in references:
+        cursor.execute(
+            "ALTER TABLE %s ADD CONSTRAINT %s %s%s;" % (
+                relation, quote_ident(name), definition,
+                " NOT VALID" if validated else ""
+            )
+        )
+        if validated:
+            validations.append(
+                "ALTER TABLE %s VALIDATE CONSTRAINT %s;"
+                % (relation, quote_ident(name))
+            )
+    return validations
+
+
+def cluster_table(conn, table_name, lock_timeout=LOCK_TIMEOUT):
+    #Copy, catch up with concurrent changes, and replace the table
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT to_regclass(%s)::oid;", (quote_ident(table_name),)
+        )
+        copy_name = "gpkg_cluster_%i" % cursor.fetchone()[0]
+    conn.commit()
+    try:
+        with metrics.phase("copy"):
+            watermark = copy_ordered(conn, table_name, copy_name)
+        with metrics.phase("indexes"):
+            renames = copy_indexes(conn, table_name, copy_name)
+
+        #each pass applies the changes made during the previous one
+        with metrics.phase("catch-up"):
+            for i in range(CATCH_UP_PASSES):
+                with conn:
+                    with conn.cursor() as cursor:
+                        next_watermark = snapshot_watermark(cursor)
+                        apply_changes(cursor, table_name, copy_name,
+                                      watermark)
+                watermark = next_watermark
+
+        #writers and readers wait only for the last changes and the swap
+        with metrics.phase("swap"):
+            conn.set_session(isolation_level="READ COMMITTED")
+            with conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        "SET LOCAL lock_timeout = %i;" % lock_timeout
+                    )
+                    cursor.execute(
+                        "LOCK TABLE %s IN ACCESS EXCLUSIVE MODE;"
+                        % quote_ident(table_name)
+                    )
+                    apply_changes(cursor, table_name, copy_name, watermark)
+                    validations = replace_table(cursor, table_name,
+                                                copy_name, renames)
+    except Exception:
+        conn.rollback()
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "DROP TABLE IF EXISTS %s;" % quote_ident(copy_name)
+                )
+        raise
+
+    #validating foreign keys only blocks changes of their constraints
+    with metrics.phase("validation"):
+        for validation in validations:
+            with conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(validation)
+
+
+def cluster_partitions(conn, table_name, lock_timeout=LOCK_TIMEOUT):
+    #CLUSTER each partition in its own transaction, locking one zoom level
+    #at a time
+    with conn:
+        with conn.cursor() as cursor:
+            if not gpkg_pg_store.is_morton_ordered(cursor, table_name):
+                with metrics.phase("indexes"):
+                    gpkg_pg_store.create_morton_index(cursor, table_name,
+                                                      partition=True)
+            relations = gpkg_pg_store.morton_indexes(cursor, table_name)
+    for relation, index in relations:
+        with metrics.phase("copy"):
+            with conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        "SET LOCAL lock_timeout = %i;" % lock_timeout
+                    )
+                    cursor.execute(
+                        "CLUSTER %s USING %s;" % (relation, index)
+                    )
+
+
+def cluster_gpkg(pg_connection_string, gpkg_name, lock_timeout=LOCK_TIMEOUT):
+    conn = psycopg2.connect(pg_connection_string)
+    try:
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT c.relkind FROM gpkg_contents g JOIN pg_class c ON "
+                    "c.relname = g.table_name AND pg_table_is_visible(c.oid) "
+                    "WHERE g.table_name = %s AND g.data_type = 'tiles';",
+                    (gpkg_name,)
+                )
+                relkind = cursor.fetchone()
+                if relkind is None:
+                    sys.stderr.write(
+                        "ERROR: GeoPackage '%s' not found in PostgreSQL.\n"
+                        % gpkg_name
+                    )
+                    sys.exit(1)
+                if metrics.enabled:
+                    cursor.execute(
+                        "SELECT count(*) FROM %s;" % quote_ident(gpkg_name)
+                    )
+                    metrics.add_total(cursor.fetchone()[0])
+        if relkind[0] == "p":
+            cluster_partitions(conn, gpkg_name, lock_timeout)
+        else:
+            cluster_table(conn, gpkg_name, lock_timeout)
+
+        conn.autocommit = True
+        with metrics.phase("analyze"):
+            with conn.cursor() as cursor:
+                cursor.execute("ANALYZE %s;" % quote_ident(gpkg_name))
+    except psycopg2.OperationalError as e:
+        if e.pgcode != '55P03':
+            raise
+        sys.stderr.write(
+            "ERROR: Could not lock GeoPackage '%s' within %i ms. Error "
+            "message was: '%s'.\n" % (gpkg_name, lock_timeout, e.message)
+        )
+        sys.exit(1)
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="This script rewrites the tiles of PostgreSQL-GeoPackages "
+        "in Morton order while they stay in use."
+    )
+    parser.add_argument(
+        "pg_connection_string",
+        help="Connection string for PostgreSQL e.g. \"dbname='gpkg' "
+        "user='gpkg'\"."
+    )
+    parser.add_argument(
+        "gpkg_names", nargs="+", metavar="gpkg_name",
+        help="The GeoPackage names, i.e. the tables in which the tile data "
+        "is stored."
+    )
+    parser.add_argument(
+        "-lock_timeout", type=int, default=LOCK_TIMEOUT, metavar="MS",
+        help="Maximum time to wait for the lock replacing a table or "
+        "clustering a partition in milliseconds, 0 waits forever. Defaults "
+        "to %i." % LOCK_TIMEOUT
+    )
+    gpkg_pg_metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    metrics.setup("gpkg-pg_cluster", args.progress, args.metrics,
+                  args.profile)
+    for gpkg_name in args.gpkg_names:
+        cluster_gpkg(args.pg_connection_string, gpkg_name, args.lock_timeout)
+    metrics.finish()
+
+    for gpkg_name in args.gpkg_names:
+        sys.stdout.write(
+            "GeoPackage '%s' successfully clustered\n" % gpkg_name
+        )
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -28,83 +28,242 @@
 #
 # Description:
 #
-#   This script drops a PostgreSQL-GeoPackage from a database reversing the
+#   This script drops PostgreSQL-GeoPackages from a database reversing the
 #   loading by the gpkg-pg_loadpkg.py script.
 #
+#   Any number of GeoPackages given by name or by a LIKE pattern are dropped
+#   in a single transaction with set-based statements.
+#
 #------------------------------------------------------------------------------
 
 import sys
+import argparse
+import contextlib
 import psycopg2
+import gpkg_pg_cache
+import gpkg_pg_metrics
+import gpkg_pg_store
+from gpkg_pg_metrics import metrics
 
 
-def drop_gpkg(pg_connection_string, gpkg_name):
+#Default number of milliseconds to wait for locks on the tables to drop
+LOCK_TIMEOUT = 5000
 
-    with psycopg2.connect(pg_connection_string) as conn_in:
-        #Check that GeoPackage exists
-        with conn_in.cursor() as cursor_in:
-            cursor_in.execute(
-                "SELECT to_regclass('\"%s\"');"
-                % gpkg_name
-            )
-            if cursor_in.fetchone()[0] is None:
-                sys.stderr.write(
-                    "ERROR: GeoPackage '%s' not found in PostgreSQL.\n" %
-                    gpkg_name
-                )
-                sys.exit(1)
 
-            cursor_in.execute(
-                "SELECT tgname FROM pg_trigger WHERE tgrelid = "
-                "'\"%s\"'::regclass;" % gpkg_name
+def quote_ident(name):
+    return "\"%s\"" % name.replace("\"", "\"\"")
+
+
+def find_gpkgs(cursor_in, gpkg_names, pattern=None):
+    #Resolve the given names and the LIKE pattern into existing GeoPackages,
+    #including those of interrupted checkpointed loads
+    cursor_in.execute("SELECT to_regclass('gpkg_load_state');")
+    loading = ""
+    if cursor_in.fetchone()[0] is not None:
+        loading = " UNION SELECT table_name FROM gpkg_load_state"
+    cursor_in.execute(
+        "SELECT g.table_name, c.oid FROM (SELECT table_name FROM "
+        "gpkg_contents WHERE data_type = 'tiles'%s) g LEFT JOIN pg_class c "
+        "ON c.relname = g.table_name AND pg_table_is_visible(c.oid) WHERE "
+        "g.table_name = ANY(%%s) OR g.table_name LIKE %%s ORDER BY "
+        "g.table_name;" % loading, (list(gpkg_names), pattern)
+    )
+    gpkgs = [gpkg for gpkg in cursor_in.fetchall() if gpkg[1] is not None]
+    found = set(gpkg[0] for gpkg in gpkgs)
+    for gpkg_name in gpkg_names:
+        if gpkg_name not in found:
+            sys.stderr.write(
+                "ERROR: GeoPackage '%s' not found in PostgreSQL.\n" %
+                gpkg_name
             )
-            triggers = cursor_in.fetchall()
-            for trigger in triggers:
-                trigger_name = trigger[0]
+            sys.exit(1)
+    return gpkgs
+
+
+def drop_gpkgs(pg_connection_string, gpkg_names, pattern=None,
+               lock_timeout=LOCK_TIMEOUT, cache=None):
+    #Drop all GeoPackages with a fixed number of statements in a single
+    #transaction, return the number of GeoPackages dropped and the bytes of
+    #relations and tile data freed, their extracts are removed from the
+    #cache if given
+    conn_in = psycopg2.connect(pg_connection_string)
+    with contextlib.closing(conn_in), conn_in, conn_in.cursor() as cursor_in:
+        cursor_in.execute(
+            "SET LOCAL lock_timeout = %i;" % lock_timeout
+        )
+        gpkgs = find_gpkgs(cursor_in, gpkg_names, pattern)
+        if not gpkgs:
+            return 0, 0, 0
+        table_names = [gpkg[0] for gpkg in gpkgs]
+        oids = [gpkg[1] for gpkg in gpkgs]
+        tables = ", ".join(quote_ident(name) for name in table_names)
+
+        try:
+            #lock all tables first so no statement waits halfway through
+            with metrics.phase("lock"):
                 cursor_in.execute(
-                    "DROP FUNCTION \"%s\"() CASCADE;" % trigger_name
+                    "LOCK TABLE %s IN ACCESS EXCLUSIVE MODE;" % tables
                 )
-            cursor_in.execute("DROP TABLE \"%s\";" % gpkg_name)
-            cursor_in.execute(
-                "SELECT md_file_id FROM gpkg_metadata_reference WHERE "
-                "table_name = '%s';" % gpkg_name
+        except psycopg2.OperationalError as e:
+            if e.pgcode != '55P03':
+                raise
+            sys.stderr.write(
+                "ERROR: Could not lock the GeoPackages within %i ms. "
+                "Error message was: '%s'.\n" % (lock_timeout, e.message)
             )
-            md_ids = cursor_in.fetchall()
+            sys.exit(1)
+
+        #size of the tables including partitions, indexes and TOAST, sums
+        #of bigints are numeric and cast back
+        cursor_in.execute(
+            "SELECT coalesce(sum(pg_total_relation_size(oid)), "
+            "0)::bigint, coalesce(sum(greatest(reltuples, 0)), "
+            "0)::bigint FROM pg_class WHERE oid = ANY(%s::oid[]) OR oid "
+            "IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = "
+            "ANY(%s::oid[]));", (oids, oids)
+        )
+        relation_bytes, tiles = cursor_in.fetchone()
+        metrics.add_total(int(tiles))
+
+        #drop the functions created for single tables by earlier
+        #versions, shared trigger functions get the table name as
+        #argument and stay
+        with metrics.phase("trigger removal"):
             cursor_in.execute(
-                "DELETE FROM gpkg_metadata_reference WHERE table_name = '%s';"
-                % gpkg_name
+                "SELECT p.oid::regprocedure::text FROM pg_trigger t JOIN "
+                "pg_proc p ON p.oid = t.tgfoid WHERE t.tgrelid = "
+                "ANY(%s::oid[]) AND NOT t.tgisinternal AND "
+                "t.tgnargs = 0 AND p.proname = t.tgname;", (oids,)
             )
-            for md_id in md_ids:
+            functions = [function[0] for function in cursor_in]
+            if functions:
                 cursor_in.execute(
-                    "DELETE FROM gpkg_metadata WHERE id = '%s';" % md_id
+                    "DROP FUNCTION %s CASCADE;" % ", ".join(functions)
                 )
+
+        #release shared tile data of deduplicated tables
+        blob_bytes = 0
+        cursor_in.execute(
+            "SELECT attrelid::regclass::text FROM pg_attribute WHERE "
+            "attrelid = ANY(%s::oid[]) AND attname = 'tile_hash' AND "
+            "NOT attisdropped;", (oids,)
+        )
+        dedup_tables = [table[0] for table in cursor_in.fetchall()]
+        if dedup_tables:
+            with metrics.phase("tile data release"):
+                blob_bytes = gpkg_pg_store.release_tile_blobs(
+                    cursor_in, " UNION ALL ".join(
+                        "SELECT tile_hash FROM %s" % table
+                        for table in dedup_tables
+                    )
+                )
+
+        with metrics.phase("table drop"):
+            cursor_in.execute("DROP TABLE %s;" % tables)
+            for table_name in ("gpkg_tile_deletions", "gpkg_tile_pruning",
+                               "gpkg_tile_overviews", "gpkg_load_state"):
+                cursor_in.execute(
+                    "SELECT to_regclass('%s');" % table_name
+                )
+                if cursor_in.fetchone()[0] is not None:
+                    cursor_in.execute(
+                        "DELETE FROM %s WHERE table_name = ANY(%%s);"
+                        % table_name, (table_names,)
+                    )
+        metrics.count(int(tiles))
+
+        with metrics.phase("metadata"):
             cursor_in.execute(
-                "DELETE FROM gpkg_tile_matrix WHERE table_name = '%s';"
-                % gpkg_name
-            )
-            cursor_in.execute(
-                "DELETE FROM gpkg_tile_matrix_set WHERE table_name = '%s';"
-                % gpkg_name
+                "DELETE FROM gpkg_metadata_reference WHERE "
+                "table_name = ANY(%s) RETURNING md_file_id;",
+                (table_names,)
             )
+            md_ids = list(set(md_id[0] for md_id in cursor_in))
+            #metadata still referenced by other GeoPackages stays
             cursor_in.execute(
-                "DELETE FROM gpkg_contents WHERE table_name = '%s';"
-                % gpkg_name
+                "DELETE FROM gpkg_metadata m WHERE m.id = ANY(%s) AND "
+                "NOT EXISTS (SELECT 1 FROM gpkg_metadata_reference r "
+                "WHERE r.md_file_id = m.id);", (md_ids,)
             )
+            for table_name in ("gpkg_tile_matrix",
+                               "gpkg_tile_matrix_set", "gpkg_contents"):
+                cursor_in.execute(
+                    "DELETE FROM %s WHERE table_name = ANY(%%s);"
+                    % table_name, (table_names,)
+                )
 
+    if cache is not None:
+        for table_name in table_names:
+            cache.invalidate(table_name)
+    return len(gpkgs), int(relation_bytes), int(blob_bytes)
 
-if __name__ == "__main__":
-    if len(sys.argv) <= 2:
-        sys.stderr.write(
-            "ERROR: Please provide the connection string for PostgreSQL as "
-            "well as the GeoPackage name to drop.\n"
-        )
-        sys.exit(1)
 
-    pg_connection_string = sys.argv[1]
-    gpkg_name = sys.argv[2]
+def drop_gpkg(pg_connection_string, gpkg_name):
+    drop_gpkgs(pg_connection_string, [gpkg_name])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="This script drops PostgreSQL-GeoPackages from a "
+        "database reversing the loading by the gpkg-pg_loadpkg.py script."
+    )
+    parser.add_argument(
+        "pg_connection_string",
+        help="Connection string for PostgreSQL e.g. \"dbname='gpkg' "
+        "user='gpkg'\"."
+    )
+    parser.add_argument(
+        "gpkg_names", nargs="*", metavar="gpkg_name",
+        help="The GeoPackage names, i.e. the tables in which the tile data "
+        "is stored."
+    )
+    parser.add_argument(
+        "-pattern",
+        help="Also drop all GeoPackages whose name matches this SQL LIKE "
+        "pattern, e.g. \"mosaic_2016%%\"."
+    )
+    parser.add_argument(
+        "-lock_timeout", type=int, default=LOCK_TIMEOUT, metavar="MS",
+        help="Maximum time to wait for the locks on the GeoPackages in "
+        "milliseconds, 0 waits forever. Defaults to %i." % LOCK_TIMEOUT
+    )
+    parser.add_argument(
+        "-cache_dir", metavar="DIR",
+        help="Also remove the cached extracts of the dropped GeoPackages "
+        "from the extract cache of gpkg-pg_dump.py in DIR."
+    )
+    gpkg_pg_metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if not args.gpkg_names and args.pattern is None:
+        parser.error("provide GeoPackage names or a -pattern")
 
-    drop_gpkg(pg_connection_string, gpkg_name)
+    metrics.setup("gpkg-pg_drop", args.progress, args.metrics, args.profile)
+    cache = None
+    if args.cache_dir is not None:
+        cache = gpkg_pg_cache.ExtractCache(args.cache_dir)
+    count, relation_bytes, blob_bytes = drop_gpkgs(
+        args.pg_connection_string, args.gpkg_names, args.pattern,
+        args.lock_timeout, cache
+    )
+    metrics.finish()
 
+    if len(args.gpkg_names) == 1 and args.pattern is None:
+        sys.stdout.write(
+            "GeoPackage '%s' successfully deleted\n" % args.gpkg_names[0]
+        )
+    else:
+        sys.stdout.write(
+            "%i GeoPackages successfully deleted\n" % count
+        )
     sys.stdout.write(
-        "GeoPackage '%s' successfully deleted\n" % gpkg_name
+        "Reclaimed %.1f MB of tables and %.1f MB of shared tile data\n" % (
+            relation_bytes/1048576.0, blob_bytes/1048576.0
+        )
     )
     sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -41,9 +41,128 @@ import os
 import argparse
 import sqlite3
 import datetime
+import functools
+import threading
+import Queue
 import psycopg2
-from osgeo import gdal
-from osgeo import osr
+import gpkg_pg_batch
+import gpkg_pg_cache
+import gpkg_pg_metrics
+import gpkg_pg_store
+from gpkg_pg_metrics import metrics
+
+
+#Number of tiles fetched and written per batch in bulk mode
+BULK_BATCH_SIZE = 1000
+#SQLite page cache used in bulk mode in KiB
+BULK_CACHE_SIZE = 256*1024
+#Number of id ranges per connection in parallel mode
+SHARDS_PER_JOB = 4
+#Number of batches buffered per id range in parallel mode
+SHARD_QUEUE_SIZE = 4
+#SQLite application id and user version of GeoPackage 1.2 files
+GPKG_APPLICATION_ID = 0x47504B47
+GPKG_USER_VERSION = 10200
+#Tables of the GeoPackage created by the native writer as in the standard
+GPKG_TABLES = [
+    "CREATE TABLE gpkg_spatial_ref_sys ("
+    "    srs_name TEXT NOT NULL,"
+    "    srs_id INTEGER NOT NULL PRIMARY KEY,"
+    "    organization TEXT NOT NULL,"
+    "    organization_coordsys_id INTEGER NOT NULL,"
+    "    definition TEXT NOT NULL,"
+    "    description TEXT"
+    ");",
+    "CREATE TABLE gpkg_contents ("
+    "    table_name TEXT NOT NULL PRIMARY KEY,"
+    "    data_type TEXT NOT NULL,"
+    "    identifier TEXT UNIQUE,"
+    "    description TEXT DEFAULT '',"
+    "    last_change DATETIME NOT NULL DEFAULT "
+    "(strftime('%Y-%m-%dT%H:%M:%fZ','now')),"
+    "    min_x DOUBLE,"
+    "    min_y DOUBLE,"
+    "    max_x DOUBLE,"
+    "    max_y DOUBLE,"
+    "    srs_id INTEGER,"
+    "    CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES "
+    "gpkg_spatial_ref_sys(srs_id)"
+    ");",
+    "CREATE TABLE gpkg_geometry_columns ("
+    "    table_name TEXT NOT NULL,"
+    "    column_name TEXT NOT NULL,"
+    "    geometry_type_name TEXT NOT NULL,"
+    "    srs_id INTEGER NOT NULL,"
+    "    z TINYINT NOT NULL,"
+    "    m TINYINT NOT NULL,"
+    "    CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),"
+    "    CONSTRAINT uk_gc_table_name UNIQUE (table_name),"
+    "    CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES "
+    "gpkg_contents(table_name),"
+    "    CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES "
+    "gpkg_spatial_ref_sys (srs_id)"
+    ");",
+    "CREATE TABLE gpkg_tile_matrix_set ("
+    "    table_name TEXT NOT NULL PRIMARY KEY,"
+    "    srs_id INTEGER NOT NULL,"
+    "    min_x DOUBLE NOT NULL,"
+    "    min_y DOUBLE NOT NULL,"
+    "    max_x DOUBLE NOT NULL,"
+    "    max_y DOUBLE NOT NULL,"
+    "    CONSTRAINT fk_gtms_table_name FOREIGN KEY (table_name) REFERENCES "
+    "gpkg_contents(table_name),"
+    "    CONSTRAINT fk_gtms_srs FOREIGN KEY (srs_id) REFERENCES "
+    "gpkg_spatial_ref_sys (srs_id)"
+    ");",
+    "CREATE TABLE gpkg_tile_matrix ("
+    "    table_name TEXT NOT NULL,"
+    "    zoom_level INTEGER NOT NULL,"
+    "    matrix_width INTEGER NOT NULL,"
+    "    matrix_height INTEGER NOT NULL,"
+    "    tile_width INTEGER NOT NULL,"
+    "    tile_height INTEGER NOT NULL,"
+    "    pixel_x_size DOUBLE NOT NULL,"
+    "    pixel_y_size DOUBLE NOT NULL,"
+    "    CONSTRAINT pk_ttm PRIMARY KEY (table_name, zoom_level),"
+    "    CONSTRAINT fk_tmm_table_name FOREIGN KEY (table_name) REFERENCES "
+    "gpkg_contents(table_name)"
+    ");",
+    "CREATE TABLE gpkg_extensions ("
+    "    table_name TEXT,"
+    "    column_name TEXT,"
+    "    extension_name TEXT NOT NULL,"
+    "    definition TEXT NOT NULL,"
+    "    scope TEXT NOT NULL,"
+    "    CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name)"
+    ");",
+    "CREATE TABLE gpkg_metadata ("
+    "    id INTEGER CONSTRAINT m_pk PRIMARY KEY ASC NOT NULL,"
+    "    md_scope TEXT NOT NULL DEFAULT 'dataset',"
+    "    md_standard_uri TEXT NOT NULL,"
+    "    mime_type TEXT NOT NULL DEFAULT 'text/xml',"
+    "    metadata TEXT NOT NULL DEFAULT ''"
+    ");",
+    "CREATE TABLE gpkg_metadata_reference ("
+    "    reference_scope TEXT NOT NULL,"
+    "    table_name TEXT,"
+    "    column_name TEXT,"
+    "    row_id_value INTEGER,"
+    "    timestamp DATETIME NOT NULL DEFAULT "
+    "(strftime('%Y-%m-%dT%H:%M:%fZ','now')),"
+    "    md_file_id INTEGER NOT NULL,"
+    "    md_parent_id INTEGER,"
+    "    CONSTRAINT crmr_mfi_fk FOREIGN KEY (md_file_id) REFERENCES "
+    "gpkg_metadata(id),"
+    "    CONSTRAINT crmr_mpi_fk FOREIGN KEY (md_parent_id) REFERENCES "
+    "gpkg_metadata(id)"
+    ");",
+    "INSERT INTO gpkg_extensions VALUES ('gpkg_metadata', NULL, "
+    "'gpkg_metadata', 'http://www.geopackage.org/spec120/"
+    "#extension_metadata', 'read-write');",
+    "INSERT INTO gpkg_extensions VALUES ('gpkg_metadata_reference', NULL, "
+    "'gpkg_metadata', 'http://www.geopackage.org/spec120/"
+    "#extension_metadata', 'read-write');",
+]
 
 
 def create_gpkg(
@@ -56,6 +175,9 @@ def create_gpkg(
         )
         sys.exit(1)
 
+    #GDAL is only loaded when it creates the SQLite GeoPackage
+    from osgeo import gdal
+    from osgeo import osr
     gdal.AllRegister()
     drv = gdal.GetDriverByName("GPKG")
     try:
@@ -131,8 +253,348 @@ def copy_table(conn_in, conn_out, table_name, constraint=None):
                     sys.exit(1)
 
 
-def dump_gpkg(pg_connection_string, gpkg_name, srcwin=None):
-    with psycopg2.connect(pg_connection_string) as conn_in:
+def write_tiles(batches, conn_out, gpkg_name, offsets, update=False):
+    cursor_out = conn_out.cursor()
+    for records in batches:
+        try:
+            cursor_out.executemany(
+                "INSERT %sINTO \"%s\" (zoom_level, tile_column, tile_row, "
+                "tile_data) VALUES (?, ?, ?, ?);" % (
+                    "OR REPLACE " if update else "", gpkg_name
+                ),
+                [(offsets[record[1]][0], record[2]-offsets[record[1]][1],
+                  record[3]-offsets[record[1]][2], record[4])
+                 for record in records]
+            )
+            metrics.count(
+                len(records), sum(len(record[4]) for record in records)
+            )
+        except Exception as e:
+            conn_out.rollback()
+            sys.stderr.write(
+                "ERROR: Input doesn't seem to be a valid GeoPackage. "
+                "Error message was: '%s'.\n" % e.message
+            )
+            sys.exit(1)
+
+
+def dump_tiles(conn_in, conn_out, gpkg_name, source, constraint,
+               offsets, bulk=False, update=False):
+    with conn_in.cursor("tiles") as cursor_tiles:
+        if bulk or update:
+            cursor_tiles.itersize = BULK_BATCH_SIZE
+        cursor_tiles.execute(
+            "SELECT id, zoom_level, tile_column, tile_row, "
+            "tile_data FROM %s%s ORDER BY id;" % (
+                source, "" if constraint is None else " WHERE " + constraint
+            )
+        )
+
+        if bulk or update:
+            write_tiles(
+                iter(lambda: cursor_tiles.fetchmany(BULK_BATCH_SIZE), []),
+                conn_out, gpkg_name, offsets, update
+            )
+            return
+
+        cursor_out = conn_out.cursor()
+        for record in metrics.counted(cursor_tiles):
+            try:
+                cursor_out.execute(
+                    "INSERT INTO \"%s\" (zoom_level, tile_column, "
+                    "tile_row, tile_data) VALUES (?, ?, ?, ?);"
+                    % gpkg_name,
+                    (offsets[record[1]][0],
+                     record[2]-offsets[record[1]][1],
+                     record[3]-offsets[record[1]][2],
+                     sqlite3.Binary(str(record[4])))
+                )
+            except Exception as e:
+                conn_out.rollback()
+                sys.stderr.write(
+                    "ERROR: Input doesn't seem to be a valid "
+                    "GeoPackage. Error message was: '%s'.\n"
+                    % e.message
+                )
+                sys.exit(1)
+
+
+def write_tile_matrix(conn_out, gpkg_name, matrix):
+    #Replace the tile matrices of the SQLite GeoPackage with those of the
+    #extract and set its extents
+    rows, offsets, tms_extent, contents_extent = matrix
+    cursor_out = conn_out.cursor()
+    cursor_out.execute(
+        "DELETE FROM gpkg_tile_matrix WHERE table_name = ?;", (gpkg_name,)
+    )
+    cursor_out.executemany(
+        "INSERT INTO gpkg_tile_matrix (table_name, zoom_level, "
+        "matrix_width, matrix_height, tile_width, tile_height, pixel_x_size, "
+        "pixel_y_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?);", rows
+    )
+    if tms_extent is not None:
+        cursor_out.execute(
+            "UPDATE gpkg_tile_matrix_set SET min_x = ?, min_y = ?, "
+            "max_x = ?, max_y = ? WHERE table_name = ?;",
+            tms_extent + (gpkg_name,)
+        )
+        cursor_out.execute(
+            "UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, "
+            "max_y = ? WHERE table_name = ?;", contents_extent + (gpkg_name,)
+        )
+
+
+def create_gpkg_native(conn_in, gpkg_name, matrix=None):
+    #Create the SQLite GeoPackage with the tables of the standard and the
+    #metadata and all tile matrices of the PostgreSQL-GeoPackage, or those
+    #of the extract as written to files created by GDAL
+    if os.path.exists("%s.gpkg" % gpkg_name):
+        sys.stderr.write(
+            "ERROR: SQLite GeoPackage '%s.gpkg' already exists.\n" % gpkg_name
+        )
+        sys.exit(1)
+
+    if matrix is None:
+        with conn_in.cursor() as cursor_in:
+            matrix = gpkg_pg_store.extract_tile_matrix(cursor_in, gpkg_name)
+
+    conn_out = sqlite3.connect("%s.gpkg" % gpkg_name)
+    try:
+        conn_out.execute(
+            "PRAGMA application_id = %i;" % GPKG_APPLICATION_ID
+        )
+        conn_out.execute("PRAGMA user_version = %i;" % GPKG_USER_VERSION)
+        for statement in GPKG_TABLES:
+            conn_out.execute(statement)
+        conn_out.execute(
+            "CREATE TABLE \"%s\" ("
+            "    id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "    zoom_level INTEGER NOT NULL,"
+            "    tile_column INTEGER NOT NULL,"
+            "    tile_row INTEGER NOT NULL,"
+            "    tile_data BLOB NOT NULL,"
+            "    UNIQUE (zoom_level, tile_column, tile_row)"
+            ");" % gpkg_name
+        )
+        copy_table(conn_in, conn_out, "gpkg_spatial_ref_sys",
+                   "srs_id IN (-1, 0, 4326) OR srs_id = (SELECT srs_id FROM "
+                   "gpkg_contents WHERE table_name = '%s')" % gpkg_name)
+        for table_name in ("gpkg_contents", "gpkg_tile_matrix_set"):
+            copy_table(conn_in, conn_out, table_name,
+                       "table_name = '%s'" % gpkg_name)
+        write_tile_matrix(conn_out, gpkg_name, matrix)
+        conn_out.commit()
+    except Exception as e:
+        conn_out.close()
+        os.remove("%s.gpkg" % gpkg_name)
+        sys.stderr.write(
+            "ERROR: Cannot create SQLite GeoPackage '%s.gpkg'. "
+            "Error message was: '%s'.\n" % (gpkg_name, e)
+        )
+        sys.exit(1)
+    conn_out.close()
+
+
+def read_watermark(gpkg_name):
+    #Get the state recorded by the last export of the SQLite GeoPackage
+    if not os.path.exists("%s.gpkg" % gpkg_name):
+        sys.stderr.write(
+            "ERROR: SQLite GeoPackage '%s.gpkg' not found.\n" % gpkg_name
+        )
+        sys.exit(1)
+    conn_out = sqlite3.connect("%s.gpkg" % gpkg_name)
+    try:
+        cursor_out = conn_out.cursor()
+        cursor_out.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND "
+            "name='gpkg_pg_watermark';"
+        )
+        watermark = None
+        if cursor_out.fetchone():
+            cursor_out.execute(
+                "SELECT txid, max_zoom_level, xoff, yoff, xsize, ysize FROM "
+                "gpkg_pg_watermark WHERE table_name = ?;", (gpkg_name,)
+            )
+            watermark = cursor_out.fetchone()
+    finally:
+        conn_out.close()
+    if watermark is None:
+        sys.stderr.write(
+            "ERROR: SQLite GeoPackage '%s.gpkg' has no recorded export of "
+            "a change tracked PostgreSQL-GeoPackage.\n" % gpkg_name
+        )
+        sys.exit(1)
+    return (watermark[0], watermark[1],
+            None if watermark[2] is None else list(watermark[2:6]))
+
+
+def check_pruning(cursor_in, gpkg_name, watermark):
+    #Deletions since the watermark must not have been pruned by
+    #gpkg-pg_prune.py
+    cursor_in.execute("SELECT to_regclass('gpkg_tile_pruning');")
+    if cursor_in.fetchone()[0] is None:
+        return
+    cursor_in.execute(
+        "SELECT pruned_txid FROM gpkg_tile_pruning WHERE table_name = %s "
+        "AND pruned_txid > %s;", (gpkg_name, watermark)
+    )
+    pruned = cursor_in.fetchone()
+    if pruned is not None:
+        sys.stderr.write(
+            "ERROR: Deletions of GeoPackage '%s' before transaction %i are "
+            "pruned, the last export at transaction %i requires a new full "
+            "dump.\n" % (gpkg_name, pruned[0], watermark)
+        )
+        sys.exit(1)
+
+
+def write_watermark(conn_out, gpkg_name, txid, max_zoom_level, srcwin):
+    #Record the export so the next update only writes later changes
+    cursor_out = conn_out.cursor()
+    cursor_out.execute(
+        "CREATE TABLE IF NOT EXISTS gpkg_pg_watermark ("
+        "    table_name TEXT NOT NULL PRIMARY KEY,"
+        "    txid INTEGER NOT NULL,"
+        "    max_zoom_level INTEGER NOT NULL,"
+        "    xoff INTEGER,"
+        "    yoff INTEGER,"
+        "    xsize INTEGER,"
+        "    ysize INTEGER"
+        ");"
+    )
+    cursor_out.execute(
+        "INSERT OR REPLACE INTO gpkg_pg_watermark VALUES (?, ?, ?, ?, ?, ?, "
+        "?);", [gpkg_name, txid, max_zoom_level] +
+        (srcwin if srcwin is not None else [None]*4)
+    )
+
+
+def remove_metadata(conn_out, gpkg_name):
+    #Remove previously exported metadata before it is dumped again
+    cursor_out = conn_out.cursor()
+    cursor_out.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type='table' AND name IN "
+        "('gpkg_metadata', 'gpkg_metadata_reference');"
+    )
+    if cursor_out.fetchone()[0] == 2:
+        cursor_out.execute(
+            "DELETE FROM gpkg_metadata WHERE id IN (SELECT md_file_id FROM "
+            "gpkg_metadata_reference WHERE table_name = ?);", (gpkg_name,)
+        )
+        cursor_out.execute(
+            "DELETE FROM gpkg_metadata_reference WHERE table_name = ?;",
+            (gpkg_name,)
+        )
+
+
+def delete_tiles(conn_in, conn_out, gpkg_name, constraint, offsets,
+                 watermark):
+    #Remove tiles deleted in PostgreSQL since the last export
+    with conn_in.cursor("deletions") as cursor_deletions:
+        cursor_deletions.itersize = BULK_BATCH_SIZE
+        cursor_deletions.execute(
+            "SELECT zoom_level, tile_column, tile_row FROM "
+            "gpkg_tile_deletions WHERE table_name = %%s AND "
+            "deleted_txid >= %%s%s;" % (
+                "" if constraint is None else " AND " + constraint
+            ), (gpkg_name, watermark)
+        )
+        conn_out.cursor().executemany(
+            "DELETE FROM \"%s\" WHERE zoom_level = ? AND tile_column = ? "
+            "AND tile_row = ?;" % gpkg_name,
+            ((offsets[record[0]][0], record[1]-offsets[record[0]][1],
+              record[2]-offsets[record[0]][2])
+             for record in cursor_deletions if record[0] in offsets)
+        )
+
+
+def read_shards(pg_connection_string, snapshot, query, shards, next_shard,
+                queues, errors):
+    #Reader thread: fetch the next free id range within the snapshot of the
+    #main connection
+    try:
+        conn_in = psycopg2.connect(pg_connection_string)
+        conn_in.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        with conn_in.cursor() as cursor_in:
+            cursor_in.execute("SET TRANSACTION SNAPSHOT '%s';" % snapshot)
+        while not errors:
+            with next_shard[1]:
+                shard = next_shard[0]
+                next_shard[0] += 1
+            if shard >= len(shards):
+                break
+            with conn_in.cursor("shard") as cursor_shard:
+                cursor_shard.execute(query % shards[shard])
+                while True:
+                    records = cursor_shard.fetchmany(BULK_BATCH_SIZE)
+                    if not records:
+                        break
+                    queues[shard].put(records)
+            queues[shard].put(None)
+        conn_in.close()
+    except Exception as e:
+        errors.append(e)
+
+
+def sharded_tiles(conn_in, pg_connection_string, gpkg_name, source,
+                  constraint, jobs):
+    #Yield batches of tiles in id order read by jobs connections in parallel
+    with conn_in.cursor() as cursor_in:
+        cursor_in.execute(
+            "SELECT min(id), max(id) FROM \"%s\"%s;" % (
+                gpkg_name, "" if constraint is None else " WHERE " + constraint
+            )
+        )
+        min_id, max_id = cursor_in.fetchone()
+        if min_id is None:
+            return
+        cursor_in.execute("SELECT pg_export_snapshot();")
+        snapshot = cursor_in.fetchone()[0]
+
+    count = min(jobs*SHARDS_PER_JOB, max_id-min_id+1)
+    step = (max_id-min_id+1) // count
+    shards = [
+        (min_id+i*step, max_id+1 if i == count-1 else min_id+(i+1)*step)
+        for i in range(count)
+    ]
+    query = (
+        "SELECT id, zoom_level, tile_column, tile_row, tile_data FROM "
+        "%s WHERE %sid >= %%i AND id < %%i ORDER BY id;" % (
+            source, "" if constraint is None else constraint + " AND "
+        )
+    )
+    queues = [Queue.Queue(SHARD_QUEUE_SIZE) for shard in shards]
+    next_shard = [0, threading.Lock()]
+    errors = []
+    for i in range(min(jobs, count)):
+        reader = threading.Thread(
+            target=read_shards,
+            args=(pg_connection_string, snapshot, query, shards, next_shard,
+                  queues, errors)
+        )
+        reader.daemon = True
+        reader.start()
+
+    for shard_queue in queues:
+        while True:
+            try:
+                records = shard_queue.get(timeout=1)
+            except Queue.Empty:
+                if errors:
+                    raise errors[0]
+                continue
+            if records is None:
+                break
+            yield records
+
+
+def dump_gpkg(pg_connection_string, gpkg_name, srcwin=None, bulk=False,
+              jobs=1, update=False, native=False, cache=None, conn_in=None):
+    #A given connection is reused, e.g. in batch mode, exports are served
+    #from and added to the extract cache if given
+    if conn_in is None:
+        conn_in = psycopg2.connect(pg_connection_string)
+    with conn_in:
         #Check that GeoPackage exists
         with conn_in.cursor() as cursor_in:
             cursor_in.execute(
@@ -146,18 +608,54 @@ def dump_gpkg(pg_connection_string, gpkg_name, srcwin=None):
                 )
                 sys.exit(1)
 
-            #get projection, geotransform, and size
+            #check for change tracking and take the watermark before reading
+            #any tiles, all later changes have a higher transaction id
+            cursor_in.execute(
+                "SELECT 1 FROM pg_attribute WHERE attrelid = "
+                "'\"%s\"'::regclass AND attname = 'change_txid' AND "
+                "NOT attisdropped;" % gpkg_name
+            )
+            tracked = cursor_in.fetchone() is not None
+            cursor_in.execute(
+                "SELECT txid_snapshot_xmin(txid_current_snapshot());"
+            )
+            txid = cursor_in.fetchone()[0]
+            if update:
+                if not tracked:
+                    sys.stderr.write(
+                        "ERROR: GeoPackage '%s' has no change tracking. "
+                        "Please run gpkg-pg_upgrade.sql.\n" % gpkg_name
+                    )
+                    sys.exit(1)
+                watermark, exported_zoom_level, exported_srcwin = \
+                    read_watermark(gpkg_name)
+                check_pruning(cursor_in, gpkg_name, watermark)
+                if srcwin is None:
+                    srcwin = exported_srcwin
+                elif list(srcwin) != exported_srcwin:
+                    sys.stderr.write(
+                        "ERROR: srcwin %s differs from the srcwin %s of the "
+                        "last export.\n" % (srcwin, exported_srcwin)
+                    )
+                    sys.exit(1)
+            window = srcwin
+
+            #get projection, geotransform, and size, the origin of the tile
+            #indexes is the one of the tile matrix set while the extent in
+            #gpkg_contents might be narrowed to the loaded tiles
             cursor_in.execute(
                 "SELECT srs.organization, srs.organization_coordsys_id, "
-                "con.min_x, ma.pixel_x_size, 0, con.max_y, 0, "
-                "-ma.pixel_y_size, (con.max_x-con.min_x)/ma.pixel_x_size, "
-                "(con.max_y-con.min_y)/ma.pixel_y_size, con.identifier, "
+                "tms.min_x, ma.pixel_x_size, 0, tms.max_y, 0, "
+                "-ma.pixel_y_size, (con.max_x-tms.min_x)/ma.pixel_x_size, "
+                "(tms.max_y-con.min_y)/ma.pixel_y_size, con.identifier, "
                 "con.description, ma.matrix_width, ma.matrix_height, "
                 "ma.zoom_level FROM gpkg_contents con, gpkg_spatial_ref_sys "
-                "srs, gpkg_tile_matrix ma, (SELECT max(zoom_level) as max "
-                "FROM gpkg_tile_matrix) max WHERE con.table_name = '%s' AND "
-                "con.srs_id = srs.srs_id AND ma.table_name = con.table_name "
-                "AND ma.zoom_level = max.max;" % gpkg_name
+                "srs, gpkg_tile_matrix_set tms, gpkg_tile_matrix ma, "
+                "(SELECT max(zoom_level) as max FROM gpkg_tile_matrix WHERE "
+                "table_name = '%s') max WHERE con.table_name = '%s' AND "
+                "con.srs_id = srs.srs_id AND tms.table_name = con.table_name "
+                "AND ma.table_name = con.table_name AND ma.zoom_level = "
+                "max.max;" % (gpkg_name, gpkg_name)
             )
             result = cursor_in.fetchone()
             proj_string = "%s:%i" % result[0:2]
@@ -205,67 +703,207 @@ def dump_gpkg(pg_connection_string, gpkg_name, srcwin=None):
                 geotransform.append(tmp[4])
                 geotransform.append(tmp[5])
 
-                constraint = (
-                    "zoom_level = %i AND tile_column >= %i AND "
-                    "tile_column < %i AND tile_row >= %i AND tile_row < %i "
-                    "ORDER BY id"
-                    % (max_zoom_level, srcwin[0], srcwin[0]+srcwin[2],
-                       srcwin[1], srcwin[1]+srcwin[3])
+                windows = gpkg_pg_store.extract_windows(
+                    cursor_in, gpkg_name, srcwin
                 )
+                matrix = gpkg_pg_store.extract_tile_matrix(
+                    cursor_in, gpkg_name, windows
+                )
+
+            else:
+                windows = None
+                matrix = None
 
+            #repeated extracts of unchanged GeoPackages are copied from the
+            #cache, tables without change tracking have no data version
+            if cache is not None and tracked and not update:
+                version, version_txid = gpkg_pg_cache.data_version(
+                    cursor_in, gpkg_name
+                )
+                if windows is None:
+                    cursor_in.execute(
+                        "SELECT min(zoom_level), max(zoom_level) FROM "
+                        "gpkg_tile_matrix WHERE table_name = %s;",
+                        (gpkg_name,)
+                    )
+                    zoom_range = cursor_in.fetchone()
+                else:
+                    zoom_range = (min(windows), max(windows))
+                extract = (
+                    None if srcwin is None else list(srcwin),
+                    tuple(zoom_range), native
+                )
+                if os.path.exists("%s.gpkg" % gpkg_name):
+                    sys.stderr.write(
+                        "ERROR: SQLite GeoPackage '%s.gpkg' already exists.\n"
+                        % gpkg_name
+                    )
+                    sys.exit(1)
+                with metrics.phase("cache"):
+                    if cache.fetch(gpkg_name, version, extract,
+                                   "%s.gpkg" % gpkg_name):
+                        return
             else:
-                srcwin = [0, 0, matrix_size[0], matrix_size[1]]
-                constraint = None
+                cache = None
+
+            if update and max_zoom_level != exported_zoom_level:
+                sys.stderr.write(
+                    "ERROR: Tile matrix of GeoPackage '%s' changed since the "
+                    "last export, please export it again.\n" % gpkg_name
+                )
+                sys.exit(1)
 
             #tables gpkg_contents, gpkg_spatial_ref_sys, gpkg_tile_matrix_set,
-            #and gpkg_tile_matrix are handled by GDAL
-            create_gpkg(
-                gpkg_name, proj_string, size, geotransform, creation_options
-            )
+            #and gpkg_tile_matrix are handled by GDAL or the native writer
+            if not update and native:
+                with metrics.phase("file creation"):
+                    create_gpkg_native(conn_in, gpkg_name, matrix)
+            elif not update:
+                with metrics.phase("GDAL creation"):
+                    create_gpkg(
+                        gpkg_name, proj_string, size, geotransform,
+                        creation_options
+                    )
 
             with sqlite3.connect("%s.gpkg" % gpkg_name) as conn_out:
-                #dump metadata
-                copy_table(conn_in, conn_out, "gpkg_metadata_reference",
-                           "table_name = '%s'" % gpkg_name)
-                copy_table(conn_in, conn_out, "gpkg_metadata",
-                           "id IN (SELECT md_file_id FROM "
-                           "gpkg_metadata_reference WHERE table_name = '%s')"
-                           % gpkg_name)
-
-                #dump tiles
-                with conn_in.cursor("tiles") as cursor_tiles:
-                    cursor_tiles.execute(
-                        "SELECT id, zoom_level, tile_column, tile_row, "
-                        "tile_data FROM \"%s\"%s;" % (
-                            gpkg_name, "" if constraint is None else " WHERE "
-                            + constraint
-                        )
+                #no journal and syncs while building the file from scratch
+                if bulk and not update:
+                    conn_out.execute("PRAGMA journal_mode = OFF;")
+                    conn_out.execute("PRAGMA synchronous = OFF;")
+                    conn_out.execute(
+                        "PRAGMA cache_size = -%i;" % BULK_CACHE_SIZE
                     )
 
-                    cursor_out = conn_out.cursor()
+                #dump metadata
+                with metrics.phase("metadata"):
+                    if update:
+                        remove_metadata(conn_out, gpkg_name)
+                    copy_table(conn_in, conn_out, "gpkg_metadata_reference",
+                               "table_name = '%s'" % gpkg_name)
+                    copy_table(conn_in, conn_out, "gpkg_metadata",
+                               "id IN (SELECT md_file_id FROM "
+                               "gpkg_metadata_reference WHERE "
+                               "table_name = '%s')" % gpkg_name)
+
+                #extracts keep the zoom levels of the PostgreSQL-GeoPackage
+                #with the tile matrices spanning the aligned window of the
+                #lowest zoom level, earlier exports with other tile matrices
+                #cannot be updated
+                cursor_out = conn_out.cursor()
+                if windows is not None and not update and not native:
+                    write_tile_matrix(conn_out, gpkg_name, matrix)
+                elif windows is not None and update:
                     cursor_out.execute(
-                        "SELECT max(zoom_level) FROM gpkg_tile_matrix WHERE "
+                        "SELECT table_name, zoom_level, matrix_width, "
+                        "matrix_height FROM gpkg_tile_matrix WHERE "
+                        "table_name = ? ORDER BY zoom_level;", (gpkg_name,)
+                    )
+                    if cursor_out.fetchall() != [
+                        row[0:4] for row in matrix[0]
+                    ]:
+                        sys.stderr.write(
+                            "ERROR: Tile matrix of GeoPackage '%s' changed "
+                            "since the last export, please export it "
+                            "again.\n" % gpkg_name
+                        )
+                        sys.exit(1)
+                cursor_out.execute(
+                    "SELECT max(zoom_level) FROM gpkg_tile_matrix WHERE "
+                    "table_name = '%s';" % gpkg_name
+                )
+                zoom_offset = max_zoom_level - cursor_out.fetchone()[0]
+
+                #output zoom level and tile index offsets per zoom level,
+                #windows cover all zoom levels with tiles in the output
+                if windows is None:
+                    cursor_in.execute(
+                        "SELECT zoom_level FROM gpkg_tile_matrix WHERE "
                         "table_name = '%s';" % gpkg_name
                     )
-                    zoom_offset = max_zoom_level - cursor_out.fetchone()[0]
-                    for record in cursor_tiles:
+                    offsets = dict(
+                        (zoom[0], (zoom[0]-zoom_offset, 0, 0))
+                        for zoom in cursor_in.fetchall()
+                    )
+                    constraint = None
+                else:
+                    offsets = matrix[1]
+                    constraint = gpkg_pg_store.window_constraint(
+                        windows, gpkg_pg_store.is_morton_ordered(
+                            cursor_in, gpkg_name
+                        )
+                    )
+
+                #dump tiles, updates first remove deleted tiles and then
+                #write the tiles changed since the last export
+                source = gpkg_pg_store.tiles_source(cursor_in, gpkg_name)
+                if update:
+                    with metrics.phase("tile deletion"):
+                        delete_tiles(conn_in, conn_out, gpkg_name,
+                                     constraint, offsets, watermark)
+                    constraint = "change_txid >= %i%s" % (
+                        watermark, "" if constraint is None else
+                        " AND " + constraint
+                    )
+                    conn_out.execute(
+                        "UPDATE gpkg_contents SET last_change = "
+                        "strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE "
+                        "table_name = ?;", (gpkg_name,)
+                    )
+                where = "" if constraint is None else " WHERE " + constraint
+                if metrics.enabled:
+                    cursor_in.execute(
+                        "SELECT count(*), coalesce(sum(octet_length("
+                        "tile_data)), 0) FROM %s%s;" % (source, where)
+                    )
+                    metrics.add_total(*cursor_in.fetchone())
+                metrics.explain(
+                    cursor_in, gpkg_name, "SELECT id, zoom_level, "
+                    "tile_column, tile_row, tile_data FROM %s%s ORDER BY id;"
+                    % (source, where)
+                )
+                with metrics.phase("tile copy"):
+                    if jobs > 1:
                         try:
-                            cursor_out.execute(
-                                "INSERT INTO \"%s\" (zoom_level, tile_column, "
-                                "tile_row, tile_data) VALUES (?, ?, ?, ?);"
-                                % gpkg_name,
-                                (record[1]-zoom_offset, record[2]-srcwin[0],
-                                 record[3]-srcwin[1],
-                                 sqlite3.Binary(str(record[4])))
+                            write_tiles(
+                                sharded_tiles(conn_in, pg_connection_string,
+                                              gpkg_name, source, constraint,
+                                              jobs),
+                                conn_out, gpkg_name, offsets, update
                             )
                         except Exception as e:
                             conn_out.rollback()
                             sys.stderr.write(
-                                "ERROR: Input doesn't seem to be a valid "
-                                "GeoPackage. Error message was: '%s'.\n"
-                                % e.message
+                                "ERROR: Reading of tiles failed. Error "
+                                "message was: '%s'.\n" % e.message
                             )
                             sys.exit(1)
+                    else:
+                        dump_tiles(conn_in, conn_out, gpkg_name, source,
+                                   constraint, offsets, bulk, update)
+
+                if tracked:
+                    with metrics.phase("watermark"):
+                        write_watermark(conn_out, gpkg_name, txid,
+                                        max_zoom_level, window)
+
+                #restore safe settings for the finished file
+                if bulk and not update:
+                    conn_out.commit()
+                    conn_out.execute("PRAGMA journal_mode = DELETE;")
+                    conn_out.execute("PRAGMA synchronous = FULL;")
+
+            #only versions older than all running transactions are cached,
+            #later commits of lower transaction ids would not change them
+            if cache is not None and (version_txid is None or
+                                      version_txid < txid):
+                with metrics.phase("cache"):
+                    cache.store(gpkg_name, version, extract,
+                                "%s.gpkg" % gpkg_name)
+
+
+def dump_item(pg_connection_string, options, conn_in, gpkg_name):
+    #Batch mode task dumping one GeoPackage on the connection of the worker
+    dump_gpkg(pg_connection_string, gpkg_name, *options, conn_in=conn_in)
 
 
 def main():
@@ -282,7 +920,8 @@ def main():
         "gpkg_name",
         help="The GeoPackage name used to determine the table in which the "
         "tile data is stored as well as for the filename of the SQLite "
-        "GeoPackage to generate."
+        "GeoPackage to generate, or the manifest listing the GeoPackage "
+        "names to dump with -manifest."
     )
     parser.add_argument(
         "-srcwin", nargs=4, type=int,
@@ -291,12 +930,90 @@ def main():
         "based on tile indexes starting from 0 0 at the top left."
     )
 
+    parser.add_argument(
+        "-bulk", action="store_true",
+        help="Fetch and write the tiles in large batches with SQLite "
+        "journaling and syncing disabled until the dump is finished."
+    )
+
+    parser.add_argument(
+        "-jobs", type=int, default=1, metavar="N",
+        help="Read the tiles with N connections in parallel, each fetching "
+        "its own id ranges within the same snapshot."
+    )
+
+    parser.add_argument(
+        "-update", action="store_true",
+        help="Update an existing SQLite GeoPackage with the tiles inserted, "
+        "updated, or deleted since its last export. Uses the srcwin of the "
+        "last export unless given."
+    )
+
+    parser.add_argument(
+        "-native", action="store_true",
+        help="Create the SQLite GeoPackage with all zoom levels of the "
+        "PostgreSQL-GeoPackage directly instead of with GDAL."
+    )
+
+    parser.add_argument(
+        "-cache_dir", metavar="DIR",
+        help="Serve repeated exports of unchanged GeoPackages from the "
+        "extract cache in DIR and add new exports to it."
+    )
+
+    parser.add_argument(
+        "-cache_size", type=int, default=gpkg_pg_cache.CACHE_SIZE,
+        metavar="MB",
+        help="Maximum size of the extract cache, least recently used "
+        "extracts are evicted. Defaults to %i." % gpkg_pg_cache.CACHE_SIZE
+    )
+
+    parser.add_argument(
+        "-cache_link", action="store_true",
+        help="Hard link cached extracts instead of copying them. The "
+        "exported files must then not be modified, e.g. with -update."
+    )
+
+    gpkg_pg_metrics.add_arguments(parser)
+    gpkg_pg_batch.add_arguments(parser)
+
     args = parser.parse_args()
 
-    dump_gpkg(args.pg_connection_string, args.gpkg_name, args.srcwin)
+    if args.cache_dir is not None and args.update:
+        parser.error("-cache_dir cannot be combined with -update")
+
+    metrics.setup("gpkg-pg_dump", args.progress, args.metrics, args.profile)
+    cache = None
+    if args.cache_dir is not None:
+        cache = gpkg_pg_cache.ExtractCache(
+            args.cache_dir, args.cache_size*1048576, args.cache_link
+        )
+    options = (args.srcwin, args.bulk, args.jobs, args.update, args.native,
+               cache)
+    if args.manifest:
+        gpkg_names = gpkg_pg_batch.read_manifest(args.gpkg_name)
+        failed = gpkg_pg_batch.run_batch(
+            gpkg_names, functools.partial(
+                dump_item, args.pg_connection_string, options
+            ),
+            args.pg_connection_string, args.workers
+        )
+        metrics.finish()
+        sys.stdout.write(
+            "%i of %i GeoPackages successfully %s\n" % (
+                len(gpkg_names) - failed, len(gpkg_names),
+                "updated" if args.update else "exported"
+            )
+        )
+        sys.exit(1 if failed else 0)
+
+    dump_gpkg(args.pg_connection_string, args.gpkg_name, *options)
+    metrics.finish()
 
     sys.stdout.write(
-        "GeoPackage '%s' successfully exported\n" % args.gpkg_name
+        "GeoPackage '%s' successfully %s\n" % (
+            args.gpkg_name, "updated" if args.update else "exported"
+        )
     )
     sys.exit(0)
 
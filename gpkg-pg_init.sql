@@ -405,3 +405,122 @@ $gpkg_metadata_reference_timestamp_update$ LANGUAGE plpgsql;
 CREATE TRIGGER gpkg_metadata_reference_timestamp_update
 BEFORE UPDATE ON gpkg_metadata_reference
 FOR EACH ROW EXECUTE PROCEDURE gpkg_metadata_reference_timestamp_update();
+
+CREATE TABLE gpkg_tile_blobs (
+    tile_hash BYTEA NOT NULL PRIMARY KEY,
+    refcount BIGINT NOT NULL,
+    tile_data BYTEA NOT NULL
+);
+
+CREATE TABLE gpkg_tile_deletions (
+    table_name TEXT NOT NULL,
+    zoom_level BIGINT NOT NULL,
+    tile_column BIGINT NOT NULL,
+    tile_row BIGINT NOT NULL,
+    deleted_txid BIGINT NOT NULL,
+    PRIMARY KEY (table_name, zoom_level, tile_column, tile_row)
+);
+
+CREATE TABLE gpkg_tile_pruning (
+    table_name TEXT NOT NULL PRIMARY KEY,
+    pruned_txid BIGINT NOT NULL
+);
+
+CREATE TABLE gpkg_tile_overviews (
+    table_name TEXT NOT NULL,
+    zoom_level BIGINT NOT NULL,
+    built_txid BIGINT NOT NULL,
+    PRIMARY KEY (table_name, zoom_level)
+);
+
+CREATE TABLE gpkg_load_state (
+    table_name TEXT NOT NULL PRIMARY KEY,
+    gpkg_filename TEXT NOT NULL,
+    last_id BIGINT,
+    tiles BIGINT NOT NULL,
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+CREATE FUNCTION gpkg_tile_change() RETURNS trigger AS $gpkg_tile_change$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            INSERT INTO gpkg_tile_deletions VALUES (TG_ARGV[0], OLD.zoom_level, OLD.tile_column, OLD.tile_row, txid_current())
+            ON CONFLICT (table_name, zoom_level, tile_column, tile_row) DO UPDATE SET deleted_txid = EXCLUDED.deleted_txid;
+            RETURN OLD;
+        END IF;
+        -- NEW is only assigned in the UPDATE branch
+        IF NEW.zoom_level <> OLD.zoom_level OR NEW.tile_column <> OLD.tile_column OR NEW.tile_row <> OLD.tile_row THEN
+            INSERT INTO gpkg_tile_deletions VALUES (TG_ARGV[0], OLD.zoom_level, OLD.tile_column, OLD.tile_row, txid_current())
+            ON CONFLICT (table_name, zoom_level, tile_column, tile_row) DO UPDATE SET deleted_txid = EXCLUDED.deleted_txid;
+        END IF;
+        NEW.change_txid := txid_current();
+        RETURN NEW;
+    END;
+$gpkg_tile_change$ LANGUAGE plpgsql;
+
+-- Cache the tile matrix of the table given as trigger argument once per
+-- statement in transaction local settings named after the relation, the zoom
+-- levels between the lowest and the highest hold 'matrix_width,matrix_height'
+-- or '' if missing
+CREATE FUNCTION gpkg_tiles_matrix() RETURNS trigger AS $gpkg_tiles_matrix$
+    DECLARE
+        prefix TEXT := 'gpkg_tiles.t' || TG_RELID::text;
+        bounds RECORD;
+        matrix RECORD;
+    BEGIN
+        SELECT min(zoom_level) AS min, max(zoom_level) AS max INTO bounds FROM gpkg_tile_matrix WHERE table_name = TG_ARGV[0];
+        PERFORM set_config(prefix || '_min', coalesce(bounds.min, 0)::text, true);
+        PERFORM set_config(prefix || '_max', coalesce(bounds.max, -1)::text, true);
+        FOR matrix IN SELECT z.zoom_level, m.matrix_width || ',' || m.matrix_height AS size FROM generate_series(bounds.min, bounds.max) AS z (zoom_level) LEFT JOIN gpkg_tile_matrix m ON m.table_name = TG_ARGV[0] AND m.zoom_level = z.zoom_level LOOP
+            PERFORM set_config(prefix || '_' || matrix.zoom_level, coalesce(matrix.size, ''), true);
+        END LOOP;
+        RETURN NULL;
+    END;
+$gpkg_tiles_matrix$ LANGUAGE plpgsql;
+
+-- Check tiles against the tile matrix of the table given as trigger argument
+-- cached by gpkg_tiles_matrix() for the statement, so no row queries
+-- gpkg_tile_matrix
+CREATE FUNCTION gpkg_tiles_check() RETURNS trigger AS $gpkg_tiles_check$
+    DECLARE
+        prefix TEXT := 'gpkg_tiles.t' || TG_RELID::text;
+        matrix TEXT := '';
+    BEGIN
+        IF NEW.zoom_level BETWEEN current_setting(prefix || '_min')::bigint AND current_setting(prefix || '_max')::bigint THEN
+            matrix := current_setting(prefix || '_' || NEW.zoom_level);
+        END IF;
+        IF NEW.tile_column < 0 THEN
+            RAISE EXCEPTION '% on table ''%'' violates constraint: tile_column cannot be < 0', lower(TG_OP), TG_ARGV[0];
+        END IF;
+        IF matrix <> '' AND NOT (NEW.tile_column < split_part(matrix, ',', 1)::bigint) THEN
+            RAISE EXCEPTION '% on table ''%'' violates constraint: tile_column must by < matrix_width specified for table and zoom level in gpkg_tile_matrix', lower(TG_OP), TG_ARGV[0];
+        END IF;
+        IF NEW.tile_row < 0 THEN
+            RAISE EXCEPTION '% on table ''%'' violates constraint: tile_row cannot be < 0', lower(TG_OP), TG_ARGV[0];
+        END IF;
+        IF matrix <> '' AND NOT (NEW.tile_row < split_part(matrix, ',', 2)::bigint) THEN
+            RAISE EXCEPTION '% on table ''%'' violates constraint: tile_row must by < matrix_height specified for table and zoom level in gpkg_tile_matrix', lower(TG_OP), TG_ARGV[0];
+        END IF;
+        IF matrix = '' THEN
+            RAISE EXCEPTION '% on table ''%'' violates constraint: zoom_level not specified for table in gpkg_tile_matrix', lower(TG_OP), TG_ARGV[0];
+        END IF;
+        RETURN NEW;
+    END;
+$gpkg_tiles_check$ LANGUAGE plpgsql;
+
+-- Morton key of a tile interleaving the bits of tile column and tile row, tiles
+-- ordered by it within a zoom level are stored close to their neighbours
+CREATE FUNCTION gpkg_tile_morton(tile_column BIGINT, tile_row BIGINT) RETURNS BIGINT AS $gpkg_tile_morton$
+    DECLARE
+        masks BIGINT[] := ARRAY[281470681808895, 71777214294589695, 1085102592571150095, 3689348814741910323, 6148914691236517205];
+        shifts INTEGER[] := ARRAY[16, 8, 4, 2, 1];
+        x BIGINT := tile_column & 2147483647;
+        y BIGINT := tile_row & 2147483647;
+    BEGIN
+        FOR i IN 1..5 LOOP
+            x := (x | (x << shifts[i])) & masks[i];
+            y := (y | (y << shifts[i])) & masks[i];
+        END LOOP;
+        RETURN x | (y << 1);
+    END;
+$gpkg_tile_morton$ LANGUAGE plpgsql IMMUTABLE STRICT;
@@ -33,20 +33,42 @@
 #
 #   gpkg-pg_loadpkg.py takes a provided SQLite GeoPackage containing raster
 #   tile data only and loads it into the given PostgreSQL-GeoPackage database.
-#   This script might get a switch to make a selection of the data to be
-#   loaded, for example based on a spatial bounding box.
-#
-# Ideas for future:
-#
-#   * Add a progress indicator
+#   A selection of the data to be loaded can be made based on a spatial
+#   bounding box or a tile window.
 #
 #------------------------------------------------------------------------------
 
 import sys
 import os
+import argparse
 import sqlite3
 import datetime
+import struct
+import math
+import hashlib
+import functools
+import threading
+import contextlib
+import collections
+import multiprocessing
 import psycopg2
+import gpkg_pg_batch
+import gpkg_pg_metrics
+import gpkg_pg_store
+from gpkg_pg_metrics import metrics
+
+
+#Header and trailer of the PostgreSQL binary COPY format
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+#Size of the chunks handed to PostgreSQL during COPY
+COPY_BUFFER_SIZE = 4*1024*1024
+#Number of batches the pipeline buffer is split into
+PIPELINE_BATCHES = 8
+#Tolerance for rounding coordinates to tile indexes
+TILE_EPSILON = 1e-9
+#Default number of tiles committed per chunk of checkpointed loads
+CHECKPOINT_TILES = 10000
 
 
 def record_to_string(record):
@@ -73,7 +95,110 @@ def record_to_string(record):
     return ','.join(values)
 
 
-def copy_table(conn_in, conn_out, table_name, constraint=None):
+class TilesBuffer(object):
+    """Queue of record batches between the SQLite reader and the PostgreSQL
+    writer bounded by the size of the buffered tile data. A batch larger than
+    the whole budget is only accepted into an empty buffer.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.batches = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def put(self, batch, size):
+        with self.condition:
+            while self.batches and self.size + size > self.max_bytes and \
+                    not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return False
+            self.batches.append((batch, size))
+            self.size += size
+            self.condition.notify_all()
+            return True
+
+    def get(self):
+        with self.condition:
+            while not self.batches:
+                self.condition.wait()
+            batch, size = self.batches.popleft()
+            self.size -= size
+            self.condition.notify_all()
+            return batch
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def record_size(record):
+    return sum(len(item) for item in record if isinstance(item, buffer))
+
+
+def read_records(conn_in, query, tiles_buffer, batch_bytes, errors):
+    #Reader stage: fetch batches sized by the average tile size seen so far
+    try:
+        cursor_in = conn_in.cursor()
+        cursor_in.execute(query)
+        batch_rows = 64
+        while True:
+            batch = cursor_in.fetchmany(batch_rows)
+            if not batch:
+                break
+            size = sum(record_size(record) for record in batch)
+            if not tiles_buffer.put(batch, size):
+                return
+            batch_rows = max(1, min(
+                10000, batch_bytes * len(batch) // max(1, size)
+            ))
+    except Exception as e:
+        errors.append(e)
+    tiles_buffer.put(None, 0)
+
+
+def read_ahead(conn_in, query, buffer_size):
+    #Yield the records of query while a separate thread reads ahead from
+    #SQLite into a buffer of at most buffer_size bytes
+    tiles_buffer = TilesBuffer(buffer_size)
+    errors = []
+    reader = threading.Thread(
+        target=read_records,
+        args=(conn_in, query, tiles_buffer,
+              max(1, buffer_size // PIPELINE_BATCHES), errors)
+    )
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            batch = tiles_buffer.get()
+            if batch is None:
+                break
+            for record in batch:
+                yield record
+    finally:
+        tiles_buffer.close()
+    reader.join()
+    if errors:
+        raise errors[0]
+
+
+def upsert_clause(columns, key):
+    if not key:
+        return " ON CONFLICT DO NOTHING"
+    return " ON CONFLICT (%s) DO UPDATE SET %s" % (
+        ", ".join(key), ", ".join(
+            "\"%s\" = EXCLUDED.\"%s\"" % (column, column)
+            for column in columns if column not in key
+        )
+    )
+
+
+def copy_table(conn_in, conn_out, table_name, constraint=None,
+               pipeline=None, upsert=None, count_tiles=False, order=None):
     cursor_in = conn_in.cursor()
     #Check that table exists
     cursor_in.execute(
@@ -81,18 +206,33 @@ def copy_table(conn_in, conn_out, table_name, constraint=None):
         % table_name
     )
     if cursor_in.fetchone():
-        cursor_in.execute(
-            "SELECT * FROM \"%s\"%s;" % (table_name, "" if constraint is None
-                                         else " WHERE " + constraint)
+        query = "SELECT * FROM \"%s\"%s%s;" % (
+            table_name, "" if constraint is None else " WHERE " + constraint,
+            "" if order is None else " ORDER BY " + order
         )
+        if count_tiles:
+            metrics.explain_sqlite(cursor_in, table_name, query)
+        if pipeline is None:
+            cursor_in.execute(query)
+            records = cursor_in
+        else:
+            records = read_ahead(conn_in, query, pipeline)
+        if count_tiles:
+            records = metrics.counted(records)
+
+        conflict = ""
+        if upsert is not None:
+            conflict = upsert_clause(
+                [column[0] for column in cursor_in.description], upsert
+            )
 
         with conn_out.cursor() as cursor_out:
-            for record in cursor_in:
+            for record in records:
                 values = record_to_string(record)
                 try:
                     cursor_out.execute(
-                        "INSERT INTO \"%s\" VALUES (%s);" %
-                        (table_name, values)
+                        "INSERT INTO \"%s\" VALUES (%s)%s;" %
+                        (table_name, values, conflict)
                     )
                 except psycopg2.IntegrityError as e:
                     conn_out.rollback()
@@ -102,6 +242,11 @@ def copy_table(conn_in, conn_out, table_name, constraint=None):
                             "Error message was: '%s'.\n" % e.message
                         )
                         sys.exit(1)
+                    sys.stderr.write(
+                        "ERROR: Input doesn't seem to be a valid GeoPackage. "
+                        "Error message was: '%s'.\n" % e.message
+                    )
+                    sys.exit(1)
                 except Exception as e:
                     conn_out.rollback()
                     sys.stderr.write(
@@ -111,177 +256,1145 @@ def copy_table(conn_in, conn_out, table_name, constraint=None):
                     sys.exit(1)
 
 
-def create_tiles_table(conn_in, conn_out, cursor_out, table_name):
-   #Create GeoPackage tiles table
+def tile_to_copy(record):
+    #The four integer columns are followed by one or more bytea columns
+    values = [struct.pack('!hiqiqiqiq', len(record), 8, record[0], 8,
+                          record[1], 8, record[2], 8, record[3])]
+    for item in record[4:]:
+        if item is None:
+            values.append(struct.pack('!i', -1))
+        else:
+            item = bytes(item)
+            values.append(struct.pack('!i', len(item)))
+            values.append(item)
+    return b''.join(values)
+
+
+def hash_tiles(records):
+    #Replace tile data by its hash and keep the data only for the first
+    #occurrence of each hash
+    hashes = set()
+    for record in records:
+        tile_hash = hashlib.sha256(record[4]).digest()
+        if tile_hash in hashes:
+            yield record[0:4] + (tile_hash, None)
+        else:
+            hashes.add(tile_hash)
+            yield record[0:4] + (tile_hash, record[4])
+
+
+class TilesCopyReader(object):
+    """File-like object streaming tile records in PostgreSQL binary COPY
+    format to be used with ``cursor.copy_expert()``.
+    """
+
+    def __init__(self, records):
+        self.records = iter(records)
+        self.buffer = PGCOPY_HEADER
+        self.done = False
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while not self.done and (size < 0 or length < size):
+            try:
+                record = next(self.records)
+            except StopIteration:
+                chunks.append(PGCOPY_TRAILER)
+                length += len(PGCOPY_TRAILER)
+                self.done = True
+                break
+            chunk = tile_to_copy(record)
+            chunks.append(chunk)
+            length += len(chunk)
+        data = b''.join(chunks)
+        if size < 0 or length <= size:
+            self.buffer = b''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+
+def copy_tiles(conn_in, conn_out, table_name, constraint=None,
+               pipeline=None, dedup=False, count_tiles=False, order=None,
+               defer_blobs=False):
+    query = (
+        "SELECT id, zoom_level, tile_column, tile_row, tile_data "
+        "FROM \"%s\"%s%s;" % (table_name, "" if constraint is None
+                               else " WHERE " + constraint,
+                               "" if order is None else " ORDER BY " + order)
+    )
+    if count_tiles:
+        metrics.explain_sqlite(conn_in.cursor(), table_name, query)
+    if pipeline is None:
+        records = conn_in.cursor()
+        records.execute(query)
+    else:
+        records = read_ahead(conn_in, query, pipeline)
+    if count_tiles:
+        records = metrics.counted(records)
+
+    with conn_out.cursor() as cursor_out:
+        try:
+            if dedup:
+                copy_tiles_dedup(cursor_out, table_name, records,
+                                 defer_blobs)
+            else:
+                cursor_out.copy_expert(
+                    "COPY \"%s\" (id, zoom_level, tile_column, tile_row, "
+                    "tile_data) FROM STDIN WITH (FORMAT binary);"
+                    % table_name,
+                    TilesCopyReader(records), COPY_BUFFER_SIZE
+                )
+        except psycopg2.IntegrityError as e:
+            conn_out.rollback()
+            if e.pgcode == '23505':
+                sys.stderr.write(
+                    "ERROR: GeoPackage seems to be already imported. "
+                    "Error message was: '%s'.\n" % e.message
+                )
+                sys.exit(1)
+            sys.stderr.write(
+                "ERROR: Input doesn't seem to be a valid GeoPackage. "
+                "Error message was: '%s'.\n" % e.message
+            )
+            sys.exit(1)
+        except Exception as e:
+            conn_out.rollback()
+            sys.stderr.write(
+                "ERROR: Input doesn't seem to be a valid GeoPackage. "
+                "Error message was: '%s'.\n" % e.message
+            )
+            sys.exit(1)
+
+
+def create_staging(cursor_out):
+    cursor_out.execute(
+        "CREATE TEMPORARY TABLE IF NOT EXISTS gpkg_tile_staging ("
+        "    id BIGINT,"
+        "    zoom_level BIGINT,"
+        "    tile_column BIGINT,"
+        "    tile_row BIGINT,"
+        "    tile_hash BYTEA,"
+        "    tile_data BYTEA"
+        ") ON COMMIT DROP;"
+        "TRUNCATE gpkg_tile_staging;"
+    )
+
+
+def store_tile_blobs(cursor_out, deferred=False):
+    #Add the staged tile data to gpkg_tile_blobs and count the references,
+    #workers of parallel loads append it to the gpkg_tile_blobs table of the
+    #load schema first on their search path instead, as upserts of the same
+    #tile data by several workers block on each other until the common commit
+    blobs = (
+        "SELECT s.tile_hash, c.refcount, s.tile_data "
+        "FROM gpkg_tile_staging s JOIN (SELECT tile_hash, count(*) AS "
+        "refcount FROM gpkg_tile_staging GROUP BY tile_hash) c "
+        "ON c.tile_hash = s.tile_hash WHERE s.tile_data IS NOT NULL"
+    )
+    if deferred:
+        cursor_out.execute(
+            "INSERT INTO gpkg_tile_blobs (tile_hash, refcount, tile_data) "
+            "%s;" % blobs
+        )
+        return
+    gpkg_pg_store.add_tile_blobs(cursor_out, blobs)
+
+
+def copy_tiles_dedup(cursor_out, table_name, records, defer_blobs=False):
+    #Stage tiles with their hashes, then store each distinct tile data once
+    #in gpkg_tile_blobs and count the references to it
+    create_staging(cursor_out)
+    cursor_out.copy_expert(
+        "COPY gpkg_tile_staging FROM STDIN WITH (FORMAT binary);",
+        TilesCopyReader(hash_tiles(records)), COPY_BUFFER_SIZE
+    )
+    store_tile_blobs(cursor_out, defer_blobs)
+    cursor_out.execute(
+        "INSERT INTO \"%s\" (id, zoom_level, tile_column, tile_row, "
+        "tile_hash) SELECT id, zoom_level, tile_column, tile_row, tile_hash "
+        "FROM gpkg_tile_staging;" % table_name
+    )
+    cursor_out.execute("TRUNCATE gpkg_tile_staging;")
+
+
+def release_tile_blobs(cursor_out, table_name):
+    #Drop the references of a deduplicated tiles table to its tile data
+    if not gpkg_pg_store.is_deduplicated(cursor_out, table_name):
+        return
+    gpkg_pg_store.release_tile_blobs(
+        cursor_out, "SELECT tile_hash FROM \"%s\"" % table_name
+    )
+
+
+def create_tiles_triggers(cursor_out, table_name):
+    #Create the triggers checking tiles against gpkg_tile_matrix with the
+    #shared functions from gpkg-pg_init.sql, the tile matrix is read once per
+    #statement and the rows are checked against it
+    cursor_out.execute(
+        "CREATE TRIGGER \"%s_tiles_matrix\" BEFORE INSERT OR UPDATE ON "
+        "\"%s\" FOR EACH STATEMENT EXECUTE PROCEDURE "
+        "gpkg_tiles_matrix('%s');" % ((table_name,)*3)
+    )
+    cursor_out.execute(
+        "CREATE TRIGGER \"%s_tiles_check\" BEFORE INSERT OR UPDATE ON "
+        "\"%s\" FOR EACH ROW EXECUTE PROCEDURE gpkg_tiles_check('%s');"
+        % ((table_name,)*3)
+    )
+
+
+def validate_tiles(cursor_out, table_name):
+    #Check the rules enforced by the triggers for all tiles at once
+    cursor_out.execute(
+        "DO $$"
+        "    DECLARE"
+        "        violation TEXT;"
+        "    BEGIN"
+        "        SELECT CASE"
+        "            WHEN t.tile_column < 0 THEN "
+        "'tile_column cannot be < 0'"
+        "            WHEN NOT (t.tile_column < m.matrix_width) THEN "
+        "'tile_column must by < matrix_width specified for table and zoom "
+        "level in gpkg_tile_matrix'"
+        "            WHEN t.tile_row < 0 THEN "
+        "'tile_row cannot be < 0'"
+        "            WHEN NOT (t.tile_row < m.matrix_height) THEN "
+        "'tile_row must by < matrix_height specified for table and zoom "
+        "level in gpkg_tile_matrix'"
+        "            ELSE "
+        "'zoom_level not specified for table in gpkg_tile_matrix'"
+        "        END INTO violation"
+        "        FROM \"%s\" t LEFT JOIN gpkg_tile_matrix m ON "
+        "m.table_name = '%s' AND m.zoom_level = t.zoom_level"
+        "        WHERE m.zoom_level IS NULL OR t.tile_column < 0 OR "
+        "t.tile_column >= m.matrix_width OR t.tile_row < 0 OR "
+        "t.tile_row >= m.matrix_height"
+        "        ORDER BY t.id LIMIT 1;"
+        "        IF violation IS NOT NULL THEN"
+        "            RAISE EXCEPTION 'insert on table ''%s'' violates "
+        "constraint: %%', violation;"
+        "        END IF;"
+        "    END;"
+        "$$;" % ((table_name,)*3)
+    )
+
+
+def finish_tiles_table(cursor_out, table_name, defer_checks=False,
+                       partition=False, cluster=False):
+    #Validate loaded tiles in one go and create triggers for future changes,
+    #tiles loaded out of order are clustered
+    if defer_checks:
+        with metrics.phase("validation"):
+            validate_tiles(cursor_out, table_name)
+        if not partition:
+            with metrics.phase("trigger creation"):
+                create_tiles_triggers(cursor_out, table_name)
+    if cluster:
+        with metrics.phase("clustering"):
+            gpkg_pg_store.cluster_tiles(cursor_out, table_name)
+
+    #Adjust serial fro future inserts
+    with metrics.phase("setval"):
+        cursor_out.execute(
+            "SELECT setval(pg_get_serial_sequence('\"%s\"', 'id'), "
+            "coalesce(max(id),0) + 1, false) FROM \"%s\";"
+            % ((table_name,)*2)
+        )
+
+
+def create_tiles_relation(cursor_out, table_name, dedup=False,
+                          partition=False, morton=False):
     cursor_out.execute(
         "CREATE TABLE \"%s\" ("
-        "    id BIGSERIAL PRIMARY KEY,"
+        "    id BIGSERIAL %s,"
         "    zoom_level BIGINT NOT NULL,"
         "    tile_column BIGINT NOT NULL,"
         "    tile_row BIGINT NOT NULL,"
-        "    tile_data BYTEA NOT NULL,"
+        "    %s BYTEA NOT NULL,"
+        "    change_txid BIGINT NOT NULL DEFAULT txid_current(),"
         "    UNIQUE (zoom_level, tile_column, tile_row)"
-        ");" % table_name
+        ")%s;" % (table_name, "NOT NULL" if partition else "PRIMARY KEY",
+                  "tile_hash" if dedup else "tile_data",
+                  " PARTITION BY LIST (zoom_level)" if partition else "")
+    )
+    cursor_out.execute(
+        "CREATE INDEX \"%s_change_txid\" ON \"%s\" (change_txid);"
+        % (table_name, table_name)
     )
+    if morton:
+        gpkg_pg_store.create_morton_index(cursor_out, table_name, partition)
+
+
+def create_tiles_table(conn_in, conn_out, cursor_out, table_name,
+                       use_copy=False, defer_checks=False, load_tiles=True,
+                       pipeline=None, dedup=False, partition=False,
+                       selection=None, morton=False, matrices=None):
+   #Create GeoPackage tiles table, deduplicated tables reference their tile
+   #data in gpkg_tile_blobs, partitioned tables get a primary key per zoom
+   #level, change_txid records the last transaction writing each tile,
+   #tiles of Morton ordered tables are read from SQLite in that order
+    with metrics.phase("table creation"):
+        create_tiles_relation(cursor_out, table_name, dedup, partition,
+                              morton)
+
+    with metrics.phase("trigger creation"):
+        if partition:
+            gpkg_pg_store.create_tiles_partitions(
+                cursor_out, table_name, matrices
+            )
+        else:
+            gpkg_pg_store.create_change_trigger(
+                cursor_out, table_name, table_name
+            )
+            if not defer_checks:
+                create_tiles_triggers(cursor_out, table_name)
+
+    if not load_tiles:
+        return
+
+    #Copy content of new table
+    order = gpkg_pg_store.MORTON_ORDER if morton else None
+    with metrics.phase("tile copy"):
+        if use_copy or dedup:
+            copy_tiles(conn_in, conn_out, table_name, selection, pipeline,
+                       dedup, count_tiles=True, order=order)
+        else:
+            copy_table(conn_in, conn_out, table_name, selection, pipeline,
+                       count_tiles=True, order=order)
 
-    #Create triggers for new table
+    finish_tiles_table(cursor_out, table_name, defer_checks, partition)
+
+
+def tile_windows(conn_in, table_name, bbox=None, srcwin=None):
+    #Convert a bounding box or a tile window of the highest zoom level into
+    #tile column and row ranges per zoom level
+    cursor_in = conn_in.cursor()
+    cursor_in.execute(
+        "SELECT min_x, max_y FROM gpkg_tile_matrix_set WHERE "
+        "table_name = '%s';" % table_name
+    )
+    origin = cursor_in.fetchone()
+    cursor_in.execute(
+        "SELECT zoom_level, matrix_width, matrix_height, "
+        "tile_width*pixel_x_size, tile_height*pixel_y_size FROM "
+        "gpkg_tile_matrix WHERE table_name = '%s' ORDER BY zoom_level;"
+        % table_name
+    )
+    matrices = cursor_in.fetchall()
+    if origin is None or not matrices:
+        sys.stderr.write(
+            "ERROR: Input doesn't seem to be a valid GeoPackage. Table '%s' "
+            "has no tile matrix set or tile matrix.\n" % table_name
+        )
+        sys.exit(1)
+    origin_x, origin_y = origin
+
+    if srcwin is not None:
+        zoom_level, matrix_width, matrix_height, span_x, span_y = matrices[-1]
+        if srcwin[0] < 0 or srcwin[1] < 0 or \
+           srcwin[2] < 1 or srcwin[3] < 1 or \
+           (srcwin[0]+srcwin[2]) > matrix_width or \
+           (srcwin[1]+srcwin[3]) > matrix_height:
+            sys.stderr.write(
+                "ERROR: Invalid srcwin %s for table '%s'. First and second "
+                "values cannot be less than 0, third and forth values cannot "
+                "be less than 1, sum of first and third value cannot be more "
+                "than %s and sum of second and forth value cannot be more "
+                "than %s.\n"
+                % (srcwin, table_name, matrix_width, matrix_height)
+            )
+            sys.exit(1)
+        bbox = (
+            origin_x + srcwin[0]*span_x,
+            origin_y - (srcwin[1]+srcwin[3])*span_y,
+            origin_x + (srcwin[0]+srcwin[2])*span_x,
+            origin_y - srcwin[1]*span_y
+        )
+
+    windows = {}
+    for zoom_level, matrix_width, matrix_height, span_x, span_y in matrices:
+        windows[zoom_level] = (
+            max(0, int(math.floor(
+                (bbox[0]-origin_x)/span_x + TILE_EPSILON
+            ))),
+            min(matrix_width, int(math.ceil(
+                (bbox[2]-origin_x)/span_x - TILE_EPSILON
+            ))),
+            max(0, int(math.floor(
+                (origin_y-bbox[3])/span_y + TILE_EPSILON
+            ))),
+            min(matrix_height, int(math.ceil(
+                (origin_y-bbox[1])/span_y - TILE_EPSILON
+            )))
+        )
+    return windows
+
+
+def narrow_contents(cursor_out, table_name, windows):
+    #Shrink the bounding box in gpkg_contents to the loaded tiles of the
+    #highest zoom level, the tile matrix set keeps the tile indexes valid
+    zoom_level = max(windows)
+    window = windows[zoom_level]
+    if window[0] >= window[1] or window[2] >= window[3]:
+        return
     cursor_out.execute(
-        "CREATE FUNCTION \"%s_tile_column_insert\"() RETURNS trigger AS $$"
-        "    BEGIN"
-        "        IF NEW.tile_column < 0 THEN"
-        "            RAISE EXCEPTION 'insert on table ''%s'' violates "
-        "constraint: tile_column cannot be < 0';"
-        "        END IF;"
-        "        IF NOT (NEW.tile_column < (SELECT matrix_width FROM "
-        "gpkg_tile_matrix WHERE table_name = '%s' AND zoom_level = "
-        "NEW.zoom_level)) THEN"
-        "            RAISE EXCEPTION 'insert on table ''%s'' violates "
-        "constraint: tile_column must by < matrix_width specified for table "
-        "and zoom level in gpkg_tile_matrix';"
-        "        END IF;"
-        "        RETURN NEW;"
-        "    END;"
-        "$$ LANGUAGE plpgsql;"
-        "CREATE TRIGGER \"%s_tile_column_insert\""
-        "BEFORE INSERT ON \"%s\""
-        "FOR EACH ROW EXECUTE PROCEDURE \"%s_tile_column_insert\"();"
-        % ((table_name,)*7)
+        "UPDATE gpkg_contents con SET "
+        "min_x = greatest(con.min_x, tms.min_x + %i*ma.tile_width*"
+        "ma.pixel_x_size), "
+        "max_x = least(con.max_x, tms.min_x + %i*ma.tile_width*"
+        "ma.pixel_x_size), "
+        "max_y = least(con.max_y, tms.max_y - %i*ma.tile_height*"
+        "ma.pixel_y_size), "
+        "min_y = greatest(con.min_y, tms.max_y - %i*ma.tile_height*"
+        "ma.pixel_y_size) "
+        "FROM gpkg_tile_matrix_set tms, gpkg_tile_matrix ma WHERE "
+        "con.table_name = '%s' AND tms.table_name = con.table_name AND "
+        "ma.table_name = con.table_name AND ma.zoom_level = %i;"
+        % (window + (table_name, zoom_level))
     )
+
+
+def update_metadata(conn_in, conn_out):
+    #Insert new and update existing metadata rows, references of the loaded
+    #metadata are replaced
+    copy_table(conn_in, conn_out, "gpkg_spatial_ref_sys",
+               "srs_id NOT IN ('-1','0','4326')", upsert=())
+    copy_table(conn_in, conn_out, "gpkg_contents", "data_type = 'tiles'",
+               upsert=("table_name",))
+    copy_table(conn_in, conn_out, "gpkg_tile_matrix_set",
+               upsert=("table_name",))
+    copy_table(conn_in, conn_out, "gpkg_tile_matrix",
+               upsert=("table_name", "zoom_level"))
+    copy_table(conn_in, conn_out, "gpkg_metadata", upsert=("id",))
+
+    cursor_in = conn_in.cursor()
+    cursor_in.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND "
+        "name='gpkg_metadata';"
+    )
+    if cursor_in.fetchone():
+        cursor_in.execute("SELECT id FROM gpkg_metadata;")
+        md_ids = [md_id[0] for md_id in cursor_in.fetchall()]
+        if md_ids:
+            with conn_out.cursor() as cursor_out:
+                cursor_out.execute(
+                    "DELETE FROM gpkg_metadata_reference WHERE "
+                    "md_file_id = ANY(%s);", (md_ids,)
+                )
+    copy_table(conn_in, conn_out, "gpkg_metadata_reference")
+
+
+def update_zoom_level(conn_in, conn_out, cursor_out, table_name, zoom_level,
+                      dedup, selection=None):
+    #Compare the tiles of one zoom level by hash, stage new and changed tiles
+    #and delete tiles no longer in the GeoPackage
+    condition = "zoom_level = %i%s" % (
+        zoom_level, "" if selection is None else " AND " + selection
+    )
+    existing = {}
+    with conn_out.cursor("tile_hashes") as cursor_hashes:
+        cursor_hashes.itersize = 10000
+        cursor_hashes.execute(
+            "SELECT tile_column, tile_row, %s FROM \"%s\" WHERE %s;" % (
+                "tile_hash" if dedup else "md5(tile_data)", table_name,
+                condition
+            )
+        )
+        for tile_column, tile_row, tile_hash in cursor_hashes:
+            existing[(tile_column, tile_row)] = (
+                bytes(tile_hash) if dedup else tile_hash
+            )
+
+    def changed_tiles():
+        cursor_in = conn_in.cursor()
+        cursor_in.execute(
+            "SELECT id, zoom_level, tile_column, tile_row, tile_data FROM "
+            "\"%s\" WHERE %s;" % (table_name, condition)
+        )
+        for record in cursor_in:
+            metrics.count(1, len(record[4]))
+            if dedup:
+                tile_hash = hashlib.sha256(record[4]).digest()
+            else:
+                tile_hash = hashlib.md5(record[4]).hexdigest()
+            if existing.pop((record[2], record[3]), None) != tile_hash:
+                yield record
+
+    create_staging(cursor_out)
+    if dedup:
+        staged = hash_tiles(changed_tiles())
+    else:
+        staged = (record[0:4] + (None, record[4])
+                  for record in changed_tiles())
+    cursor_out.copy_expert(
+        "COPY gpkg_tile_staging FROM STDIN WITH (FORMAT binary);",
+        TilesCopyReader(staged), COPY_BUFFER_SIZE
+    )
+
+    if dedup:
+        #new references are counted before the replaced ones are released
+        store_tile_blobs(cursor_out)
+        gpkg_pg_store.release_tile_blobs(
+            cursor_out, "SELECT t.tile_hash FROM \"%s\" t JOIN "
+            "gpkg_tile_staging s ON s.zoom_level = t.zoom_level AND "
+            "s.tile_column = t.tile_column AND s.tile_row = t.tile_row"
+            % table_name
+        )
+    column = "tile_hash" if dedup else "tile_data"
     cursor_out.execute(
-        "CREATE FUNCTION \"%s_tile_column_update\"() RETURNS trigger AS $$"
-        "    BEGIN"
-        "        IF NEW.tile_column < 0 THEN"
-        "            RAISE EXCEPTION 'update on table ''%s'' violates "
-        "constraint: tile_column cannot be < 0';"
-        "        END IF;"
-        "        IF NOT (NEW.tile_column < (SELECT matrix_width FROM "
-        "gpkg_tile_matrix WHERE table_name = '%s' AND zoom_level = "
-        "NEW.zoom_level)) THEN"
-        "            RAISE EXCEPTION 'update on table ''%s'' violates "
-        "constraint: tile_column must by < matrix_width specified for table "
-        "and zoom level in gpkg_tile_matrix';"
-        "        END IF;"
-        "        RETURN NEW;"
-        "    END;"
-        "$$ LANGUAGE plpgsql;"
-        "CREATE TRIGGER \"%s_tile_column_update\""
-        "BEFORE UPDATE ON \"%s\""
-        "FOR EACH ROW EXECUTE PROCEDURE \"%s_tile_column_update\"();"
-        % ((table_name,)*7)
+        "INSERT INTO \"%s\" (zoom_level, tile_column, tile_row, %s) "
+        "SELECT zoom_level, tile_column, tile_row, %s FROM gpkg_tile_staging "
+        "ON CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE SET "
+        "%s = EXCLUDED.%s;" % (table_name, column, column, column, column)
     )
+    changed = cursor_out.rowcount > 0
+    cursor_out.execute("TRUNCATE gpkg_tile_staging;")
+
+    if existing:
+        tile_columns, tile_rows = zip(*existing.keys())
+        gpkg_pg_store.delete_tiles(
+            cursor_out, table_name,
+            "zoom_level = %i AND (tile_column, tile_row) IN (SELECT * FROM "
+            "unnest(%%s::BIGINT[], %%s::BIGINT[]))" % zoom_level,
+            (list(tile_columns), list(tile_rows)), dedup
+        )
+        changed = True
+    return changed
+
+
+def update_tiles_table(conn_in, conn_out, cursor_out, table_name,
+                       selection=None):
+    #Upsert new and changed tiles into an existing tiles table leaving
+    #unchanged tiles alone
     cursor_out.execute(
-        "CREATE FUNCTION \"%s_tile_row_insert\"() RETURNS trigger AS $$"
-        "    BEGIN"
-        "        IF NEW.tile_row < 0 THEN"
-        "            RAISE EXCEPTION 'insert on table ''%s'' violates "
-        "constraint: tile_row cannot be < 0';"
-        "        END IF;"
-        "        IF NOT (NEW.tile_row < (SELECT matrix_height FROM "
-        "gpkg_tile_matrix WHERE table_name = '%s' AND zoom_level = "
-        "NEW.zoom_level)) THEN"
-        "            RAISE EXCEPTION 'insert on table ''%s'' violates "
-        "constraint: tile_row must by < matrix_height specified for table and "
-        "zoom level in gpkg_tile_matrix';"
-        "        END IF;"
-        "        RETURN NEW;"
-        "    END;"
-        "$$ LANGUAGE plpgsql;"
-        "CREATE TRIGGER \"%s_tile_row_insert\""
-        "BEFORE INSERT ON \"%s\""
-        "FOR EACH ROW EXECUTE PROCEDURE \"%s_tile_row_insert\"();"
-        % ((table_name,)*7)
+        "SELECT c.relkind, EXISTS (SELECT 1 FROM pg_attribute a WHERE "
+        "a.attrelid = c.oid AND a.attname = 'tile_hash' AND "
+        "NOT a.attisdropped) FROM pg_class c WHERE c.oid = "
+        "'\"%s\"'::regclass;" % table_name
+    )
+    relkind, dedup = cursor_out.fetchone()
+    if relkind == 'p':
+        gpkg_pg_store.create_tiles_partitions(cursor_out, table_name)
+
+    cursor_in = conn_in.cursor()
+    cursor_in.execute(
+        "SELECT DISTINCT zoom_level FROM \"%s\"%s;" % (
+            table_name, "" if selection is None else " WHERE " + selection
+        )
     )
+    zoom_levels = [zoom_level[0] for zoom_level in cursor_in.fetchall()]
+    #zoom levels missing from the GeoPackage, e.g. overviews built in
+    #PostgreSQL, are left alone
+    changed = False
+    for zoom_level in zoom_levels:
+        changed = update_zoom_level(
+            conn_in, conn_out, cursor_out, table_name, zoom_level, dedup,
+            selection
+        ) or changed
+
+    if changed:
+        cursor_out.execute(
+            "UPDATE gpkg_contents SET last_change = now() WHERE "
+            "table_name = '%s';" % table_name
+        )
+    finish_tiles_table(cursor_out, table_name)
+
+
+def plan_tiles_load(conn_in, table_names, jobs, selections=None):
+    #Split the tiles tables into ranges of similar size per zoom level and
+    #tile column, restricted to the selected tiles
+    cursor_in = conn_in.cursor()
+    zoom_levels = []
+    for table_name in table_names:
+        selection = None if selections is None else selections[table_name]
+        cursor_in.execute(
+            "SELECT zoom_level, count(*) FROM \"%s\"%s GROUP BY zoom_level;"
+            % (table_name, "" if selection is None else " WHERE " + selection)
+        )
+        zoom_levels.extend(
+            (table_name, zoom_level, count)
+            for zoom_level, count in cursor_in.fetchall()
+        )
+    chunk_size = max(1, sum(zoom[2] for zoom in zoom_levels) // (jobs*4))
+
+    tasks = []
+    for table_name, zoom_level, count in zoom_levels:
+        if zoom_level is None:
+            tasks.append((table_name, "zoom_level IS NULL", count))
+            continue
+        if count <= chunk_size:
+            tasks.append((table_name, "zoom_level = %i" % zoom_level, count))
+            continue
+        selection = None if selections is None else selections[table_name]
+        cursor_in.execute(
+            "SELECT tile_column, count(*) FROM \"%s\" WHERE zoom_level = %i%s "
+            "GROUP BY tile_column ORDER BY tile_column;"
+            % (table_name, zoom_level,
+               "" if selection is None else " AND " + selection)
+        )
+        columns = cursor_in.fetchall()
+        if columns[0][0] is None:
+            tasks.append((
+                table_name, "zoom_level = %i AND tile_column IS NULL"
+                % zoom_level, columns[0][1]
+            ))
+            columns = columns[1:]
+        first_column = None
+        tiles = 0
+        for i, (tile_column, column_count) in enumerate(columns):
+            if first_column is None:
+                first_column = tile_column
+            tiles += column_count
+            if tiles >= chunk_size or i == len(columns) - 1:
+                tasks.append((
+                    table_name, "zoom_level = %i AND tile_column >= %i AND "
+                    "tile_column <= %i" % (zoom_level, first_column,
+                                           tile_column), tiles
+                ))
+                first_column = None
+                tiles = 0
+
+    #Start with the largest ranges to balance the workers
+    tasks.sort(key=lambda task: task[2], reverse=True)
+    if selections is not None:
+        tasks = [
+            (task[0], task[1] if selections[task[0]] is None else
+             "%s AND %s" % (task[1], selections[task[0]]), task[2])
+            for task in tasks
+        ]
+    return tasks
+
+
+def create_load_schema(cursor_out, dedup=False):
+    #Schema holding the tiles tables of a parallel load until they are
+    #published, named after the creating transaction, returns it with the
+    #schema the tiles tables belong to, deduplicated loads collect the tile
+    #data of all workers without unique key
     cursor_out.execute(
-        "CREATE FUNCTION \"%s_tile_row_update\"() RETURNS trigger AS $$"
-        "    BEGIN"
-        "        IF NEW.tile_row < 0 THEN"
-        "            RAISE EXCEPTION 'update on table ''%s'' violates "
-        "constraint: tile_row cannot be < 0';"
-        "        END IF;"
-        "        IF NOT (NEW.tile_row < (SELECT matrix_height FROM "
-        "gpkg_tile_matrix WHERE table_name = '%s' AND zoom_level = "
-        "NEW.zoom_level)) THEN"
-        "            RAISE EXCEPTION 'update on table ''%s'' violates "
-        "constraint: tile_row must by < matrix_height specified for table and "
-        "zoom level in gpkg_tile_matrix';"
-        "        END IF;"
-        "        RETURN NEW;"
-        "    END;"
-        "$$ LANGUAGE plpgsql;"
-        "CREATE TRIGGER \"%s_tile_row_update\""
-        "BEFORE UPDATE ON \"%s\""
-        "FOR EACH ROW EXECUTE PROCEDURE \"%s_tile_row_update\"();"
-        % ((table_name,)*7)
+        "SELECT 'gpkg_load_' || txid_current(), current_schema();"
     )
+    load_schema, schema = cursor_out.fetchone()
+    cursor_out.execute("CREATE SCHEMA \"%s\";" % load_schema)
+    if dedup:
+        cursor_out.execute(
+            "CREATE UNLOGGED TABLE \"%s\".gpkg_tile_blobs ("
+            "    tile_hash BYTEA NOT NULL,"
+            "    refcount BIGINT NOT NULL,"
+            "    tile_data BYTEA NOT NULL"
+            ");" % load_schema
+        )
+    use_load_schema(cursor_out, load_schema, True)
+    return load_schema, schema
+
+
+def use_load_schema(cursor_out, load_schema, local=False):
+    #Resolve the tiles tables in the load schema, the metadata tables and
+    #functions are still found on the search path
     cursor_out.execute(
-        "CREATE FUNCTION \"%s_zoom_insert\"() RETURNS trigger AS $$"
-        "    BEGIN"
-        "        IF NOT (NEW.zoom_level IN (SELECT zoom_level FROM "
-        "gpkg_tile_matrix WHERE table_name = '%s')) THEN"
-        "            RAISE EXCEPTION 'insert on table ''%s'' violates "
-        "constraint: zoom_level not specified for table in gpkg_tile_matrix';"
-        "        END IF;"
-        "        RETURN NEW;"
-        "    END;"
-        "$$ LANGUAGE plpgsql;"
-        "CREATE TRIGGER \"%s_zoom_insert\""
-        "BEFORE INSERT ON \"%s\""
-        "FOR EACH ROW EXECUTE PROCEDURE \"%s_zoom_insert\"();"
-        % ((table_name,)*6)
+        "SELECT set_config('search_path', %s || ', ' || "
+        "current_setting('search_path'), %s);",
+        ('"%s"' % load_schema, local)
+    )
+
+
+def publish_tile_blobs(cursor_out, load_schema):
+    #Store the tile data collected by the workers once in the shared
+    #gpkg_tile_blobs and count all of their references
+    gpkg_pg_store.add_tile_blobs(
+        cursor_out, "SELECT DISTINCT ON (tile_hash) tile_hash, "
+        "sum(refcount) OVER (PARTITION BY tile_hash), tile_data FROM "
+        "\"%s\".gpkg_tile_blobs ORDER BY tile_hash" % load_schema
     )
+    cursor_out.execute("DROP TABLE \"%s\".gpkg_tile_blobs;" % load_schema)
+
+
+def publish_load_schema(cursor_out, load_schema, schema):
+    #Move the tiles tables and their partitions out of the load schema, the
+    #indexes, constraints, triggers, and sequences move with them
     cursor_out.execute(
-        "CREATE FUNCTION \"%s_zoom_update\"() RETURNS trigger AS $$"
-        "    BEGIN"
-        "        IF NOT (NEW.zoom_level IN (SELECT zoom_level FROM "
-        "gpkg_tile_matrix WHERE table_name = '%s')) THEN"
-        "            RAISE EXCEPTION 'update on table ''%s'' violates "
-        "constraint: zoom_level not specified for table in gpkg_tile_matrix';"
-        "        END IF;"
-        "        RETURN NEW;"
-        "    END;"
-        "$$ LANGUAGE plpgsql;"
-        "CREATE TRIGGER \"%s_zoom_update\""
-        "BEFORE UPDATE ON \"%s\""
-        "FOR EACH ROW EXECUTE PROCEDURE \"%s_zoom_update\"();"
-        % ((table_name,)*6)
+        "SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = "
+        "c.relnamespace WHERE n.nspname = %s AND c.relkind IN ('r', 'p') "
+        "ORDER BY c.relname;", (load_schema,)
     )
+    for relation in [relation[0] for relation in cursor_out.fetchall()]:
+        cursor_out.execute(
+            "ALTER TABLE \"%s\".\"%s\" SET SCHEMA \"%s\";"
+            % (load_schema, relation, schema)
+        )
+    cursor_out.execute("DROP SCHEMA \"%s\";" % load_schema)
 
-    #Copy content of new table
-    copy_table(conn_in, conn_out, table_name)
 
-    #Adjust serial fro future inserts
+def load_tiles_worker(gpkg_filename, pg_connection_string, load_schema,
+                      use_copy, pipeline, dedup, tasks, next_task,
+                      loaded_tiles, abort, pipe):
+    #Load tile ranges into the tiles tables of the load schema until all are
+    #taken, then wait for the decision of the main process whether to commit
+    success = False
+    conn_in = None
+    conn_out = None
+    try:
+        conn_in = sqlite3.connect(gpkg_filename, check_same_thread=False)
+        conn_out = psycopg2.connect(pg_connection_string)
+        with conn_out.cursor() as cursor_out:
+            use_load_schema(cursor_out, load_schema)
+        while not abort.is_set():
+            with next_task.get_lock():
+                task = next_task.value
+                next_task.value += 1
+            if task >= len(tasks):
+                break
+            table_name, constraint, tiles = tasks[task]
+            if use_copy or dedup:
+                copy_tiles(conn_in, conn_out, table_name, constraint,
+                           pipeline, dedup, defer_blobs=True)
+            else:
+                copy_table(conn_in, conn_out, table_name, constraint,
+                           pipeline)
+            with loaded_tiles.get_lock():
+                loaded_tiles.value += tiles
+        success = not abort.is_set()
+    except SystemExit:
+        pass
+    except Exception as e:
+        sys.stderr.write(
+            "ERROR: Loading of tiles failed. Error message was: '%s'.\n"
+            % e.message
+        )
+
+    if conn_in is not None:
+        conn_in.close()
+    if not success:
+        abort.set()
+    pipe.send(success)
+    try:
+        commit = pipe.recv()
+    except EOFError:
+        commit = False
+    if conn_out is None:
+        return
+    try:
+        if commit:
+            conn_out.commit()
+        else:
+            conn_out.rollback()
+    except Exception as e:
+        sys.stderr.write(
+            "ERROR: Committing of tiles failed. Error message was: '%s'.\n"
+            % e.message
+        )
+        commit = False
+    finally:
+        conn_out.close()
+    pipe.send(commit)
+
+
+def remove_loaded_gpkg(pg_connection_string, load_schema):
+    #Undo a failed parallel load by dropping its load schema, the tile data
+    #of deduplicated loads was not yet counted in gpkg_tile_blobs
+    conn_out = psycopg2.connect(pg_connection_string)
+    with contextlib.closing(conn_out), conn_out, \
+            conn_out.cursor() as cursor_out:
+        cursor_out.execute(
+            "DROP SCHEMA IF EXISTS \"%s\" CASCADE;" % load_schema
+        )
+
+
+def load_tiles_parallel(conn_in, gpkg_filename, pg_connection_string,
+                        table_names, load_schema, schema, use_copy=False,
+                        jobs=2, pipeline=None, dedup=False,
+                        partition=False, windows=None, selections=None,
+                        morton=False):
+    #Load the tiles into the tiles tables committed in the load schema with
+    #one worker process per connection and publish the GeoPackage by writing
+    #its metadata and moving the tables into their schema once all workers
+    #committed, readers never see a partially loaded GeoPackage
+    tasks = plan_tiles_load(conn_in, table_names, jobs, selections)
+    next_task = multiprocessing.Value('i', 0)
+    loaded_tiles = multiprocessing.Value('d', 0)
+    abort = multiprocessing.Event()
+    workers = []
+    for i in range(max(1, min(jobs, len(tasks)))):
+        pipe, worker_pipe = multiprocessing.Pipe()
+        worker = multiprocessing.Process(
+            target=load_tiles_worker,
+            args=(gpkg_filename, pg_connection_string, load_schema,
+                  use_copy, pipeline, dedup, tasks, next_task, loaded_tiles,
+                  abort, worker_pipe)
+        )
+        worker.start()
+        workers.append((worker, pipe))
+
+    #Wait until all workers are done or one failed
+    success = True
+    pending = list(workers)
+    while pending:
+        metrics.set_count(int(loaded_tiles.value))
+        for worker, pipe in list(pending):
+            if not pipe.poll(0.1):
+                continue
+            try:
+                success = pipe.recv() and success
+            except EOFError:
+                success = False
+            if not success:
+                abort.set()
+            pending.remove((worker, pipe))
+
+    #Commit all workers or none
+    for worker, pipe in workers:
+        try:
+            pipe.send(success)
+        except IOError:
+            success = False
+    for worker, pipe in workers:
+        try:
+            success = pipe.recv() and success
+        except EOFError:
+            success = False
+        worker.join()
+
+    if success:
+        try:
+            conn_out = psycopg2.connect(pg_connection_string)
+            with contextlib.closing(conn_out), conn_out, \
+                    conn_out.cursor() as cursor_out:
+                if dedup:
+                    with metrics.phase("tile data"):
+                        publish_tile_blobs(cursor_out, load_schema)
+                use_load_schema(cursor_out, load_schema, True)
+                with metrics.phase("metadata"):
+                    copy_metadata(conn_in, conn_out)
+                for table_name in table_names:
+                    if windows is not None:
+                        narrow_contents(cursor_out, table_name,
+                                        windows[table_name])
+                    finish_tiles_table(
+                        cursor_out, table_name, True, partition, morton
+                    )
+                publish_load_schema(cursor_out, load_schema, schema)
+        except SystemExit:
+            #the metadata copy reported the error
+            success = False
+        except Exception as e:
+            #GeoPackages loaded meanwhile have the same metadata or tables
+            if getattr(e, "pgcode", None) in ('23505', '42P07'):
+                sys.stderr.write(
+                    "ERROR: GeoPackage seems to be already imported. Error "
+                    "message was: '%s'.\n" % e.message
+                )
+            else:
+                sys.stderr.write(
+                    "ERROR: Input doesn't seem to be a valid GeoPackage. "
+                    "Error message was: '%s'.\n" % e.message
+                )
+            success = False
+
+    if not success:
+        remove_loaded_gpkg(pg_connection_string, load_schema)
+        sys.exit(1)
+
+
+def copy_metadata(conn_in, conn_out):
+    copy_table(conn_in, conn_out, "gpkg_spatial_ref_sys",
+               "srs_id NOT IN ('-1','0','4326')")
+    copy_table(conn_in, conn_out, "gpkg_contents", "data_type = 'tiles'")
+    copy_table(conn_in, conn_out, "gpkg_tile_matrix_set")
+    copy_table(conn_in, conn_out, "gpkg_tile_matrix")
+    copy_table(conn_in, conn_out, "gpkg_metadata")
+    copy_table(conn_in, conn_out, "gpkg_metadata_reference")
+
+
+def tiles_tables(conn_in):
+    cursor_in = conn_in.cursor()
+    cursor_in.execute(
+        "SELECT table_name FROM gpkg_contents WHERE data_type = 'tiles';"
+    )
+    return [table_name[0] for table_name in cursor_in]
+
+
+def tile_matrices(conn_in, table_name):
+    #Zoom levels and matrix sizes of a tiles table in SQLite, e.g. for the
+    #partitions of tables loaded before the metadata
+    cursor_in = conn_in.cursor()
+    cursor_in.execute(
+        "SELECT zoom_level, matrix_width, matrix_height FROM "
+        "gpkg_tile_matrix WHERE table_name = ? ORDER BY zoom_level;",
+        (table_name,)
+    )
+    return cursor_in.fetchall()
+
+
+def check_not_loaded(conn_out, table_names):
+    #Neither the metadata nor the tiles tables may exist yet
+    with conn_out.cursor() as cursor_out:
+        cursor_out.execute(
+            "SELECT table_name FROM gpkg_contents WHERE table_name = "
+            "ANY(%s) UNION ALL SELECT relname FROM pg_class WHERE relname = "
+            "ANY(%s) AND pg_table_is_visible(oid);",
+            (table_names, table_names)
+        )
+        loaded = cursor_out.fetchone()
+    if loaded is not None:
+        sys.stderr.write(
+            "ERROR: GeoPackage seems to be already imported. Table '%s' "
+            "exists.\n" % loaded[0]
+        )
+        sys.exit(1)
+
+
+def select_tiles(conn_in, table_names, bbox=None, srcwin=None):
+    #Tile windows and SQLite constraints per tiles table, None if all tiles
+    #are loaded
+    if bbox is None and srcwin is None:
+        return None, None
+    windows = dict(
+        (table_name, tile_windows(conn_in, table_name, bbox, srcwin))
+        for table_name in table_names
+    )
+    selections = dict(
+        (table_name, gpkg_pg_store.window_constraint(windows[table_name]))
+        for table_name in table_names
+    )
+    return windows, selections
+
+
+def add_totals(conn_in, table_names, selections=None):
+    if not metrics.enabled:
+        return
+    cursor_in = conn_in.cursor()
+    for table_name in table_names:
+        cursor_in.execute(
+            "SELECT count(*), sum(length(tile_data)) FROM \"%s\"%s;" % (
+                table_name, "" if selections is None else
+                " WHERE " + selections[table_name]
+            )
+        )
+        tiles, tile_bytes = cursor_in.fetchone()
+        metrics.add_total(tiles, tile_bytes or 0)
+
+
+def load_state(cursor_out, table_names):
+    #Last loaded SQLite id and number of tiles per tiles table of interrupted
+    #checkpointed loads
     cursor_out.execute(
-        "SELECT setval(pg_get_serial_sequence('\"%s\"', 'id'), "
-        "coalesce(max(id),0) + 1, false) FROM \"%s\";" % ((table_name,)*2)
+        "SELECT table_name, last_id, tiles FROM gpkg_load_state WHERE "
+        "table_name = ANY(%s);", (table_names,)
     )
+    return dict((state[0], state[1:]) for state in cursor_out.fetchall())
+
 
+def read_gpkg_checkpointed(gpkg_filename, pg_connection_string,
+                           use_copy=False, pipeline=None, dedup=False,
+                           bbox=None, srcwin=None, morton=False,
+                           checkpoint=CHECKPOINT_TILES, resume=False,
+                           conn_out=None):
+    #Commit the tiles in chunks of SQLite ids recording the last id of each
+    #table in gpkg_load_state, the metadata making the GeoPackage visible is
+    #loaded together with the validation in the last transaction
+    connected = conn_out is None
+    if connected:
+        conn_out = psycopg2.connect(pg_connection_string)
+    with sqlite3.connect(gpkg_filename, check_same_thread=False) as conn_in:
+        conn_in.create_function(
+            "gpkg_tile_morton", 2, gpkg_pg_store.morton_key
+        )
+        table_names = tiles_tables(conn_in)
+        windows, selections = select_tiles(conn_in, table_names, bbox,
+                                           srcwin)
+        add_totals(conn_in, table_names, selections)
 
-def read_gpkg(gpkg_filename, pg_connection_string):
+        with conn_out:
+            with conn_out.cursor() as cursor_out:
+                states = load_state(cursor_out, table_names)
+                if resume and len(states) < len(table_names):
+                    sys.stderr.write(
+                        "ERROR: No interrupted load of GeoPackage '%s' to "
+                        "resume.\n" % gpkg_filename
+                    )
+                    sys.exit(1)
+                if not resume and states:
+                    sys.stderr.write(
+                        "ERROR: Load of GeoPackage '%s' was interrupted, "
+                        "continue it with -resume or drop it.\n"
+                        % gpkg_filename
+                    )
+                    sys.exit(1)
+                if not resume:
+                    with metrics.phase("table creation"):
+                        for table_name in table_names:
+                            try:
+                                create_tiles_relation(
+                                    cursor_out, table_name, dedup,
+                                    morton=morton
+                                )
+                            except psycopg2.ProgrammingError as e:
+                                if e.pgcode != '42P07':
+                                    raise
+                                sys.stderr.write(
+                                    "ERROR: GeoPackage seems to be already "
+                                    "imported. Error message was: '%s'.\n"
+                                    % e.message
+                                )
+                                sys.exit(1)
+                            gpkg_pg_store.create_change_trigger(
+                                cursor_out, table_name, table_name
+                            )
+                            cursor_out.execute(
+                                "INSERT INTO gpkg_load_state (table_name, "
+                                "gpkg_filename, last_id, tiles) VALUES (%s, "
+                                "%s, NULL, 0);", (table_name, gpkg_filename)
+                            )
+                    states = dict(
+                        (table_name, (None, 0)) for table_name in table_names
+                    )
+        metrics.count(sum(state[1] for state in states.values()))
+
+        #each chunk is committed together with its progress
+        order = gpkg_pg_store.MORTON_ORDER if morton else None
+        cursor_in = conn_in.cursor()
+        for table_name in table_names:
+            last_id = states[table_name][0]
+            while True:
+                constraints = [] if last_id is None else ["id > %i" % last_id]
+                if selections is not None:
+                    constraints.append(selections[table_name])
+                cursor_in.execute(
+                    "SELECT max(id), count(*) FROM (SELECT id FROM \"%s\"%s "
+                    "ORDER BY id LIMIT %i);" % (
+                        table_name, "" if not constraints else
+                        " WHERE " + " AND ".join(constraints), checkpoint
+                    )
+                )
+                chunk_id, tiles = cursor_in.fetchone()
+                if chunk_id is None:
+                    break
+                constraint = " AND ".join(
+                    constraints + ["id <= %i" % chunk_id]
+                )
+                with metrics.phase("tile copy"):
+                    with conn_out:
+                        if use_copy or dedup:
+                            copy_tiles(conn_in, conn_out, table_name,
+                                       constraint, pipeline, dedup,
+                                       count_tiles=True, order=order)
+                        else:
+                            copy_table(conn_in, conn_out, table_name,
+                                       constraint, pipeline,
+                                       count_tiles=True, order=order)
+                        with conn_out.cursor() as cursor_out:
+                            cursor_out.execute(
+                                "UPDATE gpkg_load_state SET last_id = %s, "
+                                "tiles = tiles + %s, updated = now() WHERE "
+                                "table_name = %s;",
+                                (chunk_id, tiles, table_name)
+                            )
+                last_id = chunk_id
+
+        #publish the GeoPackage once all tiles are loaded and valid
+        try:
+            with conn_out:
+                with metrics.phase("metadata"):
+                    copy_metadata(conn_in, conn_out)
+                with conn_out.cursor() as cursor_out:
+                    for table_name in table_names:
+                        if selections is not None:
+                            narrow_contents(cursor_out, table_name,
+                                            windows[table_name])
+                        finish_tiles_table(cursor_out, table_name, True,
+                                           cluster=morton)
+                    cursor_out.execute(
+                        "DELETE FROM gpkg_load_state WHERE table_name = "
+                        "ANY(%s);", (table_names,)
+                    )
+        except psycopg2.Error as e:
+            sys.stderr.write(
+                "ERROR: Input doesn't seem to be a valid GeoPackage. Error "
+                "message was: '%s'.\n" % e.message
+            )
+            sys.exit(1)
+    if connected:
+        conn_out.close()
+
+
+def read_gpkg(gpkg_filename, pg_connection_string, use_copy=False,
+              defer_checks=False, jobs=1, pipeline=None, dedup=False,
+              partition=False, update=False, bbox=None, srcwin=None,
+              morton=False, checkpoint=None, resume=False, conn_out=None):
+    #A given connection is reused, e.g. in batch mode, the load is committed
+    #or rolled back on it, the Morton key of the tiles is computed by SQLite
+    #for ordered loads
     if not os.path.exists(gpkg_filename):
         sys.stderr.write("ERROR: GeoPackage '%s' not found\n" % gpkg_filename)
         sys.exit(1)
+    if checkpoint is not None:
+        read_gpkg_checkpointed(
+            gpkg_filename, pg_connection_string, use_copy, pipeline, dedup,
+            bbox, srcwin, morton, checkpoint, resume, conn_out
+        )
+        return
 
-    with sqlite3.connect(gpkg_filename) as conn_in:
-        with psycopg2.connect(pg_connection_string) as conn_out:
-            copy_table(conn_in, conn_out, "gpkg_spatial_ref_sys",
-                       "srs_id NOT IN ('-1','0','4326')")
-            copy_table(conn_in, conn_out, "gpkg_contents",
-                       "data_type = 'tiles'")
-            copy_table(conn_in, conn_out, "gpkg_tile_matrix_set")
-            copy_table(conn_in, conn_out, "gpkg_tile_matrix")
-            copy_table(conn_in, conn_out, "gpkg_metadata")
-            copy_table(conn_in, conn_out, "gpkg_metadata_reference")
-
-            cursor_in = conn_in.cursor()
-            cursor_in.execute(
-                "SELECT table_name FROM gpkg_contents "
-                "WHERE data_type = 'tiles';"
-            )
+    connected = conn_out is None
+    if connected:
+        conn_out = psycopg2.connect(pg_connection_string)
+    if update:
+        jobs = 1
+    with sqlite3.connect(gpkg_filename, check_same_thread=False) as conn_in:
+        conn_in.create_function(
+            "gpkg_tile_morton", 2, gpkg_pg_store.morton_key
+        )
+        with conn_out:
+            if partition and conn_out.server_version < 110000:
+                sys.stderr.write(
+                    "ERROR: Partitioned tiles tables require PostgreSQL 11 "
+                    "or later.\n"
+                )
+                sys.exit(1)
+
+            table_names = tiles_tables(conn_in)
+            with metrics.phase("metadata"):
+                if update:
+                    update_metadata(conn_in, conn_out)
+                elif jobs > 1:
+                    #the metadata is written once all workers committed
+                    check_not_loaded(conn_out, table_names)
+                else:
+                    copy_metadata(conn_in, conn_out)
+
+            windows, selections = select_tiles(conn_in, table_names, bbox,
+                                               srcwin)
+            add_totals(conn_in, table_names, selections)
             with conn_out.cursor() as cursor_out:
-                for table_name in cursor_in:
+                if jobs > 1:
+                    #the tiles tables are created unpublished
+                    load_schema, schema = create_load_schema(cursor_out,
+                                                             dedup)
+                for table_name in table_names:
+                    selection = None
+                    if selections is not None:
+                        selection = selections[table_name]
                     try:
+                        if update:
+                            cursor_out.execute(
+                                "SELECT to_regclass('\"%s\"');" % table_name
+                            )
+                            if cursor_out.fetchone()[0] is not None:
+                                #tiles outside of the window stay, so does
+                                #the extent of the GeoPackage
+                                with metrics.phase("tile update"):
+                                    update_tiles_table(
+                                        conn_in, conn_out, cursor_out,
+                                        table_name, selection
+                                    )
+                                continue
+                        if selection is not None and jobs <= 1:
+                            narrow_contents(cursor_out, table_name,
+                                            windows[table_name])
                         create_tiles_table(
-                            conn_in, conn_out, cursor_out, table_name[0]
+                            conn_in, conn_out, cursor_out, table_name,
+                            use_copy, defer_checks or jobs > 1, jobs <= 1,
+                            pipeline, dedup, partition, selection, morton,
+                            tile_matrices(conn_in, table_name)
                         )
                     except psycopg2.IntegrityError as e:
                         conn_out.rollback()
@@ -300,21 +1413,178 @@ def read_gpkg(gpkg_filename, pg_connection_string):
                         )
                         sys.exit(1)
 
+        if jobs > 1:
+            #Tiles are loaded by the workers on their own connections
+            if connected:
+                conn_out.close()
+            with metrics.phase("tile copy"):
+                load_tiles_parallel(
+                    conn_in, gpkg_filename, pg_connection_string,
+                    table_names, load_schema, schema, use_copy, jobs,
+                    pipeline, dedup, partition, windows, selections, morton
+                )
 
-if __name__ == "__main__":
-    if len(sys.argv) <= 2:
-        sys.stderr.write(
-            "ERROR: Please provide filename of GeoPackage as well as "
-            "connection string for PostgreSQL.\n"
+
+def load_item(pg_connection_string, options, conn_out, gpkg_filename):
+    #Batch mode task loading one GeoPackage on the connection of the worker
+    read_gpkg(gpkg_filename, pg_connection_string, *options, conn_out=conn_out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="This script loads a SQLite GeoPackage into a "
+        "PostgreSQL-GeoPackage database."
+    )
+    parser.add_argument(
+        "gpkg_filename",
+        help="Filename of the SQLite GeoPackage to load, or of the manifest "
+        "listing the GeoPackages to load with -manifest."
+    )
+    parser.add_argument(
+        "pg_connection_string",
+        help="Connection string for PostgreSQL e.g. \"dbname='gpkg' "
+        "user='gpkg'\"."
+    )
+    parser.add_argument(
+        "-copy", action="store_true",
+        help="Stream the tile data using binary COPY instead of one INSERT "
+        "statement per tile."
+    )
+
+    parser.add_argument(
+        "-defer_checks", action="store_true",
+        help="Skip the per-row trigger checks while loading the tile data and "
+        "validate all tiles with a single query once the load finishes."
+    )
+
+    parser.add_argument(
+        "-jobs", type=int, default=1, metavar="N",
+        help="Load the tile data with N worker processes, each using its own "
+        "connections. The metadata is written once all workers committed, "
+        "the tiles tables are removed again if any worker fails."
+    )
+
+    parser.add_argument(
+        "-pipeline", type=int, metavar="MB",
+        help="Read the tile data from SQLite in a separate thread overlapping "
+        "with the writes to PostgreSQL, buffering at most MB megabytes of "
+        "tile data."
+    )
+
+    parser.add_argument(
+        "-dedup", action="store_true",
+        help="Store each distinct tile data only once in gpkg_tile_blobs "
+        "referenced by its SHA-256 hash. Implies -copy, cannot be combined "
+        "with -jobs."
+    )
+
+    parser.add_argument(
+        "-partition", action="store_true",
+        help="Create the tiles tables partitioned by zoom level with the "
+        "tile matrix bounds checked by constraints of the partitions. "
+        "Requires PostgreSQL 11 or later."
+    )
+
+    parser.add_argument(
+        "-morton", action="store_true",
+        help="Store the tiles of each zoom level in Morton order so windows "
+        "are read from few contiguous pages. The tiles are sorted while "
+        "reading the SQLite GeoPackage, or clustered after loading with "
+        "-jobs."
+    )
+
+    parser.add_argument(
+        "-checkpoint", type=int, nargs="?", const=CHECKPOINT_TILES,
+        metavar="TILES",
+        help="Commit the tile data in chunks of TILES tiles, %i by default, "
+        "recording the progress in gpkg_load_state. The GeoPackage is "
+        "listed in gpkg_contents only once it is completely loaded. Implies "
+        "-defer_checks." % CHECKPOINT_TILES
+    )
+
+    parser.add_argument(
+        "-resume", action="store_true",
+        help="Continue an interrupted -checkpoint load after the last "
+        "committed chunk. Use the same options as for the interrupted load."
+    )
+
+    parser.add_argument(
+        "-update", action="store_true",
+        help="Update an already imported GeoPackage. Metadata is upserted, "
+        "new and changed tiles are detected by their hashes and upserted, "
+        "and tiles no longer in the GeoPackage are deleted. Tables are "
+        "loaded serially."
+    )
+
+    parser.add_argument(
+        "-bbox", nargs=4, type=float,
+        metavar=("min_x", "min_y", "max_x", "max_y"),
+        help="Load only the tiles intersecting the bounding box given in the "
+        "coordinate reference system of the tiles tables."
+    )
+
+    parser.add_argument(
+        "-srcwin", nargs=4, type=int,
+        metavar=("xoff", "yoff", "xsize", "ysize"),
+        help="Load only the tiles within a subwindow based on tile indexes "
+        "of the highest zoom level starting from 0 0 at the top left, and "
+        "the tiles covering it in the lower zoom levels."
+    )
+
+    gpkg_pg_metrics.add_arguments(parser)
+    gpkg_pg_batch.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.manifest and args.jobs > 1:
+        parser.error("-manifest uses -workers instead of -jobs")
+    if args.resume and args.checkpoint is None:
+        args.checkpoint = CHECKPOINT_TILES
+    if args.checkpoint is not None and (args.jobs > 1 or args.update or
+                                        args.partition):
+        parser.error(
+            "-checkpoint cannot be combined with -jobs, -update, or "
+            "-partition"
         )
-        sys.exit(1)
+    if args.checkpoint is not None and args.checkpoint < 1:
+        parser.error("-checkpoint must be at least 1 tile")
+    if args.bbox is not None and args.srcwin is not None:
+        parser.error("-bbox and -srcwin cannot be combined")
+    if args.bbox is not None and (args.bbox[0] >= args.bbox[2] or
+                                  args.bbox[1] >= args.bbox[3]):
+        parser.error("-bbox minimum must be less than maximum")
 
-    gpkg_filename = sys.argv[1]
-    pg_connection_string = sys.argv[2]
+    metrics.setup("gpkg-pg_loadpkg", args.progress, args.metrics,
+                  args.profile)
+    options = (
+        args.copy, args.defer_checks, args.jobs,
+        None if args.pipeline is None else args.pipeline*1024*1024,
+        args.dedup, args.partition, args.update, args.bbox, args.srcwin,
+        args.morton, args.checkpoint, args.resume
+    )
+    if args.manifest:
+        gpkg_filenames = gpkg_pg_batch.read_manifest(args.gpkg_filename)
+        failed = gpkg_pg_batch.run_batch(
+            gpkg_filenames, functools.partial(
+                load_item, args.pg_connection_string, options
+            ),
+            args.pg_connection_string, args.workers
+        )
+        metrics.finish()
+        sys.stdout.write(
+            "%i of %i GeoPackages successfully imported\n"
+            % (len(gpkg_filenames) - failed, len(gpkg_filenames))
+        )
+        sys.exit(1 if failed else 0)
 
-    read_gpkg(gpkg_filename, pg_connection_string)
+    read_gpkg(args.gpkg_filename, args.pg_connection_string, *options)
+    metrics.finish()
 
     sys.stdout.write(
-        "GeoPackage '%s' successfully imported\n" % gpkg_filename
+        "GeoPackage '%s' successfully imported\n" % args.gpkg_filename
     )
     sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
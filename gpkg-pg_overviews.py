@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   This script builds the overviews of a PostgreSQL-GeoPackage in the
+#   database.
+#
+#   Each lower zoom level is built from the level above by a pool of worker
+#   processes decoding four child tiles, averaging them down to one parent
+#   tile, and encoding it again. Missing children, e.g. beyond the edges of
+#   the tile matrix, are transparent. Tile matrix rows of new zoom levels are
+#   added. Change tracking limits later runs to the parents of tiles
+#   inserted, updated, or deleted since the last run.
+#
+#------------------------------------------------------------------------------
+
+import sys
+import os
+import argparse
+import collections
+import multiprocessing
+import numpy
+import psycopg2
+import gpkg_pg_metrics
+import gpkg_pg_store
+from gpkg_pg_metrics import metrics
+from osgeo import gdal
+
+
+#Number of parent tiles read, built, and written per batch
+OVERVIEW_BATCH_SIZE = 256
+#Number of batches per worker built ahead of the writes
+PENDING_BATCHES = 2
+#Relative tolerance when comparing pixel sizes of zoom levels
+PIXEL_SIZE_EPSILON = 1e-9
+
+
+def init_worker():
+    gdal.UseExceptions()
+    gdal.SetConfigOption("GDAL_PAM_ENABLED", "NO")
+
+
+def decode_tile(tile_data, tile_width, tile_height):
+    #Decode tile data into a 4 x tile_height x tile_width RGBA array
+    path = "/vsimem/gpkg-pg_overviews_%i" % os.getpid()
+    gdal.FileFromMemBuffer(path, tile_data)
+    try:
+        dataset = gdal.Open(path)
+        if dataset.RasterXSize != tile_width or \
+           dataset.RasterYSize != tile_height:
+            raise ValueError(
+                "tile is %ix%i pixels instead of %ix%i" % (
+                    dataset.RasterXSize, dataset.RasterYSize, tile_width,
+                    tile_height
+                )
+            )
+        bands = [dataset.GetRasterBand(i+1)
+                 for i in range(dataset.RasterCount)]
+        color_table = bands[0].GetColorTable()
+        if color_table is not None:
+            entries = numpy.zeros((256, 4), numpy.uint8)
+            for i in range(min(color_table.GetCount(), 256)):
+                entries[i] = color_table.GetColorEntry(i)
+            return entries[bands[0].ReadAsArray()].transpose(2, 0, 1)
+        data = [band.ReadAsArray() for band in bands]
+    finally:
+        dataset = None
+        gdal.Unlink(path)
+
+    tile = numpy.empty((4, tile_height, tile_width), numpy.uint8)
+    if len(data) < 3:
+        tile[0:3] = data[0]
+    else:
+        tile[0:3] = data[0:3]
+    if len(data) in (2, 4):
+        tile[3] = data[-1]
+    else:
+        tile[3] = 255
+    return tile
+
+
+def encode_tile(tile, tile_format, quality):
+    #Encode a RGBA array as JPEG if opaque and as PNG otherwise
+    opaque = tile[3].min() == 255
+    if tile_format == "AUTO":
+        tile_format = "JPEG" if opaque else "PNG"
+    band_count = 3 if opaque or tile_format == "JPEG" else 4
+    dataset = gdal.GetDriverByName("MEM").Create(
+        "", tile.shape[2], tile.shape[1], band_count, gdal.GDT_Byte
+    )
+    for i in range(band_count):
+        dataset.GetRasterBand(i+1).WriteArray(tile[i])
+    if band_count == 4:
+        dataset.GetRasterBand(4).SetColorInterpretation(gdal.GCI_AlphaBand)
+
+    path = "/vsimem/gpkg-pg_overviews_%i.%s" % (os.getpid(), tile_format)
+    options = ["QUALITY=%i" % quality] if tile_format == "JPEG" else []
+    gdal.GetDriverByName(tile_format).CreateCopy(
+        path, dataset, options=options
+    )
+    try:
+        size = gdal.VSIStatL(path).size
+        vsi_file = gdal.VSIFOpenL(path, "rb")
+        try:
+            return gdal.VSIFReadL(1, size, vsi_file)
+        finally:
+            gdal.VSIFCloseL(vsi_file)
+    finally:
+        gdal.Unlink(path)
+
+
+def downsample(mosaic, resampling):
+    #Reduce a 2x2 tile mosaic to one tile, colors are averaged weighted by
+    #their alpha so transparent pixels do not darken the edges
+    if resampling == "nearest":
+        return mosaic[:, ::2, ::2]
+    height, width = mosaic.shape[1]//2, mosaic.shape[2]//2
+    blocks = mosaic.reshape(4, height, 2, width, 2).astype(numpy.uint32)
+    alpha = blocks[3].sum(axis=(1, 3))
+    color = (blocks[0:3]*blocks[3]).sum(axis=(2, 4))
+    tile = numpy.empty((4, height, width), numpy.uint8)
+    tile[0:3] = numpy.where(
+        alpha > 0, (color + alpha//2) // numpy.maximum(alpha, 1), 0
+    )
+    tile[3] = (alpha + 2) // 4
+    return tile
+
+
+def build_tiles(task):
+    #Worker: build a batch of parent tiles from their children, parents
+    #without any visible pixel are returned as None
+    tile_width, tile_height, tile_format, quality, resampling, parents = task
+    tiles = []
+    for key, children in parents:
+        mosaic = numpy.zeros((4, 2*tile_height, 2*tile_width), numpy.uint8)
+        try:
+            for i, tile_data in enumerate(children):
+                if tile_data is None:
+                    continue
+                top, left = (i // 2)*tile_height, (i % 2)*tile_width
+                mosaic[:, top:top+tile_height, left:left+tile_width] = \
+                    decode_tile(tile_data, tile_width, tile_height)
+            tile = downsample(mosaic, resampling)
+            if tile[3].max() == 0:
+                tiles.append((key, None))
+            else:
+                tiles.append((key, encode_tile(tile, tile_format, quality)))
+        except Exception as e:
+            raise ValueError(
+                "Cannot build tile %i/%i/%i: %s" % (key + (e,))
+            )
+    return tiles
+
+
+def read_levels(cursor_in, gpkg_name, min_zoom_level):
+    #Get the tile matrix of the highest zoom level and those of the levels
+    #to build, matrices of new levels halve the size of the level above
+    cursor_in.execute(
+        "SELECT zoom_level, matrix_width, matrix_height, tile_width, "
+        "tile_height, pixel_x_size, pixel_y_size FROM gpkg_tile_matrix "
+        "WHERE table_name = %s ORDER BY zoom_level DESC;", (gpkg_name,)
+    )
+    matrices = dict((row[0], row[1:]) for row in cursor_in.fetchall())
+    max_zoom_level = max(matrices)
+    levels = [(max_zoom_level, matrices[max_zoom_level])]
+    new_levels = []
+    for zoom_level in range(max_zoom_level-1, min_zoom_level-1, -1):
+        child = levels[-1][1]
+        matrix = matrices.get(zoom_level)
+        if matrix is None:
+            matrix = (-(-child[0]//2), -(-child[1]//2), child[2], child[3],
+                      child[4]*2, child[5]*2)
+            new_levels.append((zoom_level, matrix))
+        elif matrix[2:4] != child[2:4] or \
+                abs(matrix[4]-child[4]*2) > PIXEL_SIZE_EPSILON*matrix[4] or \
+                abs(matrix[5]-child[5]*2) > PIXEL_SIZE_EPSILON*matrix[5]:
+            sys.stderr.write(
+                "ERROR: Zoom level %i of GeoPackage '%s' does not halve the "
+                "resolution of zoom level %i.\n"
+                % (zoom_level, gpkg_name, zoom_level+1)
+            )
+            sys.exit(1)
+        levels.append((zoom_level, matrix))
+    return levels, new_levels
+
+
+def dirty_parents(cursor_in, gpkg_name, zoom_level, watermark):
+    #Parents of the tiles of the level above changed since the watermark,
+    #without watermark all parents including those of removed children
+    if watermark is None:
+        cursor_in.execute(
+            "SELECT tile_column / 2, tile_row / 2 FROM \"%s\" WHERE "
+            "zoom_level = %%s UNION SELECT tile_column, tile_row FROM "
+            "\"%s\" WHERE zoom_level = %%s ORDER BY 2, 1;"
+            % (gpkg_name, gpkg_name), (zoom_level+1, zoom_level)
+        )
+    else:
+        cursor_in.execute(
+            "SELECT tile_column / 2, tile_row / 2 FROM \"%s\" WHERE "
+            "zoom_level = %%s AND change_txid >= %%s UNION SELECT "
+            "tile_column / 2, tile_row / 2 FROM gpkg_tile_deletions WHERE "
+            "table_name = %%s AND zoom_level = %%s AND deleted_txid >= %%s "
+            "ORDER BY 2, 1;" % gpkg_name,
+            (zoom_level+1, watermark, gpkg_name, zoom_level+1, watermark)
+        )
+    return cursor_in.fetchall()
+
+
+def parent_batches(store, gpkg_name, zoom_level, matrix, parents, options):
+    #Read the children and the current tiles of each batch of parents with a
+    #single query
+    for i in range(0, len(parents), OVERVIEW_BATCH_SIZE):
+        batch = []
+        for tile_column, tile_row in parents[i:i+OVERVIEW_BATCH_SIZE]:
+            batch.append(((zoom_level, tile_column, tile_row), [
+                (zoom_level+1, tile_column*2+dx, tile_row*2+dy)
+                for dy in (0, 1) for dx in (0, 1)
+            ]))
+        tiles = store.get_tiles(
+            gpkg_name, [key for parent in batch for key in parent[1]] +
+            [key for key, keys in batch]
+        )
+        current = dict(
+            (key, tiles[key]) for key, keys in batch if key in tiles
+        )
+        yield current, matrix[2:4] + options + ([
+            (key, [tiles.get(child) for child in keys])
+            for key, keys in batch
+        ],)
+
+
+def write_tiles(store, gpkg_name, current, tiles):
+    #Write the built tiles and delete parents without visible pixels,
+    #unchanged tiles are not rewritten so their change_txid is kept
+    store.put_tiles(gpkg_name, [
+        key + (tile_data,) for key, tile_data in tiles
+        if tile_data is not None and current.get(key) != tile_data
+    ])
+    store.delete_tiles(gpkg_name, [
+        key for key, tile_data in tiles
+        if tile_data is None and key in current
+    ])
+    metrics.count(len(tiles), sum(
+        len(tile_data) for key, tile_data in tiles if tile_data is not None
+    ))
+
+
+def build_overviews(pg_connection_string, gpkg_name, min_zoom_level=0,
+                    jobs=1, tile_format="AUTO", quality=75,
+                    resampling="average", full=False):
+    with psycopg2.connect(pg_connection_string) as conn_in:
+        with conn_in.cursor() as cursor_in:
+            #Check that GeoPackage exists
+            cursor_in.execute(
+                "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);",
+                ('"%s"' % gpkg_name,)
+            )
+            relation = cursor_in.fetchone()
+            if relation is None:
+                sys.stderr.write(
+                    "ERROR: GeoPackage '%s' not found in PostgreSQL.\n" %
+                    gpkg_name
+                )
+                sys.exit(1)
+            cursor_in.execute(
+                "SELECT to_regclass('gpkg_tile_overviews') IS NOT NULL AND "
+                "EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = "
+                "to_regclass(%s) AND attname = 'change_txid' AND "
+                "NOT attisdropped);", ('"%s"' % gpkg_name,)
+            )
+            if not cursor_in.fetchone()[0]:
+                sys.stderr.write(
+                    "ERROR: GeoPackage '%s' has no change tracking. "
+                    "Please run gpkg-pg_upgrade.sql.\n" % gpkg_name
+                )
+                sys.exit(1)
+
+            with metrics.phase("metadata"):
+                levels, new_levels = read_levels(
+                    cursor_in, gpkg_name, min_zoom_level
+                )
+                cursor_in.executemany(
+                    "INSERT INTO gpkg_tile_matrix (table_name, zoom_level, "
+                    "matrix_width, matrix_height, tile_width, tile_height, "
+                    "pixel_x_size, pixel_y_size) VALUES (%s, %s, %s, %s, "
+                    "%s, %s, %s, %s);",
+                    [(gpkg_name, zoom_level) + matrix
+                     for zoom_level, matrix in new_levels]
+                )
+                if relation[0] == 'p':
+                    gpkg_pg_store.create_tiles_partitions(
+                        cursor_in, gpkg_name
+                    )
+                cursor_in.execute(
+                    "SELECT zoom_level, built_txid FROM gpkg_tile_overviews "
+                    "WHERE table_name = %s;", (gpkg_name,)
+                )
+                watermarks = {} if full else dict(cursor_in.fetchall())
+
+    #the tile matrix rows of new levels are committed before the store
+    #caches the tile matrix
+    store = gpkg_pg_store.GpkgStore(pg_connection_string, 2)
+    pool = multiprocessing.Pool(jobs, init_worker)
+    built = 0
+    try:
+        for zoom_level, matrix in levels[1:]:
+            with metrics.phase("zoom level %i" % zoom_level):
+                with conn_in.cursor() as cursor_in:
+                    #take the watermark of the level after the level above
+                    #is written and before reading any of its tiles, all
+                    #later changes have a higher transaction id
+                    cursor_in.execute(
+                        "SELECT txid_snapshot_xmin(txid_current_snapshot());"
+                    )
+                    txid = cursor_in.fetchone()[0]
+                    parents = [
+                        parent for parent in dirty_parents(
+                            cursor_in, gpkg_name, zoom_level,
+                            watermarks.get(zoom_level)
+                        ) if parent[0] < matrix[0] and parent[1] < matrix[1]
+                    ]
+                conn_in.commit()
+                metrics.add_total(len(parents))
+
+                batches = parent_batches(
+                    store, gpkg_name, zoom_level, matrix, parents,
+                    (tile_format, quality, resampling)
+                )
+                #keep the workers busy with a bounded number of batches
+                pending = collections.deque()
+                for current, batch in batches:
+                    pending.append((current, pool.apply_async(
+                        build_tiles, (batch,)
+                    )))
+                    if len(pending) >= PENDING_BATCHES*jobs:
+                        current, result = pending.popleft()
+                        write_tiles(store, gpkg_name, current, result.get())
+                while pending:
+                    current, result = pending.popleft()
+                    write_tiles(store, gpkg_name, current, result.get())
+                built += len(parents)
+
+                #later runs only rebuild parents of tiles changed after the
+                #watermark
+                with conn_in.cursor() as cursor_in:
+                    cursor_in.execute(
+                        "INSERT INTO gpkg_tile_overviews (table_name, "
+                        "zoom_level, built_txid) VALUES (%s, %s, %s) ON "
+                        "CONFLICT (table_name, zoom_level) DO UPDATE SET "
+                        "built_txid = EXCLUDED.built_txid;",
+                        (gpkg_name, zoom_level, txid)
+                    )
+                    if parents:
+                        cursor_in.execute(
+                            "UPDATE gpkg_contents SET last_change = now() "
+                            "WHERE table_name = %s;", (gpkg_name,)
+                        )
+                conn_in.commit()
+    except Exception as e:
+        sys.stderr.write(
+            "ERROR: Cannot build overviews of GeoPackage '%s'. Error message "
+            "was: '%s'.\n" % (gpkg_name, e)
+        )
+        sys.exit(1)
+    finally:
+        pool.terminate()
+        store.close()
+        conn_in.close()
+    return built
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="This script builds the overviews of a "
+        "PostgreSQL-GeoPackage from its highest zoom level in the database."
+    )
+    parser.add_argument(
+        "pg_connection_string",
+        help="Connection string for PostgreSQL e.g. \"dbname='gpkg' "
+        "user='gpkg'\"."
+    )
+    parser.add_argument(
+        "gpkg_name",
+        help="The GeoPackage name, i.e. the table in which the tile data is "
+        "stored."
+    )
+    parser.add_argument(
+        "-min_zoom", type=int, default=0, metavar="ZOOM_LEVEL",
+        help="Lowest zoom level to build. Defaults to 0."
+    )
+    parser.add_argument(
+        "-jobs", type=int, default=multiprocessing.cpu_count(), metavar="N",
+        help="Number of worker processes building tiles. Defaults to the "
+        "number of CPUs."
+    )
+    parser.add_argument(
+        "-format", dest="tile_format", default="AUTO",
+        choices=("AUTO", "PNG", "JPEG"),
+        help="Tile format, AUTO uses JPEG for opaque tiles and PNG for tiles "
+        "with transparent pixels. Defaults to AUTO."
+    )
+    parser.add_argument(
+        "-quality", type=int, default=75,
+        help="JPEG quality. Defaults to 75."
+    )
+    parser.add_argument(
+        "-resampling", default="average", choices=("average", "nearest"),
+        help="Resampling method. Defaults to average."
+    )
+    parser.add_argument(
+        "-all", dest="full", action="store_true",
+        help="Rebuild all overview tiles instead of only those whose "
+        "children changed since the last run."
+    )
+    gpkg_pg_metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.min_zoom < 0:
+        parser.error("-min_zoom cannot be less than 0")
+
+    metrics.setup(
+        "gpkg-pg_overviews", args.progress, args.metrics, args.profile
+    )
+    built = build_overviews(
+        args.pg_connection_string, args.gpkg_name, args.min_zoom, args.jobs,
+        args.tile_format, args.quality, args.resampling, args.full
+    )
+    metrics.finish()
+
+    sys.stdout.write(
+        "Built %i overview tiles of GeoPackage '%s'\n"
+        % (built, args.gpkg_name)
+    )
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
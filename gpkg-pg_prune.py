@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   This script prunes the deleted tiles tracked for incremental exports of
+#   PostgreSQL-GeoPackages in gpkg_tile_deletions.
+#
+#   Deletions older than the given transaction id are removed, but never
+#   those still needed to update the overviews or seen by running
+#   transactions. The transaction id pruned up to is recorded per table in
+#   gpkg_tile_pruning, so gpkg-pg_dump.py rejects updates of older exports.
+#
+#------------------------------------------------------------------------------
+
+import sys
+import argparse
+import contextlib
+import psycopg2
+
+
+def prune_deletions(pg_connection_string, before, gpkg_names=None):
+    #Prune the deletions of the given GeoPackages, or of all if None, in a
+    #single statement, returns the number of deletions pruned and the
+    #transaction ids pruned up to per GeoPackage
+    conn_in = psycopg2.connect(pg_connection_string)
+    with contextlib.closing(conn_in), conn_in, conn_in.cursor() as cursor_in:
+        cursor_in.execute(
+            "WITH horizons AS (SELECT d.table_name, least(%s, "
+            "txid_snapshot_xmin(txid_current_snapshot()), (SELECT "
+            "min(o.built_txid) FROM gpkg_tile_overviews o WHERE "
+            "o.table_name = d.table_name)) AS txid FROM (SELECT DISTINCT "
+            "table_name FROM gpkg_tile_deletions WHERE %s IS NULL OR "
+            "table_name = ANY(%s)) d), "
+            "pruned AS (DELETE FROM gpkg_tile_deletions d USING horizons h "
+            "WHERE d.table_name = h.table_name AND d.deleted_txid < h.txid "
+            "RETURNING d.table_name), "
+            "recorded AS (INSERT INTO gpkg_tile_pruning (table_name, "
+            "pruned_txid) SELECT table_name, txid FROM horizons ON CONFLICT "
+            "(table_name) DO UPDATE SET pruned_txid = "
+            "greatest(gpkg_tile_pruning.pruned_txid, EXCLUDED.pruned_txid) "
+            "RETURNING table_name, pruned_txid) "
+            "SELECT r.table_name, r.pruned_txid, (SELECT count(*) FROM "
+            "pruned p WHERE p.table_name = r.table_name) FROM recorded r "
+            "ORDER BY r.table_name;",
+            (before, gpkg_names, gpkg_names)
+        )
+        horizons = cursor_in.fetchall()
+    return (sum(horizon[2] for horizon in horizons),
+            [horizon[0:2] for horizon in horizons])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="This script prunes the deleted tiles tracked for "
+        "incremental exports of PostgreSQL-GeoPackages."
+    )
+    parser.add_argument(
+        "pg_connection_string",
+        help="Connection string for PostgreSQL e.g. \"dbname='gpkg' "
+        "user='gpkg'\"."
+    )
+    parser.add_argument(
+        "gpkg_names", nargs="*", metavar="gpkg_name",
+        help="The GeoPackage names whose deletions to prune, all if none "
+        "are given."
+    )
+    parser.add_argument(
+        "-before", type=int, required=True, metavar="TXID",
+        help="Prune the deletions of transactions before this transaction "
+        "id, e.g. the oldest watermark of the exports still updated with "
+        "gpkg-pg_dump.py -update."
+    )
+
+    args = parser.parse_args()
+
+    pruned, horizons = prune_deletions(
+        args.pg_connection_string, args.before, args.gpkg_names or None
+    )
+    for table_name, txid in horizons:
+        sys.stdout.write(
+            "Deletions of GeoPackage '%s' pruned before transaction %i\n"
+            % (table_name, txid)
+        )
+    sys.stdout.write("%i deletions successfully pruned\n" % pruned)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
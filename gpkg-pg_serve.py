@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   This script serves the tiles of a PostgreSQL-GeoPackage database via
+#   HTTP.
+#
+#   Tiles are requested as /<table_name>/<zoom_level>/<tile_column>/<tile_row>
+#   with tile indexes starting from 0 0 at the top left like in the
+#   GeoPackage. The tiles are read with a GpkgStore of gpkg_pg_store.py,
+#   which pools connections, prepares the tile queries once per connection,
+#   and caches the tile matrix definitions. Recently requested tiles are
+#   cached in memory.
+#
+#------------------------------------------------------------------------------
+
+import sys
+import re
+import time
+import argparse
+import hashlib
+import threading
+import collections
+import BaseHTTPServer
+import SocketServer
+import gpkg_pg_store
+
+
+TILE_PATH = re.compile(r"^/([^/]+)/(\d+)/(\d+)/(\d+)(?:\.\w+)?$")
+#Entity tag of an If-None-Match list, weak tags are prefixed by W/
+ENTITY_TAG = re.compile(r'(?:W/)?("[^"]*")')
+
+
+def tile_content_type(tile_data):
+    if tile_data[0:8] == b'\x89PNG\r\n\x1a\n':
+        return "image/png"
+    if tile_data[0:3] == b'\xff\xd8\xff':
+        return "image/jpeg"
+    if tile_data[0:4] == b'RIFF' and tile_data[8:12] == b'WEBP':
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def etag_matches(if_none_match, etag):
+    #Weak comparison of the ETag with the entity tags of If-None-Match
+    #headers as of RFC 7232, "*" matches any existing tile
+    header = ",".join(if_none_match).strip()
+    if header == "*":
+        return True
+    return etag in ENTITY_TAG.findall(header)
+
+
+class TileCache(object):
+    """Least recently used cache of tiles bounded by the total size of the
+    cached tile data. Entries expire after ttl seconds.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.tiles = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            tile = self.tiles.pop(key, None)
+            if tile is None:
+                return None
+            if tile[0] < time.time():
+                self.size -= len(tile[2])
+                return None
+            self.tiles[key] = tile
+            return tile[1:]
+
+    def put(self, key, etag, tile_data):
+        if len(tile_data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.tiles.pop(key, None)
+            if old is not None:
+                self.size -= len(old[2])
+            self.tiles[key] = (time.time() + self.ttl, etag, tile_data)
+            self.size += len(tile_data)
+            while self.size > self.max_bytes:
+                tile = self.tiles.popitem(last=False)[1]
+                self.size -= len(tile[2])
+
+
+class TileStore(object):
+    """Tiles of a GpkgStore with their ETags behind an in-memory cache."""
+
+    def __init__(self, pg_connection_string, pool_size, cache_size, ttl):
+        self.store = gpkg_pg_store.GpkgStore(
+            pg_connection_string, pool_size, ttl
+        )
+        self.cache = TileCache(cache_size, ttl)
+
+    def close(self):
+        self.store.close()
+
+    def get_tile(self, table_name, zoom_level, tile_column, tile_row):
+        key = (table_name, zoom_level, tile_column, tile_row)
+        tile = self.cache.get(key)
+        if tile is not None:
+            return tile
+
+        tile_data = self.store.get_tile(
+            table_name, zoom_level, tile_column, tile_row
+        )
+        if tile_data is None:
+            return None
+        etag = '"%s"' % hashlib.md5(tile_data).hexdigest()
+        self.cache.put(key, etag, tile_data)
+        return etag, tile_data
+
+
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_empty(self, code, etag=None):
+        self.send_response(code)
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        match = TILE_PATH.match(self.path.split("?")[0])
+        if match is None:
+            self.send_empty(404)
+            return
+        try:
+            tile = self.server.store.get_tile(
+                match.group(1), int(match.group(2)), int(match.group(3)),
+                int(match.group(4))
+            )
+        except Exception as e:
+            sys.stderr.write(
+                "ERROR: Cannot read tile '%s'. Error message was: '%s'.\n"
+                % (self.path, e)
+            )
+            self.send_empty(500)
+            return
+        if tile is None:
+            self.send_empty(404)
+            return
+
+        etag, tile_data = tile
+        if etag_matches(self.headers.getheaders("If-None-Match"), etag):
+            self.send_empty(304, etag)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", tile_content_type(tile_data))
+        self.send_header("Content-Length", str(len(tile_data)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(tile_data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args
+            )
+
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve_gpkg(pg_connection_string, host="localhost", port=8080,
+               pool_size=16, cache_size=256*1024*1024, ttl=60,
+               verbose=False):
+    try:
+        store = TileStore(pg_connection_string, pool_size, cache_size, ttl)
+    except Exception as e:
+        sys.stderr.write(
+            "ERROR: Cannot connect to PostgreSQL. Error message was: '%s'.\n"
+            % e.message
+        )
+        sys.exit(1)
+
+    server = TileServer((host, port), TileHandler)
+    server.store = store
+    server.verbose = verbose
+    sys.stdout.write("Serving tiles on http://%s:%i/\n" % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="This script serves the tiles of a PostgreSQL-GeoPackage "
+        "database via HTTP as /<table_name>/<zoom_level>/<tile_column>/"
+        "<tile_row>."
+    )
+    parser.add_argument(
+        "pg_connection_string",
+        help="Connection string for PostgreSQL e.g. \"dbname='gpkg' "
+        "user='gpkg'\"."
+    )
+    parser.add_argument(
+        "-host", default="localhost",
+        help="Address to listen on. Defaults to localhost."
+    )
+    parser.add_argument(
+        "-port", type=int, default=8080,
+        help="Port to listen on. Defaults to 8080."
+    )
+    parser.add_argument(
+        "-pool", type=int, default=16, metavar="N",
+        help="Maximum number of PostgreSQL connections. Defaults to 16."
+    )
+    parser.add_argument(
+        "-cache", type=int, default=256, metavar="MB",
+        help="Size of the in-memory tile cache in megabytes. Defaults to 256."
+    )
+    parser.add_argument(
+        "-ttl", type=int, default=60, metavar="SECONDS",
+        help="Time after which cached tiles and tile matrix definitions are "
+        "read again from PostgreSQL. Defaults to 60."
+    )
+    parser.add_argument(
+        "-v", dest="verbose", action="store_true",
+        help="Log every request."
+    )
+
+    args = parser.parse_args()
+
+    serve_gpkg(
+        args.pg_connection_string, args.host, args.port, args.pool,
+        args.cache*1024*1024, args.ttl, args.verbose
+    )
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
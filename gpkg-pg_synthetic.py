@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   This script generates a synthetic SQLite GeoPackage with raster tiles for
+#   benchmarking.
+#
+#   The tiles cover the WGS 84 geodetic tile matrix set with 2x1 tiles at
+#   zoom level 0 and doubling resolution per zoom level. Tile data are random
+#   bytes behind a PNG signature with sizes drawn from a log-normal
+#   distribution, so results are reproducible for a given seed without
+#   encoding any images.
+#
+#------------------------------------------------------------------------------
+
+import sys
+import os
+import math
+import random
+import argparse
+import binascii
+import sqlite3
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+#Size of the random bytes tile data are cut from
+RANDOM_POOL_SIZE = 8*1024*1024
+#Number of tiles written per batch
+BATCH_SIZE = 1000
+
+
+def create_tables(conn_out, table_name, zoom_levels, matrix_size,
+                  tile_size):
+    cursor_out = conn_out.cursor()
+    cursor_out.execute(
+        "CREATE TABLE gpkg_spatial_ref_sys ("
+        "    srs_name TEXT NOT NULL,"
+        "    srs_id INTEGER NOT NULL PRIMARY KEY,"
+        "    organization TEXT NOT NULL,"
+        "    organization_coordsys_id INTEGER NOT NULL,"
+        "    definition TEXT NOT NULL,"
+        "    description TEXT"
+        ");"
+    )
+    cursor_out.executemany(
+        "INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?);", [
+            ("WGS 84 geodetic", 4326, "EPSG", 4326,
+             'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,'
+             '298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG",'
+             '"6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],'
+             'UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],'
+             'AUTHORITY["EPSG","4326"]]',
+             "longitude/latitude coordinates in decimal degrees on the WGS 84 "
+             "spheroid"),
+            ("Undefined cartesian SRS", -1, "NONE", -1, "undefined",
+             "undefined cartesian coordinate reference system"),
+            ("Undefined geographic SRS", 0, "NONE", 0, "undefined",
+             "undefined geographic coordinate reference system")
+        ]
+    )
+    cursor_out.execute(
+        "CREATE TABLE gpkg_contents ("
+        "    table_name TEXT NOT NULL PRIMARY KEY,"
+        "    data_type TEXT NOT NULL,"
+        "    identifier TEXT UNIQUE,"
+        "    description TEXT DEFAULT '',"
+        "    last_change DATETIME NOT NULL DEFAULT "
+        "(strftime('%Y-%m-%dT%H:%M:%fZ','now')),"
+        "    min_x DOUBLE,"
+        "    min_y DOUBLE,"
+        "    max_x DOUBLE,"
+        "    max_y DOUBLE,"
+        "    srs_id INTEGER"
+        ");"
+    )
+    cursor_out.execute(
+        "INSERT INTO gpkg_contents (table_name, data_type, identifier, "
+        "description, min_x, min_y, max_x, max_y, srs_id) VALUES (?, 'tiles', "
+        "?, 'Synthetic tiles', -180, -90, 180, 90, 4326);",
+        (table_name, table_name)
+    )
+    cursor_out.execute(
+        "CREATE TABLE gpkg_tile_matrix_set ("
+        "    table_name TEXT NOT NULL PRIMARY KEY,"
+        "    srs_id INTEGER NOT NULL,"
+        "    min_x DOUBLE NOT NULL,"
+        "    min_y DOUBLE NOT NULL,"
+        "    max_x DOUBLE NOT NULL,"
+        "    max_y DOUBLE NOT NULL"
+        ");"
+    )
+    cursor_out.execute(
+        "INSERT INTO gpkg_tile_matrix_set VALUES (?, 4326, -180, -90, 180, "
+        "90);", (table_name,)
+    )
+    cursor_out.execute(
+        "CREATE TABLE gpkg_tile_matrix ("
+        "    table_name TEXT NOT NULL,"
+        "    zoom_level INTEGER NOT NULL,"
+        "    matrix_width INTEGER NOT NULL,"
+        "    matrix_height INTEGER NOT NULL,"
+        "    tile_width INTEGER NOT NULL,"
+        "    tile_height INTEGER NOT NULL,"
+        "    pixel_x_size DOUBLE NOT NULL,"
+        "    pixel_y_size DOUBLE NOT NULL,"
+        "    CONSTRAINT pk_ttm PRIMARY KEY (table_name, zoom_level)"
+        ");"
+    )
+    cursor_out.executemany(
+        "INSERT INTO gpkg_tile_matrix VALUES (?, ?, ?, ?, ?, ?, ?, ?);", [
+            (table_name, zoom_level, matrix_size[0] << zoom_level,
+             matrix_size[1] << zoom_level, tile_size, tile_size,
+             360.0/(tile_size*(matrix_size[0] << zoom_level)),
+             180.0/(tile_size*(matrix_size[1] << zoom_level)))
+            for zoom_level in range(zoom_levels)
+        ]
+    )
+    cursor_out.execute(
+        "CREATE TABLE \"%s\" ("
+        "    id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "    zoom_level INTEGER NOT NULL,"
+        "    tile_column INTEGER NOT NULL,"
+        "    tile_row INTEGER NOT NULL,"
+        "    tile_data BLOB NOT NULL,"
+        "    UNIQUE (zoom_level, tile_column, tile_row)"
+        ");" % table_name
+    )
+
+
+def random_tiles(zoom_levels, matrix_size, tile_bytes, tile_sigma,
+                 duplicates, seed):
+    #Yield (zoom_level, tile_column, tile_row, tile_data) in zoom level order
+    rng = random.Random(seed)
+    pool = binascii.unhexlify(
+        "%0*x" % (2*RANDOM_POOL_SIZE, rng.getrandbits(8*RANDOM_POOL_SIZE))
+    )
+    #log-normal distribution with the requested mean
+    mu = math.log(tile_bytes) - tile_sigma**2/2
+    previous = []
+    for zoom_level in range(zoom_levels):
+        for tile_row in range(matrix_size[1] << zoom_level):
+            for tile_column in range(matrix_size[0] << zoom_level):
+                if previous and rng.random() < duplicates:
+                    tile_data = rng.choice(previous)
+                else:
+                    size = int(rng.lognormvariate(mu, tile_sigma))
+                    size = max(1, min(RANDOM_POOL_SIZE, size))
+                    offset = rng.randint(0, RANDOM_POOL_SIZE-size)
+                    tile_data = PNG_SIGNATURE + pool[offset:offset+size]
+                    if len(previous) < 100:
+                        previous.append(tile_data)
+                yield (zoom_level, tile_column, tile_row,
+                       sqlite3.Binary(tile_data))
+
+
+def generate_gpkg(gpkg_filename, table_name, zoom_levels=4,
+                  matrix_size=(2, 1), tile_size=256, tile_bytes=20000,
+                  tile_sigma=0.5, duplicates=0.0, seed=0):
+    if os.path.exists(gpkg_filename):
+        sys.stderr.write(
+            "ERROR: SQLite GeoPackage '%s' already exists.\n" % gpkg_filename
+        )
+        sys.exit(1)
+
+    conn_out = sqlite3.connect(gpkg_filename)
+    #no journal and syncs while building the file from scratch
+    conn_out.execute("PRAGMA journal_mode = OFF;")
+    conn_out.execute("PRAGMA synchronous = OFF;")
+    conn_out.execute("PRAGMA application_id = 1196444487;")
+    conn_out.execute("PRAGMA user_version = 10200;")
+    with conn_out:
+        create_tables(conn_out, table_name, zoom_levels, matrix_size,
+                      tile_size)
+        tiles = random_tiles(zoom_levels, matrix_size, tile_bytes,
+                             tile_sigma, duplicates, seed)
+        cursor_out = conn_out.cursor()
+        while True:
+            batch = [tile for _, tile in zip(range(BATCH_SIZE), tiles)]
+            if not batch:
+                break
+            cursor_out.executemany(
+                "INSERT INTO \"%s\" (zoom_level, tile_column, tile_row, "
+                "tile_data) VALUES (?, ?, ?, ?);" % table_name, batch
+            )
+    conn_out.execute("PRAGMA journal_mode = DELETE;")
+    conn_out.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="This script generates a synthetic SQLite GeoPackage "
+        "with raster tiles for benchmarking."
+    )
+    parser.add_argument(
+        "gpkg_filename",
+        help="Filename of the SQLite GeoPackage to generate."
+    )
+    parser.add_argument(
+        "-table_name", default="synthetic",
+        help="Name of the tiles table. Defaults to synthetic."
+    )
+    parser.add_argument(
+        "-zoom_levels", type=int, default=4, metavar="N",
+        help="Number of zoom levels, each with four times the tiles of the "
+        "previous one. Defaults to 4."
+    )
+    parser.add_argument(
+        "-matrix", nargs=2, type=int, default=[2, 1],
+        metavar=("width", "height"),
+        help="Tile matrix size at zoom level 0. Defaults to 2 1."
+    )
+    parser.add_argument(
+        "-tile_size", type=int, default=256, metavar="PIXELS",
+        help="Tile width and height in pixels. Defaults to 256."
+    )
+    parser.add_argument(
+        "-tile_bytes", type=int, default=20000, metavar="BYTES",
+        help="Mean size of the tile data. Defaults to 20000."
+    )
+    parser.add_argument(
+        "-tile_sigma", type=float, default=0.5,
+        help="Standard deviation of the logarithm of the tile data size, 0 "
+        "gives equally sized tiles. Defaults to 0.5."
+    )
+    parser.add_argument(
+        "-duplicates", type=float, default=0.0, metavar="FRACTION",
+        help="Fraction of tiles repeating the data of an earlier tile, like "
+        "empty or ocean tiles. Defaults to 0."
+    )
+    parser.add_argument(
+        "-seed", type=int, default=0,
+        help="Seed of the random generator. Defaults to 0."
+    )
+
+    args = parser.parse_args()
+
+    if args.zoom_levels < 1 or args.matrix[0] < 1 or args.matrix[1] < 1 or \
+       args.tile_size < 1 or args.tile_bytes < 1 or args.tile_sigma < 0 or \
+       not 0 <= args.duplicates <= 1:
+        parser.error("invalid size or distribution parameters")
+
+    generate_gpkg(
+        args.gpkg_filename, args.table_name, args.zoom_levels, args.matrix,
+        args.tile_size, args.tile_bytes, args.tile_sigma, args.duplicates,
+        args.seed
+    )
+
+    sys.stdout.write(
+        "GeoPackage '%s' successfully generated\n" % args.gpkg_filename
+    )
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+-------------------------------------------------------------------------------
+--
+-- Project: PostgreSQL-GeoPackage
+-- Authors: Stephan Meissl <stephan.meissl@eox.at>
+--
+-------------------------------------------------------------------------------
+-- Copyright (c) 2016 EOX IT Services GmbH
+--
+-- Permission is hereby granted, free of charge, to any person obtaining a copy
+-- of this software and associated documentation files (the "Software"), to
+-- deal in the Software without restriction, including without limitation the
+-- rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+-- sell copies of the Software, and to permit persons to whom the Software is
+-- furnished to do so, subject to the following conditions:
+--
+-- The above copyright notice and this permission notice shall be included in
+-- all copies or substantial portions of the Software.
+--
+-- THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+-- IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+-- FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+-- AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+-- LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+-- FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+-- IN THE SOFTWARE.
+-------------------------------------------------------------------------------
+--
+-- Description:
+--
+--   SQL statements to upgrade a PostgreSQL-GeoPackage database initialized by
+--   an earlier version of gpkg-pg_init.sql. All statements can be run
+--   repeatedly.
+--
+-------------------------------------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS gpkg_tile_blobs (
+    tile_hash BYTEA NOT NULL PRIMARY KEY,
+    refcount BIGINT NOT NULL,
+    tile_data BYTEA NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS gpkg_tile_deletions (
+    table_name TEXT NOT NULL,
+    zoom_level BIGINT NOT NULL,
+    tile_column BIGINT NOT NULL,
+    tile_row BIGINT NOT NULL,
+    deleted_txid BIGINT NOT NULL,
+    PRIMARY KEY (table_name, zoom_level, tile_column, tile_row)
+);
+
+CREATE TABLE IF NOT EXISTS gpkg_tile_pruning (
+    table_name TEXT NOT NULL PRIMARY KEY,
+    pruned_txid BIGINT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS gpkg_tile_overviews (
+    table_name TEXT NOT NULL,
+    zoom_level BIGINT NOT NULL,
+    built_txid BIGINT NOT NULL,
+    PRIMARY KEY (table_name, zoom_level)
+);
+
+CREATE TABLE IF NOT EXISTS gpkg_load_state (
+    table_name TEXT NOT NULL PRIMARY KEY,
+    gpkg_filename TEXT NOT NULL,
+    last_id BIGINT,
+    tiles BIGINT NOT NULL,
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE FUNCTION gpkg_tile_change() RETURNS trigger AS $gpkg_tile_change$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            INSERT INTO gpkg_tile_deletions VALUES (TG_ARGV[0], OLD.zoom_level, OLD.tile_column, OLD.tile_row, txid_current())
+            ON CONFLICT (table_name, zoom_level, tile_column, tile_row) DO UPDATE SET deleted_txid = EXCLUDED.deleted_txid;
+            RETURN OLD;
+        END IF;
+        -- NEW is only assigned in the UPDATE branch
+        IF NEW.zoom_level <> OLD.zoom_level OR NEW.tile_column <> OLD.tile_column OR NEW.tile_row <> OLD.tile_row THEN
+            INSERT INTO gpkg_tile_deletions VALUES (TG_ARGV[0], OLD.zoom_level, OLD.tile_column, OLD.tile_row, txid_current())
+            ON CONFLICT (table_name, zoom_level, tile_column, tile_row) DO UPDATE SET deleted_txid = EXCLUDED.deleted_txid;
+        END IF;
+        NEW.change_txid := txid_current();
+        RETURN NEW;
+    END;
+$gpkg_tile_change$ LANGUAGE plpgsql;
+
+-- Add change tracking to existing tiles tables, partitioned tables get the
+-- triggers on their partitions
+DO $gpkg_tile_change_upgrade$
+    DECLARE
+        tiles_table TEXT;
+        tiles_relation TEXT;
+    BEGIN
+        FOR tiles_table IN SELECT table_name FROM gpkg_contents WHERE data_type = 'tiles' AND EXISTS (SELECT 1 FROM pg_class c WHERE c.relname = table_name AND pg_table_is_visible(c.oid)) LOOP
+            IF NOT EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = quote_ident(tiles_table)::regclass AND attname = 'change_txid' AND NOT attisdropped) THEN
+                EXECUTE format('ALTER TABLE %I ADD COLUMN change_txid BIGINT NOT NULL DEFAULT txid_current()', tiles_table);
+            END IF;
+            EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON %I (change_txid)', tiles_table || '_change_txid', tiles_table);
+            FOR tiles_relation IN SELECT c.relname FROM pg_class c WHERE c.oid = quote_ident(tiles_table)::regclass AND c.relkind = 'r' UNION ALL SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = quote_ident(tiles_table)::regclass LOOP
+                EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', tiles_relation || '_change', tiles_relation);
+                EXECUTE format('CREATE TRIGGER %I BEFORE UPDATE OR DELETE ON %I FOR EACH ROW EXECUTE PROCEDURE gpkg_tile_change(%L)', tiles_relation || '_change', tiles_relation, tiles_table);
+            END LOOP;
+        END LOOP;
+    END;
+$gpkg_tile_change_upgrade$;
+
+-- Cache the tile matrix of the table given as trigger argument once per
+-- statement in transaction local settings named after the relation, the zoom
+-- levels between the lowest and the highest hold 'matrix_width,matrix_height'
+-- or '' if missing
+CREATE OR REPLACE FUNCTION gpkg_tiles_matrix() RETURNS trigger AS $gpkg_tiles_matrix$
+    DECLARE
+        prefix TEXT := 'gpkg_tiles.t' || TG_RELID::text;
+        bounds RECORD;
+        matrix RECORD;
+    BEGIN
+        SELECT min(zoom_level) AS min, max(zoom_level) AS max INTO bounds FROM gpkg_tile_matrix WHERE table_name = TG_ARGV[0];
+        PERFORM set_config(prefix || '_min', coalesce(bounds.min, 0)::text, true);
+        PERFORM set_config(prefix || '_max', coalesce(bounds.max, -1)::text, true);
+        FOR matrix IN SELECT z.zoom_level, m.matrix_width || ',' || m.matrix_height AS size FROM generate_series(bounds.min, bounds.max) AS z (zoom_level) LEFT JOIN gpkg_tile_matrix m ON m.table_name = TG_ARGV[0] AND m.zoom_level = z.zoom_level LOOP
+            PERFORM set_config(prefix || '_' || matrix.zoom_level, coalesce(matrix.size, ''), true);
+        END LOOP;
+        RETURN NULL;
+    END;
+$gpkg_tiles_matrix$ LANGUAGE plpgsql;
+
+-- Check tiles against the tile matrix of the table given as trigger argument
+-- cached by gpkg_tiles_matrix() for the statement, so no row queries
+-- gpkg_tile_matrix
+CREATE OR REPLACE FUNCTION gpkg_tiles_check() RETURNS trigger AS $gpkg_tiles_check$
+    DECLARE
+        prefix TEXT := 'gpkg_tiles.t' || TG_RELID::text;
+        matrix TEXT := '';
+    BEGIN
+        IF NEW.zoom_level BETWEEN current_setting(prefix || '_min')::bigint AND current_setting(prefix || '_max')::bigint THEN
+            matrix := current_setting(prefix || '_' || NEW.zoom_level);
+        END IF;
+        IF NEW.tile_column < 0 THEN
+            RAISE EXCEPTION '% on table ''%'' violates constraint: tile_column cannot be < 0', lower(TG_OP), TG_ARGV[0];
+        END IF;
+        IF matrix <> '' AND NOT (NEW.tile_column < split_part(matrix, ',', 1)::bigint) THEN
+            RAISE EXCEPTION '% on table ''%'' violates constraint: tile_column must by < matrix_width specified for table and zoom level in gpkg_tile_matrix', lower(TG_OP), TG_ARGV[0];
+        END IF;
+        IF NEW.tile_row < 0 THEN
+            RAISE EXCEPTION '% on table ''%'' violates constraint: tile_row cannot be < 0', lower(TG_OP), TG_ARGV[0];
+        END IF;
+        IF matrix <> '' AND NOT (NEW.tile_row < split_part(matrix, ',', 2)::bigint) THEN
+            RAISE EXCEPTION '% on table ''%'' violates constraint: tile_row must by < matrix_height specified for table and zoom level in gpkg_tile_matrix', lower(TG_OP), TG_ARGV[0];
+        END IF;
+        IF matrix = '' THEN
+            RAISE EXCEPTION '% on table ''%'' violates constraint: zoom_level not specified for table in gpkg_tile_matrix', lower(TG_OP), TG_ARGV[0];
+        END IF;
+        RETURN NEW;
+    END;
+$gpkg_tiles_check$ LANGUAGE plpgsql;
+
+-- Morton key of a tile interleaving the bits of tile column and tile row, tiles
+-- ordered by it within a zoom level are stored close to their neighbours
+CREATE OR REPLACE FUNCTION gpkg_tile_morton(tile_column BIGINT, tile_row BIGINT) RETURNS BIGINT AS $gpkg_tile_morton$
+    DECLARE
+        masks BIGINT[] := ARRAY[281470681808895, 71777214294589695, 1085102592571150095, 3689348814741910323, 6148914691236517205];
+        shifts INTEGER[] := ARRAY[16, 8, 4, 2, 1];
+        x BIGINT := tile_column & 2147483647;
+        y BIGINT := tile_row & 2147483647;
+    BEGIN
+        FOR i IN 1..5 LOOP
+            x := (x | (x << shifts[i])) & masks[i];
+            y := (y | (y << shifts[i])) & masks[i];
+        END LOOP;
+        RETURN x | (y << 1);
+    END;
+$gpkg_tile_morton$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+-- Replace the six functions and triggers created for each tiles table by
+-- earlier versions with a trigger on the shared function, partitioned tables
+-- use check constraints instead
+DO $gpkg_tiles_check_upgrade$
+    DECLARE
+        tiles_table TEXT;
+        suffix TEXT;
+    BEGIN
+        FOR tiles_table IN SELECT table_name FROM gpkg_contents WHERE data_type = 'tiles' AND EXISTS (SELECT 1 FROM pg_class c WHERE c.relname = table_name AND pg_table_is_visible(c.oid)) LOOP
+            FOREACH suffix IN ARRAY ARRAY['_tile_column_insert', '_tile_column_update', '_tile_row_insert', '_tile_row_update', '_zoom_insert', '_zoom_update'] LOOP
+                EXECUTE format('DROP FUNCTION IF EXISTS %I() CASCADE', tiles_table || suffix);
+            END LOOP;
+            IF EXISTS (SELECT 1 FROM pg_class WHERE oid = quote_ident(tiles_table)::regclass AND relkind = 'r') THEN
+                EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', tiles_table || '_tiles_check', tiles_table);
+                EXECUTE format('CREATE TRIGGER %I BEFORE INSERT OR UPDATE ON %I FOR EACH ROW EXECUTE PROCEDURE gpkg_tiles_check(%L)', tiles_table || '_tiles_check', tiles_table, tiles_table);
+                EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', tiles_table || '_tiles_matrix', tiles_table);
+                EXECUTE format('CREATE TRIGGER %I BEFORE INSERT OR UPDATE ON %I FOR EACH STATEMENT EXECUTE PROCEDURE gpkg_tiles_matrix(%L)', tiles_table || '_tiles_matrix', tiles_table, tiles_table);
+            END IF;
+        END LOOP;
+    END;
+$gpkg_tiles_check_upgrade$;
@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   This script verifies that a SQLite GeoPackage and the
+#   PostgreSQL-GeoPackage it was loaded into or dumped from hold the same
+#   tiles and metadata.
+#
+#   Tiles are compared by count and an order independent checksum per zoom
+#   level, i.e. the sum of a hash over zoom level, tile column, tile row, and
+#   tile data of each tile. PostgreSQL computes its checksums on the server
+#   with several connections sharing a snapshot while worker processes read
+#   the SQLite GeoPackage. Zoom levels that differ are compared again per
+#   tile row to list the rows that differ.
+#
+#------------------------------------------------------------------------------
+
+import sys
+import hashlib
+import sqlite3
+import decimal
+import argparse
+import threading
+import multiprocessing
+import multiprocessing.pool
+import psycopg2
+import gpkg_pg_metrics
+import gpkg_pg_store
+from gpkg_pg_metrics import metrics
+
+
+#Checksums are sums of 64 bit hashes modulo 2^64
+CHECKSUM_MODULUS = 2**64
+#Relative tolerance when comparing numbers of the metadata tables
+NUMBER_EPSILON = 1e-9
+#Metadata compared per tiles table, last_change and timestamps differ
+METADATA_QUERIES = [
+    ("gpkg_contents",
+     "SELECT data_type, identifier, description, min_x, min_y, max_x, "
+     "max_y, srs_id FROM gpkg_contents WHERE table_name = '%s'"),
+    ("gpkg_spatial_ref_sys",
+     "SELECT srs.srs_id, srs.organization, srs.organization_coordsys_id "
+     "FROM gpkg_spatial_ref_sys srs, gpkg_contents con WHERE "
+     "con.table_name = '%s' AND srs.srs_id = con.srs_id"),
+    ("gpkg_tile_matrix_set",
+     "SELECT srs_id, min_x, min_y, max_x, max_y FROM gpkg_tile_matrix_set "
+     "WHERE table_name = '%s'"),
+    ("gpkg_tile_matrix",
+     "SELECT zoom_level, matrix_width, matrix_height, tile_width, "
+     "tile_height, pixel_x_size, pixel_y_size FROM gpkg_tile_matrix WHERE "
+     "table_name = '%s' ORDER BY zoom_level"),
+    ("gpkg_metadata",
+     "SELECT r.reference_scope, r.column_name, r.row_id_value, m.md_scope, "
+     "m.md_standard_uri, m.mime_type, m.metadata FROM "
+     "gpkg_metadata_reference r, gpkg_metadata m WHERE r.table_name = '%s' "
+     "AND m.id = r.md_file_id ORDER BY 1, 2, 3, 4, 5, 6, 7"),
+]
+
+#Thread local PostgreSQL connections of the checksum threads
+local = threading.local()
+
+
+def tile_hash(zoom_level, tile_column, tile_row, tile_data):
+    #Same hash as computed by pg_checksums
+    return int(hashlib.md5("%i/%i/%i/%s" % (
+        zoom_level, tile_column, tile_row, hashlib.md5(tile_data).hexdigest()
+    )).hexdigest()[:16], 16)
+
+
+def sqlite_checksums(task):
+    #Worker process: count and checksum of the tiles of one zoom level of
+    #the SQLite GeoPackage, per tile row if by_row
+    gpkg_filename, table_name, zoom_level, by_row = task
+    conn_in = sqlite3.connect(gpkg_filename)
+    try:
+        cursor_in = conn_in.cursor()
+        cursor_in.execute(
+            "SELECT tile_column, tile_row, tile_data FROM \"%s\" WHERE "
+            "zoom_level = ?;" % table_name, (zoom_level,)
+        )
+        checksums = {}
+        for tile_column, tile_row, tile_data in cursor_in:
+            checksum = checksums.setdefault(tile_row if by_row else 0, [0, 0])
+            checksum[0] += 1
+            checksum[1] = (checksum[1] + tile_hash(
+                zoom_level, tile_column, tile_row, tile_data
+            )) % CHECKSUM_MODULUS
+    finally:
+        conn_in.close()
+    return dict((key, tuple(value)) for key, value in checksums.items())
+
+
+def init_pg_thread(pg_connection_string, snapshot, connections):
+    local.conn = psycopg2.connect(pg_connection_string)
+    local.conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    with local.conn.cursor() as cursor_in:
+        cursor_in.execute("SET TRANSACTION SNAPSHOT '%s';" % snapshot)
+    connections.append(local.conn)
+
+
+def pg_checksums(task):
+    #Thread: count and checksum of the tiles of one zoom level computed by
+    #PostgreSQL, per tile row if by_row, the tiles are hashed with the zoom
+    #level and tile indexes they have in the SQLite GeoPackage
+    source, zoom_level, level, by_row = task
+    if zoom_level is None:
+        return {}
+    output_zoom_level, column_offset, row_offset, window = level
+    with local.conn.cursor() as cursor_in:
+        cursor_in.execute(
+            "SELECT %s, count(*), sum(('x' || substr(md5('%i/' || "
+            "(tile_column - %i) || '/' || (tile_row - %i) || '/' || "
+            "md5(tile_data)), 1, 16))::bit(64)::bigint) FROM %s WHERE "
+            "zoom_level = %%s%s GROUP BY 1;" % (
+                "tile_row - %i" % row_offset if by_row else "0",
+                output_zoom_level, column_offset, row_offset, source,
+                "" if window is None else " AND tile_column >= %i AND "
+                "tile_column < %i AND tile_row >= %i AND tile_row < %i"
+                % window
+            ), (zoom_level,)
+        )
+        return dict(
+            (row[0], (row[1], int(row[2]) % CHECKSUM_MODULUS))
+            for row in cursor_in.fetchall()
+        )
+
+
+def normalize(value):
+    #Compare numbers as floats and text as UTF-8
+    if isinstance(value, (int, long, float, decimal.Decimal)):
+        return float(value)
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def rows_equal(rows_a, rows_b):
+    if len(rows_a) != len(rows_b):
+        return False
+    for row_a, row_b in zip(rows_a, rows_b):
+        for a, b in zip(map(normalize, row_a), map(normalize, row_b)):
+            if isinstance(a, float) and isinstance(b, float):
+                if abs(a - b) > NUMBER_EPSILON*max(abs(a), abs(b)):
+                    return False
+            elif a != b:
+                return False
+    return True
+
+
+def format_ranges(values):
+    #Format sorted integers as ranges, e.g. 1-3, 7
+    ranges = []
+    for value in sorted(values):
+        if ranges and ranges[-1][1] == value - 1:
+            ranges[-1][1] = value
+        else:
+            ranges.append([value, value])
+    return ", ".join(
+        "%i" % first if first == last else "%i-%i" % (first, last)
+        for first, last in ranges
+    )
+
+
+def read_window(conn_in, table_name):
+    #Window recorded by the export of an extract, None for full exports
+    cursor_in = conn_in.cursor()
+    cursor_in.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND "
+        "name='gpkg_pg_watermark';"
+    )
+    if cursor_in.fetchone() is None:
+        return None
+    cursor_in.execute(
+        "SELECT xoff, yoff, xsize, ysize FROM gpkg_pg_watermark WHERE "
+        "table_name = ?;", (table_name,)
+    )
+    window = cursor_in.fetchone()
+    if window is None or window[0] is None:
+        return None
+    return list(window)
+
+
+def export_levels(conn_in, cursor_pg, gpkg_filename, table_name, source,
+                  srcwin=None):
+    #Zoom level, tile index origin, and tile window in the SQLite GeoPackage
+    #per zoom level of the PostgreSQL-GeoPackage as written by the dump,
+    #with the tile matrix of extracts and the zoom level offset of full
+    #exports whose zoom levels were renumbered by GDAL
+    if srcwin is None:
+        srcwin = read_window(conn_in, table_name)
+    if srcwin is not None:
+        windows = gpkg_pg_store.extract_windows(cursor_pg, table_name, srcwin)
+        matrix = gpkg_pg_store.extract_tile_matrix(cursor_pg, table_name,
+                                                   windows)
+        return dict(
+            (zoom_level, matrix[1][zoom_level] + (window,))
+            for zoom_level, window in windows.items()
+        ), matrix, 0
+
+    query = (
+        "SELECT zoom_level, matrix_width, matrix_height FROM "
+        "gpkg_tile_matrix WHERE table_name = %s ORDER BY zoom_level DESC "
+        "LIMIT 1;"
+    )
+    cursor_in = conn_in.cursor()
+    cursor_in.execute(query.replace("%s", "?"), (table_name,))
+    sqlite_matrix = cursor_in.fetchone()
+    cursor_pg.execute(query, (table_name,))
+    pg_matrix = cursor_pg.fetchone()
+    if sqlite_matrix is None or pg_matrix is None:
+        zoom_offset = 0
+    elif tuple(sqlite_matrix[1:]) != tuple(pg_matrix[1:]):
+        sys.stderr.write(
+            "ERROR: SQLite GeoPackage '%s' seems to be an extract of '%s' "
+            "without recorded window. Please give its window with "
+            "-srcwin.\n" % (gpkg_filename, table_name)
+        )
+        sys.exit(1)
+    else:
+        zoom_offset = pg_matrix[0] - sqlite_matrix[0]
+    cursor_pg.execute(
+        "SELECT DISTINCT zoom_level FROM %s UNION SELECT zoom_level FROM "
+        "gpkg_tile_matrix WHERE table_name = %%s;" % source, (table_name,)
+    )
+    return dict(
+        (row[0], (row[0]-zoom_offset, 0, 0, None))
+        for row in cursor_pg.fetchall()
+    ), None, zoom_offset
+
+
+def expected_metadata(name, pg_rows, matrix, zoom_offset):
+    #Metadata rows of the PostgreSQL-GeoPackage as written by the dump
+    if matrix is not None:
+        rows, offsets, tms_extent, contents_extent = matrix
+        if name == "gpkg_contents":
+            return [row[:3] + contents_extent + row[7:] for row in pg_rows]
+        if name == "gpkg_tile_matrix_set":
+            return [row[:1] + tms_extent for row in pg_rows]
+        if name == "gpkg_tile_matrix":
+            return [row[1:] for row in rows]
+    elif name == "gpkg_tile_matrix":
+        return [(row[0]-zoom_offset,) + row[1:] for row in pg_rows]
+    return pg_rows
+
+
+def compare_metadata(conn_in, conn_pg, table_name, matrix=None,
+                     zoom_offset=0):
+    #Return the names of the metadata tables whose rows differ, GDAL adds
+    #tile matrices of zoom levels missing in the PostgreSQL-GeoPackage to
+    #full exports with renumbered zoom levels
+    cursor_in = conn_in.cursor()
+    cursor_in.execute("SELECT name FROM sqlite_master WHERE type='table';")
+    sqlite_tables = set(row[0] for row in cursor_in.fetchall())
+    differences = []
+    with conn_pg.cursor() as cursor_pg:
+        for name, query in METADATA_QUERIES:
+            cursor_pg.execute(query % table_name + ";")
+            pg_rows = expected_metadata(name, cursor_pg.fetchall(), matrix,
+                                        zoom_offset)
+            sqlite_rows = []
+            if name in sqlite_tables and (
+                    name != "gpkg_metadata" or
+                    "gpkg_metadata_reference" in sqlite_tables):
+                cursor_in.execute(query % table_name + ";")
+                sqlite_rows = cursor_in.fetchall()
+            if name == "gpkg_tile_matrix" and zoom_offset:
+                zoom_levels = set(row[0] for row in pg_rows)
+                sqlite_rows = [
+                    row for row in sqlite_rows if row[0] in zoom_levels
+                ]
+            if not rows_equal(sqlite_rows, pg_rows):
+                differences.append(name)
+    return differences
+
+
+def verify_gpkg(gpkg_filename, pg_connection_string, jobs=1, srcwin=None):
+    #Compare all tiles tables of the SQLite GeoPackage with the
+    #PostgreSQL-GeoPackage, or with the extract of the given or recorded
+    #window, return the number of differences
+    #fork the SQLite workers before any connection is opened
+    sqlite_pool = multiprocessing.Pool(jobs)
+    conn_in = sqlite3.connect(gpkg_filename)
+    cursor_in = conn_in.cursor()
+    cursor_in.execute(
+        "SELECT table_name FROM gpkg_contents WHERE data_type = 'tiles';"
+    )
+    table_names = [row[0] for row in cursor_in.fetchall()]
+    differences = 0
+
+    with psycopg2.connect(pg_connection_string) as conn_pg:
+        conn_pg.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        with conn_pg.cursor() as cursor_pg:
+            cursor_pg.execute("SELECT pg_export_snapshot();")
+            snapshot = cursor_pg.fetchone()[0]
+        connections = []
+        pg_pool = multiprocessing.pool.ThreadPool(
+            jobs, init_pg_thread,
+            (pg_connection_string, snapshot, connections)
+        )
+        try:
+            for table_name in table_names:
+                with conn_pg.cursor() as cursor_pg:
+                    cursor_pg.execute(
+                        "SELECT to_regclass(%s);", ('"%s"' % table_name,)
+                    )
+                    if cursor_pg.fetchone()[0] is None:
+                        sys.stdout.write(
+                            "DIFF '%s': not found in PostgreSQL\n"
+                            % table_name
+                        )
+                        differences += 1
+                        continue
+                    source = gpkg_pg_store.tiles_source(cursor_pg, table_name)
+                    levels, matrix, zoom_offset = export_levels(
+                        conn_in, cursor_pg, gpkg_filename, table_name,
+                        source, srcwin
+                    )
+
+                with metrics.phase("metadata"):
+                    for name in compare_metadata(conn_in, conn_pg,
+                                                 table_name, matrix,
+                                                 zoom_offset):
+                        sys.stdout.write(
+                            "DIFF '%s': %s differs\n" % (table_name, name)
+                        )
+                        differences += 1
+
+                #zoom levels of the SQLite GeoPackage and the zoom level of
+                #the PostgreSQL-GeoPackage exported to each
+                cursor_in.execute(
+                    "SELECT DISTINCT zoom_level FROM \"%s\" UNION SELECT "
+                    "zoom_level FROM gpkg_tile_matrix WHERE table_name = ? "
+                    "ORDER BY 1;" % table_name, (table_name,)
+                )
+                pg_zoom_levels = dict(
+                    (level[0], zoom_level)
+                    for zoom_level, level in levels.items()
+                )
+                zoom_levels = sorted(
+                    set(row[0] for row in cursor_in.fetchall()) |
+                    set(pg_zoom_levels)
+                )
+
+                #both sides compute their checksums at the same time, zoom
+                #levels that differ are compared again per tile row
+                with metrics.phase("checksums"):
+                    for by_row in (False, True):
+                        sqlite_results = sqlite_pool.map_async(
+                            sqlite_checksums,
+                            [(gpkg_filename, table_name, zoom_level, by_row)
+                             for zoom_level in zoom_levels]
+                        )
+                        pg_results = pg_pool.map_async(
+                            pg_checksums,
+                            [(source, pg_zoom_levels.get(zoom_level),
+                              levels.get(pg_zoom_levels.get(zoom_level)),
+                              by_row)
+                             for zoom_level in zoom_levels]
+                        )
+                        results = zip(zoom_levels, sqlite_results.get(),
+                                      pg_results.get())
+                        if by_row:
+                            for zoom_level, sqlite_rows, pg_rows in results:
+                                rows = [
+                                    row for row in
+                                    set(sqlite_rows) | set(pg_rows)
+                                    if sqlite_rows.get(row) !=
+                                    pg_rows.get(row)
+                                ]
+                                sys.stdout.write(
+                                    "DIFF '%s' zoom level %i: tile rows %s\n"
+                                    % (table_name, zoom_level,
+                                       format_ranges(rows))
+                                )
+                            break
+
+                        differing = []
+                        for zoom_level, sqlite_level, pg_level in results:
+                            sqlite_level = sqlite_level.get(0, (0, 0))
+                            pg_level = pg_level.get(0, (0, 0))
+                            metrics.count(sqlite_level[0])
+                            if sqlite_level == pg_level:
+                                sys.stdout.write(
+                                    "OK '%s' zoom level %i: %i tiles\n"
+                                    % (table_name, zoom_level,
+                                       sqlite_level[0])
+                                )
+                            else:
+                                sys.stdout.write(
+                                    "DIFF '%s' zoom level %i: %i tiles in "
+                                    "SQLite, %i tiles in PostgreSQL\n"
+                                    % (table_name, zoom_level,
+                                       sqlite_level[0], pg_level[0])
+                                )
+                                differing.append(zoom_level)
+                        differences += len(differing)
+                        if not differing:
+                            break
+                        zoom_levels = differing
+        finally:
+            sqlite_pool.terminate()
+            pg_pool.terminate()
+            for conn in connections:
+                conn.close()
+    conn_in.close()
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="This script verifies that a SQLite GeoPackage and a "
+        "PostgreSQL-GeoPackage database hold the same tiles and metadata."
+    )
+    parser.add_argument(
+        "gpkg_filename",
+        help="Filename of the SQLite GeoPackage to verify."
+    )
+    parser.add_argument(
+        "pg_connection_string",
+        help="Connection string for PostgreSQL e.g. \"dbname='gpkg' "
+        "user='gpkg'\"."
+    )
+    parser.add_argument(
+        "-jobs", type=int, default=multiprocessing.cpu_count(), metavar="N",
+        help="Number of zoom levels checksummed in parallel on each side. "
+        "Defaults to the number of CPUs."
+    )
+    parser.add_argument(
+        "-srcwin", nargs=4, type=int,
+        metavar=("xoff", "yoff", "xsize", "ysize"),
+        help="Verify an extract dumped with this srcwin. Defaults to the "
+        "srcwin recorded by the dump of change tracked GeoPackages."
+    )
+    gpkg_pg_metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.srcwin is not None and (args.srcwin[0] < 0 or
+                                    args.srcwin[1] < 0 or
+                                    args.srcwin[2] < 1 or
+                                    args.srcwin[3] < 1):
+        parser.error("-srcwin offsets cannot be negative and sizes must be "
+                     "at least 1")
+
+    metrics.setup("gpkg-pg_verify", args.progress, args.metrics, args.profile)
+    try:
+        differences = verify_gpkg(
+            args.gpkg_filename, args.pg_connection_string, args.jobs,
+            args.srcwin
+        )
+    except (sqlite3.Error, psycopg2.Error) as e:
+        sys.stderr.write(
+            "ERROR: Cannot verify GeoPackage '%s'. Error message was: "
+            "'%s'.\n" % (args.gpkg_filename, e)
+        )
+        sys.exit(1)
+    metrics.finish()
+
+    if differences:
+        sys.stdout.write(
+            "GeoPackage '%s' differs in %i places\n"
+            % (args.gpkg_filename, differences)
+        )
+        sys.exit(1)
+    sys.stdout.write(
+        "GeoPackage '%s' successfully verified\n" % args.gpkg_filename
+    )
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
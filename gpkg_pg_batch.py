@@ -0,0 +1,134 @@
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+#
+# Description:
+#
+#   Batch mode shared by the PostgreSQL-GeoPackage scripts.
+#
+#   A manifest lists one GeoPackage per line. The GeoPackages are processed
+#   by a pool of worker processes, each reusing a single PostgreSQL
+#   connection for all of its GeoPackages. Failures are reported with the
+#   error message per GeoPackage and do not stop the remaining ones.
+#
+#------------------------------------------------------------------------------
+
+import sys
+import time
+import StringIO
+import multiprocessing
+import psycopg2
+from gpkg_pg_metrics import metrics
+
+
+#Connection string and reused connection of a worker process
+worker = {"pg_connection_string": None, "connection": None}
+
+
+def read_manifest(manifest_filename):
+    #One GeoPackage per line, blank lines and lines starting with # are
+    #skipped
+    with open(manifest_filename) as manifest:
+        return [line.strip() for line in manifest
+                if line.strip() and not line.strip().startswith("#")]
+
+
+def init_worker(pg_connection_string):
+    worker["pg_connection_string"] = pg_connection_string
+    #workers report their tiles through the batch results only
+    metrics.__init__()
+
+
+def run_item(task_item):
+    #Worker: process one GeoPackage, errors written to stderr by the task
+    #become its status
+    task, item = task_item
+    conn = worker["connection"]
+    errors = StringIO.StringIO()
+    stderr = sys.stderr
+    start = time.time()
+    tiles, tile_bytes = metrics.tiles, metrics.tile_bytes
+    error = None
+    try:
+        if conn is None or conn.closed:
+            conn = worker["connection"] = psycopg2.connect(
+                worker["pg_connection_string"]
+            )
+        sys.stderr = errors
+        task(conn, item)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            error = errors.getvalue().strip() or "exit status %s" % e.code
+    except Exception as e:
+        error = errors.getvalue().strip() or "%s: %s" % (
+            e.__class__.__name__, e
+        )
+    finally:
+        sys.stderr = stderr
+    if error is not None and conn is not None and not conn.closed:
+        conn.rollback()
+    return (item, error, time.time() - start, metrics.tiles - tiles,
+            metrics.tile_bytes - tile_bytes)
+
+
+def run_batch(items, task, pg_connection_string, workers=1):
+    #Call task(connection, item) for all items, write one status line per
+    #item to stdout and return the number of failed items
+    pool = multiprocessing.Pool(
+        workers, init_worker, (pg_connection_string,)
+    )
+    failed = 0
+    try:
+        for item, error, seconds, tiles, tile_bytes in pool.imap_unordered(
+                run_item, [(task, item) for item in items]):
+            metrics.count(tiles, tile_bytes)
+            metrics.clear_line()
+            if error is None:
+                sys.stdout.write("OK %s %.3f s\n" % (item, seconds))
+            else:
+                failed += 1
+                sys.stdout.write("FAILED %s %.3f s %s\n" % (
+                    item, seconds, " ".join(error.split())
+                ))
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "-manifest", action="store_true",
+        help="Read the GeoPackages to process from the given file with one "
+        "GeoPackage per line instead of processing a single one."
+    )
+    parser.add_argument(
+        "-workers", type=int, default=1, metavar="N",
+        help="Number of GeoPackages processed concurrently with -manifest, "
+        "each worker reusing its PostgreSQL connection. Defaults to 1."
+    )
@@ -0,0 +1,173 @@
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+#
+# Description:
+#
+#   Cache of SQLite GeoPackages exported by gpkg-pg_dump.py.
+#
+#   Entries are keyed by the GeoPackage name, the extract, i.e. window, zoom
+#   range, and writer, and a data version of the PostgreSQL-GeoPackage. The
+#   version changes whenever tiles or metadata change or the GeoPackage is
+#   loaded again. Entries of other versions are removed when the GeoPackage
+#   is looked up or dropped, and the least recently used entries are evicted
+#   once the cache exceeds its size.
+#
+#------------------------------------------------------------------------------
+
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+
+
+#Default maximum size of the cache in MB
+CACHE_SIZE = 10240
+#Size of the chunks copied from and to the cache
+COPY_BUFFER_SIZE = 4*1024*1024
+
+
+def digest(value):
+    return hashlib.sha1(repr(value)).hexdigest()
+
+
+def data_version(cursor, table_name):
+    #Digest of the tile changes and metadata of a tracked tiles table, and
+    #the highest transaction id it covers
+    cursor.execute(
+        "SELECT to_regclass(%(relation)s)::oid, (SELECT max(change_txid) "
+        "FROM \"" + table_name + "\"), (SELECT max(deleted_txid) FROM "
+        "gpkg_tile_deletions WHERE table_name = %(name)s), (SELECT "
+        "md5(c::text) || md5(s::text) FROM gpkg_contents c JOIN "
+        "gpkg_spatial_ref_sys s ON s.srs_id = c.srs_id WHERE c.table_name = "
+        "%(name)s), (SELECT md5(t::text) FROM gpkg_tile_matrix_set t WHERE "
+        "t.table_name = %(name)s), (SELECT md5(string_agg(m::text, ',' "
+        "ORDER BY m.zoom_level)) FROM gpkg_tile_matrix m WHERE "
+        "m.table_name = %(name)s), (SELECT md5(string_agg(r::text || "
+        "m::text, ',' ORDER BY r::text)) FROM gpkg_metadata_reference r "
+        "JOIN gpkg_metadata m ON m.id = r.md_file_id WHERE r.table_name = "
+        "%(name)s);",
+        {"relation": '"%s"' % table_name, "name": table_name}
+    )
+    version = cursor.fetchone()
+    txids = [txid for txid in version[1:3] if txid is not None]
+    return digest(tuple(version)), max(txids) if txids else None
+
+
+class ExtractCache(object):
+    """Directory of exported SQLite GeoPackages limited to max_bytes. Hits
+    are copied to the output file or hard linked if link is set.
+    """
+
+    def __init__(self, cache_dir, max_bytes=CACHE_SIZE*1048576, link=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.link = link
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, table_name, version, extract):
+        return os.path.join(self.cache_dir, "%s-%s-%s.gpkg" % (
+            digest(table_name), version, digest(extract)
+        ))
+
+    def entries(self):
+        #Entries with their size and last use, oldest first
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".gpkg"):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def remove(self, path):
+        #Entries might be removed by concurrent dumps at the same time
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def invalidate(self, table_name, version=None):
+        #Remove the entries of a GeoPackage except those of version
+        prefix = "%s-" % digest(table_name)
+        for filename in os.listdir(self.cache_dir):
+            if filename.startswith(prefix) and filename.endswith(".gpkg") \
+               and not filename.startswith("%s%s-" % (prefix, version)):
+                self.remove(os.path.join(self.cache_dir, filename))
+
+    def fetch(self, table_name, version, extract, filename):
+        #Write a cached extract to filename, return whether it was cached
+        self.invalidate(table_name, version)
+        path = self.path(table_name, version, extract)
+        try:
+            if self.link:
+                os.link(path, filename)
+            else:
+                with open(path, "rb") as cached:
+                    with open(filename, "wb") as output:
+                        shutil.copyfileobj(cached, output, COPY_BUFFER_SIZE)
+            #the modification time records the last use
+            os.utime(path, None)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT or os.path.exists(filename):
+                raise
+            return False
+        return True
+
+    def store(self, table_name, version, extract, filename):
+        #Copy an exported extract into the cache and evict the least
+        #recently used entries beyond the size limit
+        if os.path.getsize(filename) > self.max_bytes:
+            return
+        fd, temporary = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as cached:
+                with open(filename, "rb") as output:
+                    shutil.copyfileobj(output, cached, COPY_BUFFER_SIZE)
+            os.rename(temporary, self.path(table_name, version, extract))
+        except Exception:
+            self.remove(temporary)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, path in entries:
+            if size <= self.max_bytes:
+                break
+            self.remove(path)
+            size -= entry_size
@@ -0,0 +1,244 @@
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   Instrumentation shared by the PostgreSQL-GeoPackage scripts.
+#
+#   The scripts time their phases and count the tiles they process with the
+#   module level metrics object. Depending on the options given to the
+#   scripts, progress with an ETA is reported on stderr, the results are
+#   written to a JSON metrics file, and a cProfile profile as well as the
+#   plans of the main queries are written to a profile directory.
+#
+#------------------------------------------------------------------------------
+
+import sys
+import os
+import time
+import json
+import cProfile
+import contextlib
+
+
+#Minimum number of seconds between progress reports
+PROGRESS_INTERVAL = 1.0
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "%i:%02i:%02i" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.script = None
+        self.progress = False
+        self.metrics_filename = None
+        self.profile_dir = None
+        self.profiler = None
+        self.start = time.time()
+        self.phases = []
+        self.tiles = 0
+        self.tile_bytes = 0
+        self.total_tiles = 0
+        self.total_bytes = 0
+        self.plans = []
+        self.last_report = 0
+
+    def setup(self, script, progress=False, metrics_filename=None,
+              profile_dir=None):
+        self.script = script
+        self.progress = progress
+        self.metrics_filename = metrics_filename
+        self.profile_dir = profile_dir
+        self.start = time.time()
+        if profile_dir is not None:
+            if not os.path.isdir(profile_dir):
+                os.makedirs(profile_dir)
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @property
+    def enabled(self):
+        #Whether tile totals are needed at all
+        return self.progress or self.metrics_filename is not None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        #Time a phase, phases repeated e.g. per table are summed up
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            for phase in self.phases:
+                if phase["phase"] == name:
+                    phase["seconds"] += seconds
+                    phase["count"] += 1
+                    break
+            else:
+                self.phases.append(
+                    {"phase": name, "seconds": seconds, "count": 1}
+                )
+            if self.progress:
+                self.clear_line()
+                sys.stderr.write("%s: %.3f s\n" % (name, seconds))
+
+    def add_total(self, tiles, tile_bytes=0):
+        self.total_tiles += tiles
+        self.total_bytes += tile_bytes
+
+    def count(self, tiles, tile_bytes=0):
+        self.tiles += tiles
+        self.tile_bytes += tile_bytes
+        if self.progress and time.time() - self.last_report >= \
+           PROGRESS_INTERVAL:
+            self.report()
+
+    def set_count(self, tiles, tile_bytes=0):
+        #Counts maintained elsewhere, e.g. by worker processes
+        self.count(tiles - self.tiles, tile_bytes - self.tile_bytes)
+
+    def counted(self, records, index=4):
+        #Count the tiles passing through an iterator of records
+        for record in records:
+            self.count(
+                1, 0 if record[index] is None else len(record[index])
+            )
+            yield record
+
+    def report(self):
+        self.last_report = time.time()
+        seconds = max(self.last_report - self.start, 1e-6)
+        message = "%i%s tiles, %.1f%s MB, %.1f tiles/s" % (
+            self.tiles, "/%i" % self.total_tiles if self.total_tiles else "",
+            self.tile_bytes/1048576.0,
+            "/%.1f" % (self.total_bytes/1048576.0) if self.total_bytes
+            else "", self.tiles/seconds
+        )
+        if self.total_tiles and self.tiles:
+            if self.total_bytes and self.tile_bytes:
+                done = float(self.tile_bytes)/self.total_bytes
+            else:
+                done = float(self.tiles)/self.total_tiles
+            message += ", ETA %s" % format_duration(
+                max(0, seconds/done - seconds)
+            )
+        sys.stderr.write("\r" + message + "\033[K")
+        sys.stderr.flush()
+
+    def clear_line(self):
+        if self.last_report:
+            sys.stderr.write("\r\033[K")
+
+    def explain(self, cursor, name, query, params=None):
+        #Record the executed plan of a PostgreSQL query, changes are rolled
+        #back to a savepoint
+        if self.profile_dir is None:
+            return
+        cursor.execute("SAVEPOINT gpkg_pg_explain;")
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+        plan = "\n".join(row[0] for row in cursor.fetchall())
+        cursor.execute("ROLLBACK TO SAVEPOINT gpkg_pg_explain;")
+        self.plans.append({"name": name, "query": query, "plan": plan})
+
+    def explain_sqlite(self, cursor, name, query):
+        #Record the query plan of a SQLite query
+        if self.profile_dir is None:
+            return
+        cursor.execute("EXPLAIN QUERY PLAN " + query)
+        plan = "\n".join(str(row[-1]) for row in cursor.fetchall())
+        self.plans.append({"name": name, "query": query, "plan": plan})
+
+    def finish(self):
+        seconds = max(time.time() - self.start, 1e-6)
+        if self.progress:
+            if self.tiles:
+                self.report()
+                sys.stderr.write("\n")
+            sys.stderr.write("total: %.3f s\n" % seconds)
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(
+                os.path.join(self.profile_dir, "%s.prof" % self.script)
+            )
+            with open(os.path.join(self.profile_dir,
+                                   "%s.plans.txt" % self.script), "w") as f:
+                for plan in self.plans:
+                    f.write("-- %s\n%s\n\n%s\n\n" % (
+                        plan["name"], plan["query"], plan["plan"]
+                    ))
+
+        if self.metrics_filename is not None:
+            with open(self.metrics_filename, "w") as f:
+                json.dump({
+                    "script": self.script,
+                    "arguments": sys.argv[1:],
+                    "start": time.strftime(
+                        "%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.start)
+                    ),
+                    "seconds": round(seconds, 6),
+                    "tiles": self.tiles,
+                    "bytes": self.tile_bytes,
+                    "tiles_per_second": round(self.tiles/seconds, 3),
+                    "mb_per_second": round(
+                        self.tile_bytes/1048576.0/seconds, 3
+                    ),
+                    "phases": [
+                        {"phase": phase["phase"],
+                         "seconds": round(phase["seconds"], 6),
+                         "count": phase["count"]}
+                        for phase in self.phases
+                    ],
+                    "plans": self.plans
+                }, f, indent=2, sort_keys=True)
+                f.write("\n")
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "-progress", action="store_true",
+        help="Report progress with tile counts, bytes, and an ETA as well as "
+        "the time of each phase on stderr."
+    )
+    parser.add_argument(
+        "-metrics", metavar="FILE",
+        help="Write the timing of each phase and the tile throughput as JSON "
+        "to FILE."
+    )
+    parser.add_argument(
+        "-profile", metavar="DIR",
+        help="Write a cProfile profile of the script and the EXPLAIN "
+        "(ANALYZE, BUFFERS) output of its main queries to DIR. The queries "
+        "are run once more for this."
+    )
+
+
+metrics = Metrics()
@@ -0,0 +1,693 @@
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   Programmatic access to the tiles of a PostgreSQL-GeoPackage database.
+#
+#   GpkgStore reads and writes tiles through a pool of connections. Tile
+#   queries are prepared once per connection and table, lists of tiles are
+#   read and written with a single statement, windows are streamed with a
+#   server side cursor, and the tile matrix of each table is cached.
+#
+#   GpkgStore serves access by tile, e.g. by gpkg-pg_serve.py and
+#   gpkg-pg_overviews.py, with each call committed on its own pooled
+#   connection. Loading, dumping, and dropping whole GeoPackages work on
+#   their own connection instead, as they stream the tiles with COPY and
+#   server side cursors and need a single transaction spanning the metadata
+#   and the tiles. They share the helpers below with GpkgStore, so the
+#   statements selecting windows of tiles, deleting tiles, and counting the
+#   references to deduplicated tile data in gpkg_tile_blobs exist once.
+#
+#   Example:
+#
+#     store = GpkgStore("dbname='gpkg' user='gpkg'")
+#     tiles = store.get_tiles("table", [(0, 0, 0), (1, 0, 1)])
+#     for tile_column, tile_row, tile_data in store.iter_window(
+#             "table", 1, 0, 0, 2, 2):
+#         ...
+#     store.close()
+#
+#------------------------------------------------------------------------------
+
+import sys
+import time
+import hashlib
+import threading
+import contextlib
+import psycopg2
+import psycopg2.pool
+from gpkg_pg_metrics import metrics
+
+
+#Number of tiles fetched per round trip when streaming windows
+WINDOW_BATCH_SIZE = 1000
+#Order of tiles stored close to their neighbours within each zoom level
+MORTON_ORDER = "zoom_level, gpkg_tile_morton(tile_column, tile_row)"
+#Shifts and masks spreading the 31 lower bits of a tile index to every
+#second bit of the Morton key
+MORTON_MASKS = [
+    (16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+    (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+    (1, 0x5555555555555555),
+]
+#Relative tolerance when comparing the tile sizes of zoom levels
+TILE_SIZE_EPSILON = 1e-9
+
+#Queries prepared per connection and table, formatted with the tiles source
+STATEMENTS = {
+    "tile": (
+        "(BIGINT, BIGINT, BIGINT)",
+        "SELECT tile_data FROM %s WHERE zoom_level = $1 AND tile_column = $2 "
+        "AND tile_row = $3"
+    ),
+    "tiles": (
+        "(BIGINT[], BIGINT[], BIGINT[])",
+        "SELECT k.zoom_level, k.tile_column, k.tile_row, t.tile_data FROM "
+        "unnest($1, $2, $3) AS k (zoom_level, tile_column, tile_row) JOIN "
+        "%s t ON t.zoom_level = k.zoom_level AND t.tile_column = "
+        "k.tile_column AND t.tile_row = k.tile_row"
+    ),
+}
+
+
+def is_deduplicated(cursor, table_name):
+    #Deduplicated tables reference their tile data in gpkg_tile_blobs
+    cursor.execute(
+        "SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass(%s) AND "
+        "attname = 'tile_hash' AND NOT attisdropped;",
+        ('"%s"' % table_name,)
+    )
+    return cursor.fetchone() is not None
+
+
+def tiles_source(cursor, table_name, deduplicated=None):
+    #Relation to select the tiles with their tile data from
+    if deduplicated is None:
+        deduplicated = is_deduplicated(cursor, table_name)
+    if not deduplicated:
+        return "\"%s\"" % table_name
+    return (
+        "(SELECT t.*, b.tile_data FROM \"%s\" t JOIN gpkg_tile_blobs b "
+        "ON b.tile_hash = t.tile_hash) AS tiles" % table_name
+    )
+
+
+def add_tile_blobs(cursor, blobs, params=None):
+    #Store the tile data selected as (tile_hash, refcount, tile_data) by the
+    #blobs query once in gpkg_tile_blobs, existing tile data only counts the
+    #new references
+    query = (
+        "INSERT INTO gpkg_tile_blobs (tile_hash, refcount, tile_data) %s "
+        "ON CONFLICT (tile_hash) DO UPDATE SET refcount = "
+        "gpkg_tile_blobs.refcount + EXCLUDED.refcount;" % blobs
+    )
+    metrics.explain(cursor, "gpkg_tile_blobs", query, params)
+    cursor.execute(query, params)
+
+
+def delete_tile_blobs(cursor, tile_hashes):
+    #Remove the tile data of the hashes no longer referenced, returns the
+    #bytes of tile data removed
+    if not tile_hashes:
+        return 0
+    cursor.execute(
+        "WITH deleted AS (DELETE FROM gpkg_tile_blobs WHERE tile_hash = "
+        "ANY(%s) AND refcount <= 0 RETURNING pg_column_size(tile_data) AS "
+        "size) SELECT coalesce(sum(size), 0)::bigint FROM deleted;",
+        (tile_hashes,)
+    )
+    return int(cursor.fetchone()[0])
+
+
+def release_tile_blobs(cursor, hashes, params=None):
+    #Drop one reference for each tile hash selected by the hashes query and
+    #remove the tile data no longer referenced with set-based statements,
+    #returns the bytes of tile data removed
+    query = (
+        "UPDATE gpkg_tile_blobs b SET refcount = b.refcount - c.refcount "
+        "FROM (SELECT tile_hash, count(*) AS refcount FROM (%s) h GROUP BY "
+        "tile_hash) c WHERE b.tile_hash = c.tile_hash;" % hashes
+    )
+    metrics.explain(cursor, "gpkg_tile_blobs", query, params)
+    cursor.execute(query, params)
+    cursor.execute(
+        "WITH deleted AS (DELETE FROM gpkg_tile_blobs b WHERE b.refcount <= "
+        "0 AND b.tile_hash IN (%s) RETURNING pg_column_size(b.tile_data) AS "
+        "size) SELECT coalesce(sum(size), 0)::bigint FROM deleted;" % hashes,
+        params
+    )
+    return int(cursor.fetchone()[0])
+
+
+def delete_tiles(cursor, table_name, condition, params=None,
+                 deduplicated=None):
+    #Delete the tiles matching the WHERE condition, deduplicated tables
+    #release their tile data, returns whether tiles were deleted
+    if deduplicated is None:
+        deduplicated = is_deduplicated(cursor, table_name)
+    if not deduplicated:
+        cursor.execute(
+            "DELETE FROM \"" + table_name + "\" WHERE " + condition + ";",
+            params
+        )
+        return cursor.rowcount > 0
+    cursor.execute(
+        "WITH deleted AS (DELETE FROM \"" + table_name + "\" WHERE " +
+        condition + " RETURNING tile_hash) "
+        "UPDATE gpkg_tile_blobs b SET refcount = b.refcount - c.refcount "
+        "FROM (SELECT tile_hash, count(*) AS refcount FROM deleted "
+        "GROUP BY tile_hash) c WHERE b.tile_hash = c.tile_hash "
+        "RETURNING b.tile_hash, b.refcount;", params
+    )
+    released = cursor.fetchall()
+    delete_tile_blobs(cursor, [row[0] for row in released if row[1] <= 0])
+    return len(released) > 0
+
+
+def create_change_trigger(cursor_out, relation_name, table_name):
+    #Track updates and deletions of tiles for incremental exports
+    cursor_out.execute(
+        "CREATE TRIGGER \"%s_change\" BEFORE UPDATE OR DELETE ON \"%s\" "
+        "FOR EACH ROW EXECUTE PROCEDURE gpkg_tile_change('%s');"
+        % (relation_name, relation_name, table_name)
+    )
+
+
+def create_tiles_partitions(cursor_out, table_name, matrices=None):
+    #Create one partition per zoom level with the tile matrix bounds as check
+    #constraints replacing the triggers, the zoom levels and matrix sizes are
+    #read from gpkg_tile_matrix unless given
+    if matrices is None:
+        cursor_out.execute(
+            "SELECT zoom_level, matrix_width, matrix_height FROM "
+            "gpkg_tile_matrix WHERE table_name = '%s' ORDER BY zoom_level;"
+            % table_name
+        )
+        matrices = cursor_out.fetchall()
+    for zoom_level, matrix_width, matrix_height in matrices:
+        cursor_out.execute(
+            "SELECT to_regclass('\"%s_zoom_%i\"');" % (table_name, zoom_level)
+        )
+        if cursor_out.fetchone()[0] is not None:
+            continue
+        cursor_out.execute(
+            "CREATE TABLE \"%s_zoom_%i\" PARTITION OF \"%s\" ("
+            "    PRIMARY KEY (id),"
+            "    CHECK (tile_column >= 0 AND tile_column < %i),"
+            "    CHECK (tile_row >= 0 AND tile_row < %i)"
+            ") FOR VALUES IN (%i);"
+            % (table_name, zoom_level, table_name, matrix_width,
+               matrix_height, zoom_level)
+        )
+        create_change_trigger(
+            cursor_out, "%s_zoom_%i" % (table_name, zoom_level), table_name
+        )
+
+
+def morton_key(tile_column, tile_row):
+    #Same key as gpkg_tile_morton() of gpkg-pg_init.sql, e.g. registered with
+    #SQLite to read tiles in the order they are stored
+    keys = []
+    for value in (tile_column, tile_row):
+        value &= 0x7FFFFFFF
+        for shift, mask in MORTON_MASKS:
+            value = (value | value << shift) & mask
+        keys.append(value)
+    return keys[0] | keys[1] << 1
+
+
+def is_morton_ordered(cursor, table_name):
+    #Tables stored in Morton order have an index on the Morton key
+    cursor.execute("SELECT to_regclass(%s);", ('"%s_morton"' % table_name,))
+    return cursor.fetchone()[0] is not None
+
+
+def create_morton_index(cursor_out, table_name, partition=False):
+    #Index the tiles by zoom level and Morton key, the order clustering
+    #restores, partitions get their own index from the partitioned one
+    cursor_out.execute(
+        "CREATE INDEX \"%s_morton\" ON \"%s\" (%s);"
+        % (table_name, table_name, MORTON_ORDER)
+    )
+    if not partition:
+        cursor_out.execute(
+            "ALTER TABLE \"%s\" CLUSTER ON \"%s_morton\";"
+            % (table_name, table_name)
+        )
+
+
+def morton_indexes(cursor, table_name):
+    #Relations holding the tiles with their Morton key index, i.e. the
+    #partitions of partitioned tables
+    cursor.execute(
+        "SELECT i.indrelid::regclass::text, i.indexrelid::regclass::text "
+        "FROM pg_index i JOIN pg_inherits h ON h.inhrelid = i.indexrelid "
+        "WHERE h.inhparent = to_regclass(%s) ORDER BY 1;",
+        ('"%s_morton"' % table_name,)
+    )
+    return cursor.fetchall() or [
+        ('"%s"' % table_name, '"%s_morton"' % table_name)
+    ]
+
+
+def cluster_tiles(cursor_out, table_name):
+    #Rewrite the tiles in Morton order, partitions one after the other
+    for relation, index in morton_indexes(cursor_out, table_name):
+        cursor_out.execute("CLUSTER %s USING %s;" % (relation, index))
+
+
+def extract_windows(cursor, table_name, srcwin):
+    #Translate a window of the highest zoom level into tile ranges of all
+    #zoom levels aligned outward to whole tiles, zoom levels whose tiles do
+    #not nest into those of the lowest zoom level are skipped with a warning
+    cursor.execute(
+        "SELECT zoom_level, matrix_width, matrix_height, "
+        "tile_width*pixel_x_size, tile_height*pixel_y_size FROM "
+        "gpkg_tile_matrix WHERE table_name = %s ORDER BY zoom_level DESC;",
+        (table_name,)
+    )
+    matrices = cursor.fetchall()
+    tile_size = [float(size) for size in matrices[0][3:5]]
+    ratios = {}
+    for zoom_level, matrix_width, matrix_height, tile_x_size, \
+            tile_y_size in matrices:
+        tile_x_size, tile_y_size = float(tile_x_size), float(tile_y_size)
+        ratio = int(round(tile_x_size/tile_size[0]))
+        if ratio < 1 or abs(ratio*tile_size[0]-tile_x_size) > \
+                TILE_SIZE_EPSILON*tile_x_size or \
+                abs(ratio*tile_size[1]-tile_y_size) > \
+                TILE_SIZE_EPSILON*tile_y_size:
+            sys.stderr.write(
+                "WARNING: Tiles of zoom level %i of GeoPackage '%s' are no "
+                "multiple of the tiles of zoom level %i, zoom level %i is "
+                "not exported.\n"
+                % (zoom_level, table_name, matrices[0][0], zoom_level)
+            )
+            continue
+        ratios[zoom_level] = (ratio, matrix_width, matrix_height)
+
+    coarsest = max(ratio[0] for ratio in ratios.values())
+    windows = {}
+    for zoom_level, (ratio, matrix_width, matrix_height) in ratios.items():
+        if coarsest % ratio != 0:
+            sys.stderr.write(
+                "WARNING: Tiles of zoom level %i of GeoPackage '%s' do not "
+                "nest into the tiles of the lowest zoom level, zoom level %i "
+                "is not exported.\n" % (zoom_level, table_name, zoom_level)
+            )
+            continue
+        windows[zoom_level] = (
+            srcwin[0]//ratio,
+            min(matrix_width, -(-(srcwin[0]+srcwin[2])//ratio)),
+            srcwin[1]//ratio,
+            min(matrix_height, -(-(srcwin[1]+srcwin[3])//ratio))
+        )
+    return windows
+
+
+def window_extent(window, tile_x_size, tile_y_size, min_x, max_y):
+    return (
+        float(min_x + window[0]*tile_x_size),
+        float(max_y - window[3]*tile_y_size),
+        float(min_x + window[1]*tile_x_size),
+        float(max_y - window[2]*tile_y_size)
+    )
+
+
+def window_constraint(windows, morton=False):
+    #WHERE clause selecting the tiles within the windows by zoom level, usable
+    #in SQLite as well as in PostgreSQL. Tables stored in Morton order are
+    #read by the range of Morton keys between the corners of each window,
+    #i.e. from few contiguous pages
+    ranges = [
+        "(zoom_level = %i AND tile_column >= %i AND tile_column < %i AND "
+        "tile_row >= %i AND tile_row < %i%s)" % ((zoom_level,) + window + (
+            "" if not morton else " AND gpkg_tile_morton(tile_column, "
+            "tile_row) BETWEEN %i AND %i" % (
+                morton_key(window[0], window[2]),
+                morton_key(window[1]-1, window[3]-1)
+            ),
+        ))
+        for zoom_level, window in sorted(windows.items())
+        if window[0] < window[1] and window[2] < window[3]
+    ]
+    if not ranges:
+        return "1 = 0"
+    return "(%s)" % " OR ".join(ranges)
+
+
+def extract_tile_matrix(cursor, table_name, windows=None):
+    #Tile matrix rows, output zoom level and tile index origin per zoom
+    #level, and the extents of the tile matrix set and gpkg_contents of an
+    #extract of the given windows. All zoom levels of an extract span the
+    #window of the lowest one, which is aligned to the tiles of every zoom
+    #level, while gpkg_contents is narrowed to the window of the highest
+    #one. Without windows all tile matrices are kept as they are. NUMERIC
+    #pixel sizes are converted as SQLite cannot bind decimals.
+    cursor.execute(
+        "SELECT ma.zoom_level, ma.matrix_width, ma.matrix_height, "
+        "ma.tile_width, ma.tile_height, ma.pixel_x_size, ma.pixel_y_size, "
+        "ma.tile_width*ma.pixel_x_size, ma.tile_height*ma.pixel_y_size, "
+        "tms.min_x, tms.max_y, con.min_x, con.min_y, con.max_x, con.max_y "
+        "FROM gpkg_tile_matrix ma, gpkg_tile_matrix_set tms, gpkg_contents "
+        "con WHERE ma.table_name = %s AND tms.table_name = ma.table_name "
+        "AND con.table_name = ma.table_name ORDER BY ma.zoom_level;",
+        (table_name,)
+    )
+    matrices = dict((row[0], row[1:]) for row in cursor.fetchall())
+    if windows is None:
+        rows = [
+            (table_name, zoom_level) + matrix[0:4] +
+            (float(matrix[4]), float(matrix[5]))
+            for zoom_level, matrix in sorted(matrices.items())
+        ]
+        offsets = dict(
+            (zoom_level, (zoom_level, 0, 0)) for zoom_level in matrices
+        )
+        return rows, offsets, None, None
+
+    lowest = matrices[min(windows)]
+    window = windows[min(windows)]
+    rows = []
+    offsets = {}
+    for zoom_level in sorted(windows):
+        matrix = matrices[zoom_level]
+        scale = int(round(lowest[6]/matrix[6]))
+        rows.append((
+            table_name, zoom_level, (window[1]-window[0])*scale,
+            (window[3]-window[2])*scale, matrix[2], matrix[3],
+            float(matrix[4]), float(matrix[5])
+        ))
+        offsets[zoom_level] = (zoom_level, window[0]*scale, window[2]*scale)
+    tms_extent = window_extent(window, *lowest[6:10])
+    highest = matrices[max(windows)]
+    extent = window_extent(windows[max(windows)], *highest[6:10])
+    contents = [
+        extent[i] if highest[10+i] is None else float(highest[10+i])
+        for i in range(4)
+    ]
+    contents_extent = (
+        max(extent[0], contents[0]), max(extent[1], contents[1]),
+        min(extent[2], contents[2]), min(extent[3], contents[3])
+    )
+    return rows, offsets, tms_extent, contents_extent
+
+
+class TileMatrix(object):
+    """Zoom levels with matrix size of a tiles table and how to read it."""
+
+    def __init__(self, zoom_levels, source, deduplicated):
+        self.zoom_levels = zoom_levels
+        self.source = source
+        self.deduplicated = deduplicated
+
+    def contains(self, zoom_level, tile_column, tile_row):
+        size = self.zoom_levels.get(zoom_level)
+        return size is not None and 0 <= tile_column < size[0] and \
+            0 <= tile_row < size[1]
+
+
+class GpkgStore(object):
+    """Read and write access to the tiles tables using a pool of
+    connections. Tile matrix definitions are read again after ttl seconds.
+    """
+
+    def __init__(self, pg_connection_string, pool_size=4, ttl=60):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            1, pool_size, pg_connection_string
+        )
+        #the pool raises an error when exhausted, wait for a free connection
+        self.connections = threading.BoundedSemaphore(pool_size)
+        self.ttl = ttl
+        self.matrices = {}
+        self.statements = {}
+        self.prepared = {}
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.pool.closeall()
+
+    @contextlib.contextmanager
+    def connection(self, autocommit=True):
+        #Borrow a connection from the pool, without autocommit the work is
+        #committed at the end or rolled back on errors
+        self.connections.acquire()
+        try:
+            conn = self.pool.getconn()
+        except Exception:
+            self.connections.release()
+            raise
+        try:
+            if conn.autocommit != autocommit:
+                conn.autocommit = autocommit
+            yield conn
+            if not autocommit:
+                conn.commit()
+        finally:
+            #also ends transactions of generators closed early
+            if not autocommit and not conn.closed:
+                conn.rollback()
+            self.pool.putconn(conn)
+            self.connections.release()
+
+    def query_matrix(self, cursor, table_name):
+        cursor.execute(
+            "SELECT ma.zoom_level, ma.matrix_width, ma.matrix_height FROM "
+            "gpkg_tile_matrix ma, gpkg_contents con WHERE "
+            "con.table_name = %s AND con.data_type = 'tiles' AND "
+            "ma.table_name = con.table_name;", (table_name,)
+        )
+        zoom_levels = dict(
+            (row[0], (row[1], row[2])) for row in cursor.fetchall()
+        )
+        if not zoom_levels:
+            return None
+        deduplicated = is_deduplicated(cursor, table_name)
+        return TileMatrix(
+            zoom_levels, tiles_source(cursor, table_name, deduplicated),
+            deduplicated
+        )
+
+    def tile_matrix(self, conn, table_name):
+        with self.lock:
+            matrix = self.matrices.get(table_name)
+        if matrix is not None and matrix[0] >= time.time():
+            return matrix[1]
+        with conn.cursor() as cursor:
+            matrix = self.query_matrix(cursor, table_name)
+        with self.lock:
+            self.matrices[table_name] = (time.time() + self.ttl, matrix)
+            if table_name not in self.statements:
+                self.statements[table_name] = len(self.statements)
+        return matrix
+
+    def invalidate(self, conn, table_name):
+        #The table might have been dropped or reloaded, prepare again
+        with self.lock:
+            self.prepared.pop(conn, None)
+            self.matrices.pop(table_name, None)
+        with conn.cursor() as cursor:
+            cursor.execute("DEALLOCATE ALL;")
+
+    def execute(self, conn, table_name, kind, params):
+        #Execute a prepared query of a table and fetch all rows, preparing
+        #it first on this connection
+        for attempt in (0, 1):
+            matrix = self.tile_matrix(conn, table_name)
+            if matrix is None:
+                return None
+            statement = "gpkg_%s_%i" % (kind, self.statements[table_name])
+            prepared = self.prepared.setdefault(conn, set())
+            try:
+                with conn.cursor() as cursor:
+                    if statement not in prepared:
+                        types, query = STATEMENTS[kind]
+                        cursor.execute(
+                            "PREPARE %s %s AS %s;"
+                            % (statement, types, query % matrix.source)
+                        )
+                        prepared.add(statement)
+                    cursor.execute(
+                        "EXECUTE %s (%s);" % (
+                            statement, ", ".join(["%s"]*len(params))
+                        ), params
+                    )
+                    return cursor.fetchall()
+            except psycopg2.Error:
+                if attempt or not conn.autocommit:
+                    raise
+                self.invalidate(conn, table_name)
+
+    def get_tile(self, table_name, zoom_level, tile_column, tile_row):
+        """Return the tile data or None if the tile does not exist."""
+        with self.connection() as conn:
+            matrix = self.tile_matrix(conn, table_name)
+            if matrix is None or \
+               not matrix.contains(zoom_level, tile_column, tile_row):
+                return None
+            rows = self.execute(
+                conn, table_name, "tile", (zoom_level, tile_column, tile_row)
+            )
+        if not rows:
+            return None
+        return bytes(rows[0][0])
+
+    def get_tiles(self, table_name, keys):
+        """Return a dict of the tile data of all existing tiles given by
+        (zoom_level, tile_column, tile_row) keys read with a single query.
+        """
+        with self.connection() as conn:
+            matrix = self.tile_matrix(conn, table_name)
+            if matrix is None:
+                return {}
+            keys = [key for key in set(keys) if matrix.contains(*key)]
+            if not keys:
+                return {}
+            rows = self.execute(
+                conn, table_name, "tiles",
+                tuple(list(values) for values in zip(*keys))
+            )
+        return dict(
+            ((row[0], row[1], row[2]), bytes(row[3])) for row in rows or []
+        )
+
+    def iter_window(self, table_name, zoom_level, min_column, min_row,
+                    max_column, max_row, batch_size=WINDOW_BATCH_SIZE):
+        """Yield (tile_column, tile_row, tile_data) of the tiles of a zoom
+        level with min_column <= tile_column < max_column and
+        min_row <= tile_row < max_row. The tiles are streamed with a server
+        side cursor, a connection of the pool is held until the generator is
+        exhausted or closed.
+        """
+        with self.connection(autocommit=False) as conn:
+            matrix = self.tile_matrix(conn, table_name)
+            if matrix is None or zoom_level not in matrix.zoom_levels:
+                return
+            with conn.cursor("window") as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(
+                    "SELECT tile_column, tile_row, tile_data FROM %s WHERE "
+                    "zoom_level = %%s AND tile_column >= %%s AND "
+                    "tile_column < %%s AND tile_row >= %%s AND "
+                    "tile_row < %%s ORDER BY tile_column, tile_row;"
+                    % matrix.source,
+                    (zoom_level, min_column, max_column, min_row, max_row)
+                )
+                for tile_column, tile_row, tile_data in cursor:
+                    yield tile_column, tile_row, bytes(tile_data)
+
+    def put_tiles(self, table_name, tiles):
+        """Insert or replace the tiles given as (zoom_level, tile_column,
+        tile_row, tile_data) in a single transaction. Deduplicated tables
+        store new tile data in gpkg_tile_blobs and release replaced tile
+        data. Returns the number of tiles written.
+        """
+        #the last tile wins if a key is given more than once
+        tiles = dict(
+            ((tile[0], tile[1], tile[2]), tile[3]) for tile in tiles
+        )
+        if not tiles:
+            return 0
+        keys = list(tiles.keys())
+        zoom_levels, tile_columns, tile_rows = [list(v) for v in zip(*keys)]
+
+        with self.connection(autocommit=False) as conn:
+            matrix = self.tile_matrix(conn, table_name)
+            if matrix is None:
+                raise ValueError(
+                    "GeoPackage '%s' not found in PostgreSQL." % table_name
+                )
+            with conn.cursor() as cursor:
+                if not matrix.deduplicated:
+                    cursor.execute(
+                        "INSERT INTO \"%s\" (zoom_level, tile_column, "
+                        "tile_row, tile_data) SELECT * FROM "
+                        "unnest(%%s::BIGINT[], %%s::BIGINT[], "
+                        "%%s::BIGINT[], %%s::BYTEA[]) ON CONFLICT "
+                        "(zoom_level, tile_column, tile_row) DO UPDATE SET "
+                        "tile_data = EXCLUDED.tile_data;" % table_name,
+                        (zoom_levels, tile_columns, tile_rows,
+                         [psycopg2.Binary(tiles[key]) for key in keys])
+                    )
+                    return len(keys)
+
+                hashes = [hashlib.sha256(tiles[key]).digest() for key in keys]
+                blobs = {}
+                for tile_hash, key in zip(hashes, keys):
+                    blob = blobs.setdefault(tile_hash, [tiles[key], 0])
+                    blob[1] += 1
+                #count the new references before releasing those of the
+                #replaced tiles so tile data kept is never removed
+                add_tile_blobs(
+                    cursor, "SELECT * FROM unnest(%s::BYTEA[], %s::BIGINT[], "
+                    "%s::BYTEA[])",
+                    ([psycopg2.Binary(h) for h in blobs.keys()],
+                     [blob[1] for blob in blobs.values()],
+                     [psycopg2.Binary(blob[0]) for blob in blobs.values()])
+                )
+                release_tile_blobs(
+                    cursor, "SELECT t.tile_hash FROM \"%s\" t JOIN "
+                    "unnest(%%s::BIGINT[], %%s::BIGINT[], %%s::BIGINT[]) AS "
+                    "k (zoom_level, tile_column, tile_row) ON t.zoom_level = "
+                    "k.zoom_level AND t.tile_column = k.tile_column AND "
+                    "t.tile_row = k.tile_row" % table_name,
+                    (zoom_levels, tile_columns, tile_rows)
+                )
+                cursor.execute(
+                    "INSERT INTO \"%s\" (zoom_level, tile_column, tile_row, "
+                    "tile_hash) SELECT * FROM unnest(%%s::BIGINT[], "
+                    "%%s::BIGINT[], %%s::BIGINT[], %%s::BYTEA[]) ON "
+                    "CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE "
+                    "SET tile_hash = EXCLUDED.tile_hash;" % table_name,
+                    (zoom_levels, tile_columns, tile_rows,
+                     [psycopg2.Binary(h) for h in hashes])
+                )
+        return len(keys)
+
+    def delete_tiles(self, table_name, keys):
+        """Delete the tiles given by (zoom_level, tile_column, tile_row) keys
+        in a single transaction. Deduplicated tables release the tile data
+        no longer referenced.
+        """
+        keys = list(set(keys))
+        if not keys:
+            return
+        zoom_levels, tile_columns, tile_rows = [list(v) for v in zip(*keys)]
+        with self.connection(autocommit=False) as conn:
+            matrix = self.tile_matrix(conn, table_name)
+            if matrix is None:
+                raise ValueError(
+                    "GeoPackage '%s' not found in PostgreSQL." % table_name
+                )
+            with conn.cursor() as cursor:
+                delete_tiles(
+                    cursor, table_name, "(zoom_level, tile_column, tile_row) "
+                    "IN (SELECT * FROM unnest(%s::BIGINT[], %s::BIGINT[], "
+                    "%s::BIGINT[]))", (zoom_levels, tile_columns, tile_rows),
+                    matrix.deduplicated
+                )
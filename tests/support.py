@@ -0,0 +1,149 @@
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   Helpers shared by the tests. The scripts are loaded as modules from their
+#   hyphenated file names. Tests of code importing psycopg2 are skipped
+#   without it, tests against a database initialized with gpkg-pg_init.sql
+#   run only if GPKG_PG_TEST_DSN holds its connection string.
+#
+#------------------------------------------------------------------------------
+
+import os
+import sys
+import imp
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import contextlib
+import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+#Connection string of the test database, e.g. "dbname='gpkg_test'"
+PG_TEST_DSN = os.environ.get("GPKG_PG_TEST_DSN")
+
+requires_psycopg2 = unittest.skipIf(
+    psycopg2 is None, "psycopg2 is not installed"
+)
+requires_database = unittest.skipIf(
+    psycopg2 is None or PG_TEST_DSN is None,
+    "GPKG_PG_TEST_DSN is not set"
+)
+
+
+def load_script(name):
+    #Import a script like gpkg-pg_drop.py as module gpkg_pg_drop_script
+    return imp.load_source(
+        "%s_script" % name.replace("-", "_"),
+        os.path.join(ROOT, "%s.py" % name)
+    )
+
+
+@contextlib.contextmanager
+def temporary_directory():
+    path = tempfile.mkdtemp()
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path)
+
+
+@contextlib.contextmanager
+def captured_output():
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+    try:
+        yield sys.stdout, sys.stderr
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def create_tiles_gpkg(filename, table_name, tiles, matrices):
+    #Minimal SQLite GeoPackage with the given (zoom_level, matrix_width,
+    #matrix_height) tile matrices of 256 pixel tiles halving per level and
+    #(zoom_level, tile_column, tile_row, tile_data) tiles
+    conn = sqlite3.connect(filename)
+    conn.execute(
+        "CREATE TABLE gpkg_contents (table_name TEXT PRIMARY KEY, "
+        "data_type TEXT, identifier TEXT, description TEXT, last_change "
+        "TEXT, min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, "
+        "srs_id INTEGER);"
+    )
+    conn.execute(
+        "CREATE TABLE gpkg_tile_matrix_set (table_name TEXT PRIMARY KEY, "
+        "srs_id INTEGER, min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, "
+        "max_y DOUBLE);"
+    )
+    conn.execute(
+        "CREATE TABLE gpkg_tile_matrix (table_name TEXT, zoom_level "
+        "INTEGER, matrix_width INTEGER, matrix_height INTEGER, tile_width "
+        "INTEGER, tile_height INTEGER, pixel_x_size DOUBLE, pixel_y_size "
+        "DOUBLE, PRIMARY KEY (table_name, zoom_level));"
+    )
+    conn.execute(
+        "CREATE TABLE \"%s\" (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, "
+        "tile_data BLOB, UNIQUE (zoom_level, tile_column, tile_row));"
+        % table_name
+    )
+    max_zoom_level = max(matrix[0] for matrix in matrices)
+    width = [matrix[1] for matrix in matrices
+             if matrix[0] == max_zoom_level][0]
+    height = [matrix[2] for matrix in matrices
+              if matrix[0] == max_zoom_level][0]
+    extent = (0.0, -256.0*height, 256.0*width, 0.0)
+    conn.execute(
+        "INSERT INTO gpkg_contents VALUES (?, 'tiles', ?, '', "
+        "'2016-01-01T00:00:00Z', ?, ?, ?, ?, 3857);",
+        (table_name, table_name) + extent
+    )
+    conn.execute(
+        "INSERT INTO gpkg_tile_matrix_set VALUES (?, 3857, ?, ?, ?, ?);",
+        (table_name,) + extent
+    )
+    conn.executemany(
+        "INSERT INTO gpkg_tile_matrix VALUES (?, ?, ?, ?, 256, 256, ?, ?);",
+        [(table_name, zoom_level, matrix_width, matrix_height,
+          2.0**(max_zoom_level-zoom_level), 2.0**(max_zoom_level-zoom_level))
+         for zoom_level, matrix_width, matrix_height in matrices]
+    )
+    conn.executemany(
+        "INSERT INTO \"%s\" (zoom_level, tile_column, tile_row, tile_data) "
+        "VALUES (?, ?, ?, ?);" % table_name,
+        [tile[:3] + (sqlite3.Binary(tile[3]),) for tile in tiles]
+    )
+    conn.commit()
+    conn.close()
@@ -0,0 +1,108 @@
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+#
+# Description:
+#
+#   Tests of the extract cache of gpkg_pg_cache.
+#
+#------------------------------------------------------------------------------
+
+import os
+import unittest
+
+from support import temporary_directory
+import gpkg_pg_cache
+
+
+class ExtractCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        directory = temporary_directory()
+        self.path = directory.__enter__()
+        self.addCleanup(directory.__exit__, None, None, None)
+        self.cache = gpkg_pg_cache.ExtractCache(
+            os.path.join(self.path, "cache"), max_bytes=25
+        )
+        self.filename = os.path.join(self.path, "extract.gpkg")
+        self.output = os.path.join(self.path, "output.gpkg")
+
+    def store(self, table_name, version, extract, data, mtime):
+        with open(self.filename, "wb") as extract_file:
+            extract_file.write(data)
+        self.cache.store(table_name, version, extract, self.filename)
+        path = self.cache.path(table_name, version, extract)
+        if os.path.exists(path):
+            os.utime(path, (mtime, mtime))
+
+    def fetch(self, table_name, version, extract):
+        if os.path.exists(self.output):
+            os.remove(self.output)
+        if not self.cache.fetch(table_name, version, extract, self.output):
+            return None
+        with open(self.output, "rb") as output:
+            return output.read()
+
+    def test_fetch(self):
+        self.store("tiles", "v1", (0, 0, 1, 1), "extract 1", 1000)
+        self.assertEqual(self.fetch("tiles", "v1", (0, 0, 1, 1)), "extract 1")
+        self.assertIsNone(self.fetch("tiles", "v1", (0, 0, 2, 2)))
+        self.assertIsNone(self.fetch("other", "v1", (0, 0, 1, 1)))
+
+    def test_versions(self):
+        #looking up a new version removes the entries of older ones
+        self.store("tiles", "v1", (0, 0, 1, 1), "extract 1", 1000)
+        self.store("other", "v1", (0, 0, 1, 1), "extract 2", 1000)
+        self.assertIsNone(self.fetch("tiles", "v2", (0, 0, 1, 1)))
+        self.assertEqual(len(self.cache.entries()), 1)
+        self.assertEqual(self.fetch("other", "v1", (0, 0, 1, 1)), "extract 2")
+
+    def test_eviction(self):
+        #three entries of 9 bytes exceed 25 bytes, the least recently used
+        #one is evicted
+        self.store("tiles", "v1", 1, "extract 1", 1000)
+        self.store("tiles", "v1", 2, "extract 2", 2000)
+        self.assertEqual(self.fetch("tiles", "v1", 1), "extract 1")
+        self.store("tiles", "v1", 3, "extract 3", 3000)
+        self.assertEqual(
+            [self.fetch("tiles", "v1", extract) for extract in (1, 2, 3)],
+            ["extract 1", None, "extract 3"]
+        )
+
+    def test_too_large(self):
+        self.store("tiles", "v1", 1, "x"*26, 1000)
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_invalidate(self):
+        self.store("tiles", "v1", 1, "extract 1", 1000)
+        self.store("tiles", "v1", 2, "extract 2", 1000)
+        self.cache.invalidate("tiles")
+        self.assertEqual(self.cache.entries(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   Tests of gpkg-pg_drop.py against a fake connection returning the types
+#   psycopg2 returns and, if configured, against a database.
+#
+#------------------------------------------------------------------------------
+
+import sys
+import decimal
+import unittest
+import subprocess
+import os.path
+
+from support import (
+    ROOT, PG_TEST_DSN, requires_psycopg2, requires_database, load_script,
+    temporary_directory, captured_output, create_tiles_gpkg
+)
+
+
+class FakeCursor(object):
+    #Answers the statements of drop_gpkgs like PostgreSQL for a single
+    #GeoPackage without deduplication, sums are numeric and thus Decimal
+
+    def __init__(self, statements):
+        self.statements = statements
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+        if "to_regclass" in query:
+            self.rows = [(None,)]
+        elif "FROM gpkg_contents WHERE data_type" in query:
+            self.rows = [("test_tiles", 16384)]
+        elif "pg_total_relation_size" in query:
+            self.rows = [(decimal.Decimal(3145728), decimal.Decimal(42))]
+        else:
+            self.rows = []
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.statements = []
+        self.committed = False
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.committed = exc_type is None
+
+    def cursor(self):
+        return FakeCursor(self.statements)
+
+    def close(self):
+        self.closed = True
+
+
+@requires_psycopg2
+class DropTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.drop = load_script("gpkg-pg_drop")
+        self.conn = FakeConnection()
+        self.connect = self.drop.psycopg2.connect
+        self.drop.psycopg2.connect = lambda dsn: self.conn
+
+    def tearDown(self):
+        self.drop.psycopg2.connect = self.connect
+
+    def test_drop_gpkgs(self):
+        result = self.drop.drop_gpkgs("dbname='gpkg'", ["test_tiles"])
+        self.assertEqual(result, (1, 3145728, 0))
+        self.assertTrue(self.conn.committed)
+        self.assertTrue(self.conn.closed)
+        self.assertIn("DROP TABLE \"test_tiles\";", self.conn.statements)
+
+    def test_main(self):
+        sys.argv = ["gpkg-pg_drop.py", "dbname='gpkg'", "test_tiles"]
+        with captured_output() as (stdout, stderr):
+            with self.assertRaises(SystemExit) as cm:
+                self.drop.main()
+        self.assertEqual(cm.exception.code, 0)
+        self.assertEqual(
+            stdout.getvalue(),
+            "GeoPackage 'test_tiles' successfully deleted\n"
+            "Reclaimed 3.0 MB of tables and 0.0 MB of shared tile data\n"
+        )
+
+    def test_missing_gpkg(self):
+        with captured_output() as (stdout, stderr):
+            with self.assertRaises(SystemExit) as cm:
+                self.drop.drop_gpkgs("dbname='gpkg'", ["other_tiles"])
+        self.assertEqual(cm.exception.code, 1)
+        self.assertIn("'other_tiles' not found", stderr.getvalue())
+        self.assertFalse(self.conn.committed)
+        self.assertTrue(self.conn.closed)
+
+
+@requires_database
+class DropDatabaseTestCase(unittest.TestCase):
+
+    def run_script(self, *args):
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, args[0])] + list(args[1:]),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        stdout, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0, stderr)
+        return stdout
+
+    def test_load_and_drop(self):
+        with temporary_directory() as path:
+            filename = os.path.join(path, "test_drop_tiles.gpkg")
+            create_tiles_gpkg(
+                filename, "test_drop_tiles",
+                [(0, 0, 0, "tile 0"), (1, 1, 0, "tile 1")],
+                [(0, 1, 1), (1, 2, 2)]
+            )
+            self.run_script("gpkg-pg_loadpkg.py", filename, PG_TEST_DSN)
+            stdout = self.run_script(
+                "gpkg-pg_drop.py", PG_TEST_DSN, "test_drop_tiles"
+            )
+        self.assertTrue(stdout.startswith(
+            "GeoPackage 'test_drop_tiles' successfully deleted\n"
+            "Reclaimed "
+        ))
+
+
+if __name__ == "__main__":
+    unittest.main()
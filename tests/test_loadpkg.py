@@ -0,0 +1,363 @@
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   Tests of reading SQLite GeoPackages in gpkg-pg_loadpkg.py.
+#
+#------------------------------------------------------------------------------
+
+import shutil
+import struct
+import sqlite3
+import tempfile
+import unittest
+import threading
+import os.path
+
+from support import (
+    requires_psycopg2, load_script, captured_output, create_tiles_gpkg
+)
+
+
+class FakeCursor(object):
+    #Answers the query of gpkg_load_state with the given states and records
+    #all other statements
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=None):
+        self.conn.statements.append((query, params))
+        self.rows = []
+        if query.startswith("SELECT table_name, last_id, tiles FROM "
+                            "gpkg_load_state"):
+            self.rows = self.conn.states
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection(object):
+
+    def __init__(self, states):
+        self.states = states
+        self.statements = []
+        self.commits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.commits += 1
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+@requires_psycopg2
+class TileWindowsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loadpkg = load_script("gpkg-pg_loadpkg")
+        self.directory = tempfile.mkdtemp()
+        filename = os.path.join(self.directory, "test.gpkg")
+        create_tiles_gpkg(
+            filename, "test_tiles", [],
+            [(0, 1, 1), (1, 2, 2), (2, 4, 4)]
+        )
+        self.conn = sqlite3.connect(filename)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def test_srcwin(self):
+        windows = self.loadpkg.tile_windows(
+            self.conn, "test_tiles", srcwin=(1, 2, 2, 1)
+        )
+        self.assertEqual(windows, {
+            0: (0, 1, 0, 1), 1: (0, 2, 1, 2), 2: (1, 3, 2, 3)
+        })
+
+    def test_bbox(self):
+        #the bounding box touches tile borders without covering the tiles
+        windows = self.loadpkg.tile_windows(
+            self.conn, "test_tiles", bbox=(256.0, -768.0, 512.0, -512.0)
+        )
+        self.assertEqual(windows, {
+            0: (0, 1, 0, 1), 1: (0, 1, 1, 2), 2: (1, 2, 2, 3)
+        })
+
+    def test_invalid_srcwin(self):
+        with captured_output() as (stdout, stderr):
+            with self.assertRaises(SystemExit) as cm:
+                self.loadpkg.tile_windows(
+                    self.conn, "test_tiles", srcwin=(3, 0, 2, 1)
+                )
+        self.assertEqual(cm.exception.code, 1)
+        self.assertIn("ERROR: Invalid srcwin", stderr.getvalue())
+
+    def test_missing_tile_matrix_set(self):
+        self.conn.execute("DELETE FROM gpkg_tile_matrix_set;")
+        with captured_output() as (stdout, stderr):
+            with self.assertRaises(SystemExit) as cm:
+                self.loadpkg.tile_windows(
+                    self.conn, "test_tiles", srcwin=(0, 0, 1, 1)
+                )
+        self.assertEqual(cm.exception.code, 1)
+        self.assertIn("has no tile matrix set", stderr.getvalue())
+
+
+@requires_psycopg2
+class TileToCopyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loadpkg = load_script("gpkg-pg_loadpkg")
+
+    def test_tile(self):
+        self.assertEqual(
+            self.loadpkg.tile_to_copy((2, 3, 1, 7, buffer("tile"))),
+            struct.pack("!h", 5) +
+            struct.pack("!iq", 8, 2) + struct.pack("!iq", 8, 3) +
+            struct.pack("!iq", 8, 1) + struct.pack("!iq", 8, 7) +
+            struct.pack("!i", 4) + "tile"
+        )
+
+    def test_null(self):
+        #tiles of deduplicated tables store the data of the first occurrence
+        #of each hash only
+        self.assertEqual(
+            self.loadpkg.tile_to_copy((0, 0, 0, 1, "hash", None))[-12:],
+            struct.pack("!i", 4) + "hash" + struct.pack("!i", -1)
+        )
+
+    def test_reader(self):
+        records = [(0, 0, 0, 1, "a"), (1, 0, 1, 2, "bc")]
+        data = self.loadpkg.PGCOPY_HEADER + "".join(
+            self.loadpkg.tile_to_copy(record) for record in records
+        ) + self.loadpkg.PGCOPY_TRAILER
+        for size in (-1, 1, 7, len(data)):
+            reader = self.loadpkg.TilesCopyReader(records)
+            chunks = []
+            while True:
+                chunk = reader.read(size)
+                if not chunk:
+                    break
+                self.assertTrue(size < 0 or len(chunk) <= size)
+                chunks.append(chunk)
+            self.assertEqual("".join(chunks), data)
+
+
+@requires_psycopg2
+class ReadAheadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loadpkg = load_script("gpkg-pg_loadpkg")
+        self.directory = tempfile.mkdtemp()
+        filename = os.path.join(self.directory, "test.gpkg")
+        self.tiles = [
+            (2, tile_column, tile_row, "tile %i" % (4*tile_column+tile_row))
+            for tile_column in range(4) for tile_row in range(4)
+        ]
+        create_tiles_gpkg(filename, "test_tiles", self.tiles, [(2, 4, 4)])
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.query = (
+            "SELECT zoom_level, tile_column, tile_row, tile_data FROM "
+            "test_tiles ORDER BY id;"
+        )
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def test_records(self):
+        #a buffer smaller than a tile holds one batch at a time
+        for buffer_size in (1, 20, 1024):
+            records = list(
+                self.loadpkg.read_ahead(self.conn, self.query, buffer_size)
+            )
+            self.assertEqual(
+                [record[:3] + (str(record[3]),) for record in records],
+                self.tiles
+            )
+
+    def test_close(self):
+        #the reader stops once the writer closes the generator early
+        threads = set(threading.enumerate())
+        records = self.loadpkg.read_ahead(self.conn, self.query, 1)
+        next(records)
+        records.close()
+        for thread in set(threading.enumerate()) - threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+    def test_error(self):
+        records = self.loadpkg.read_ahead(
+            self.conn, "SELECT * FROM missing_tiles;", 1024
+        )
+        self.assertRaises(sqlite3.OperationalError, list, records)
+
+
+@requires_psycopg2
+class PlanTilesLoadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loadpkg = load_script("gpkg-pg_loadpkg")
+        self.directory = tempfile.mkdtemp()
+        filename = os.path.join(self.directory, "test.gpkg")
+        create_tiles_gpkg(
+            filename, "test_tiles",
+            [(0, 0, 0, "tile")] + [
+                (2, tile_column, tile_row, "tile")
+                for tile_column in range(4) for tile_row in range(4)
+            ],
+            [(0, 1, 1), (1, 2, 2), (2, 4, 4)]
+        )
+        self.conn = sqlite3.connect(filename)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def count(self, task):
+        return self.conn.execute(
+            "SELECT count(*) FROM \"%s\" WHERE %s;" % task[0:2]
+        ).fetchone()[0]
+
+    def test_plan(self):
+        #17 tiles in chunks of 4 split zoom level 2 by tile column
+        tasks = self.loadpkg.plan_tiles_load(self.conn, ["test_tiles"], 1)
+        self.assertEqual(tasks, [
+            ("test_tiles", "zoom_level = 2 AND tile_column >= %i AND "
+             "tile_column <= %i" % (tile_column, tile_column), 4)
+            for tile_column in range(4)
+        ] + [("test_tiles", "zoom_level = 0", 1)])
+        for task in tasks:
+            self.assertEqual(self.count(task), task[2])
+
+    def test_selection(self):
+        tasks = self.loadpkg.plan_tiles_load(
+            self.conn, ["test_tiles"], 1, {"test_tiles": "tile_row < 2"}
+        )
+        self.assertEqual(len(tasks), 5)
+        for task in tasks:
+            self.assertTrue(task[1].endswith(" AND tile_row < 2"))
+            self.assertEqual(self.count(task), task[2])
+        self.assertEqual(sum(task[2] for task in tasks), 9)
+
+
+@requires_psycopg2
+class CheckpointedLoadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loadpkg = load_script("gpkg-pg_loadpkg")
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "test.gpkg")
+        create_tiles_gpkg(
+            self.filename, "test_tiles",
+            [(2, i % 4, i // 4, "tile %i" % i) for i in range(10)],
+            [(2, 4, 4)]
+        )
+        #record the chunks instead of loading them
+        self.constraints = []
+        loadpkg = self.loadpkg
+        loadpkg.copy_table = lambda conn_in, conn_out, table_name, \
+            constraint, *args, **kwargs: self.constraints.append(constraint)
+        loadpkg.copy_metadata = lambda conn_in, conn_out: None
+        loadpkg.create_tiles_relation = lambda *args, **kwargs: None
+        loadpkg.finish_tiles_table = lambda *args, **kwargs: None
+        self.store = loadpkg.gpkg_pg_store
+        self.create_change_trigger = self.store.create_change_trigger
+        self.store.create_change_trigger = lambda *args: None
+
+    def tearDown(self):
+        self.store.create_change_trigger = self.create_change_trigger
+        shutil.rmtree(self.directory)
+
+    def load(self, conn_out, resume=False):
+        self.loadpkg.read_gpkg_checkpointed(
+            self.filename, "dbname='gpkg'", checkpoint=4, resume=resume,
+            conn_out=conn_out
+        )
+
+    def progress(self, conn_out):
+        return [
+            params for query, params in conn_out.statements
+            if query.startswith("UPDATE gpkg_load_state")
+        ]
+
+    def test_load(self):
+        conn_out = FakeConnection([])
+        self.load(conn_out)
+        self.assertEqual(self.constraints, [
+            "id <= 4", "id > 4 AND id <= 8", "id > 8 AND id <= 10"
+        ])
+        self.assertEqual(self.progress(conn_out), [
+            (4, 4, "test_tiles"), (8, 4, "test_tiles"),
+            (10, 2, "test_tiles")
+        ])
+        #table creation, three chunks, and publishing
+        self.assertEqual(conn_out.commits, 5)
+
+    def test_resume(self):
+        conn_out = FakeConnection([("test_tiles", 4, 4)])
+        self.load(conn_out, resume=True)
+        self.assertEqual(self.constraints, [
+            "id > 4 AND id <= 8", "id > 8 AND id <= 10"
+        ])
+        self.assertEqual(self.progress(conn_out), [
+            (8, 4, "test_tiles"), (10, 2, "test_tiles")
+        ])
+
+    def test_resume_without_state(self):
+        with captured_output() as (stdout, stderr):
+            with self.assertRaises(SystemExit) as cm:
+                self.load(FakeConnection([]), resume=True)
+        self.assertEqual(cm.exception.code, 1)
+        self.assertIn("No interrupted load", stderr.getvalue())
+        self.assertEqual(self.constraints, [])
+
+    def test_interrupted(self):
+        with captured_output() as (stdout, stderr):
+            with self.assertRaises(SystemExit) as cm:
+                self.load(FakeConnection([("test_tiles", 4, 4)]))
+        self.assertEqual(cm.exception.code, 1)
+        self.assertIn("continue it with -resume", stderr.getvalue())
+        self.assertEqual(self.constraints, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   Tests of the conditional requests of gpkg-pg_serve.py.
+#
+#------------------------------------------------------------------------------
+
+import unittest
+
+from support import requires_psycopg2, load_script
+
+
+ETAG = '"d41d8cd98f00b204e9800998ecf8427e"'
+
+
+@requires_psycopg2
+class EtagMatchesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.serve = load_script("gpkg-pg_serve")
+
+    def test_missing(self):
+        self.assertFalse(self.serve.etag_matches([], ETAG))
+
+    def test_strong(self):
+        self.assertTrue(self.serve.etag_matches([ETAG], ETAG))
+        self.assertFalse(self.serve.etag_matches(['"other"'], ETAG))
+
+    def test_weak(self):
+        self.assertTrue(self.serve.etag_matches(["W/" + ETAG], ETAG))
+
+    def test_list(self):
+        self.assertTrue(self.serve.etag_matches(
+            ['"other", W/"more",%s' % ETAG], ETAG
+        ))
+        self.assertTrue(self.serve.etag_matches(['"other"', ETAG], ETAG))
+        self.assertFalse(self.serve.etag_matches(
+            ['"other", W/"more"'], ETAG
+        ))
+
+    def test_any(self):
+        self.assertTrue(self.serve.etag_matches([" * "], ETAG))
+        self.assertFalse(self.serve.etag_matches(['"*"'], ETAG))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,224 @@
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+# Description:
+#
+#   Tests of the helpers for the tiles tables in gpkg_pg_store.
+#
+#------------------------------------------------------------------------------
+
+import sqlite3
+import decimal
+import unittest
+
+from support import requires_psycopg2, captured_output
+
+
+class FakeCursor(object):
+    """Cursor returning the given rows for every query.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+
+@requires_psycopg2
+class WindowConstraintTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import gpkg_pg_store
+        self.store = gpkg_pg_store
+
+    def select(self, constraint):
+        conn = sqlite3.connect(":memory:")
+        conn.execute(
+            "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, "
+            "tile_row INTEGER);"
+        )
+        conn.executemany(
+            "INSERT INTO tiles VALUES (?, ?, ?);",
+            [(z, c, r) for z in range(3) for c in range(2**z)
+             for r in range(2**z)]
+        )
+        return conn.execute(
+            "SELECT * FROM tiles WHERE %s ORDER BY 1, 2, 3;" % constraint
+        ).fetchall()
+
+    def test_windows(self):
+        constraint = self.store.window_constraint(
+            {1: (1, 2, 0, 1), 2: (2, 4, 0, 2)}
+        )
+        self.assertEqual(self.select(constraint), [
+            (1, 1, 0), (2, 2, 0), (2, 2, 1), (2, 3, 0), (2, 3, 1)
+        ])
+
+    def test_empty_windows(self):
+        constraint = self.store.window_constraint(
+            {0: (0, 0, 0, 1), 1: (1, 1, 0, 2)}
+        )
+        self.assertEqual(constraint, "1 = 0")
+        self.assertEqual(self.select(constraint), [])
+
+    def test_morton_range(self):
+        constraint = self.store.window_constraint({2: (2, 4, 0, 2)}, True)
+        self.assertIn(
+            "gpkg_tile_morton(tile_column, tile_row) BETWEEN %i AND %i" % (
+                self.store.morton_key(2, 0), self.store.morton_key(3, 1)
+            ), constraint
+        )
+
+
+@requires_psycopg2
+class MortonKeyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import gpkg_pg_store
+        self.store = gpkg_pg_store
+
+    def interleave(self, tile_column, tile_row):
+        key = 0
+        for bit in range(31):
+            key |= (tile_column >> bit & 1) << 2*bit
+            key |= (tile_row >> bit & 1) << 2*bit + 1
+        return key
+
+    def test_keys(self):
+        self.assertEqual(
+            [self.store.morton_key(c, r) for r in range(2) for c in range(2)],
+            [0, 1, 2, 3]
+        )
+        self.assertEqual(self.store.morton_key(3, 5), 39)
+        for tile_column, tile_row in ((12345, 678), (2**30, 1),
+                                      (2**31-1, 2**31-1)):
+            self.assertEqual(
+                self.store.morton_key(tile_column, tile_row),
+                self.interleave(tile_column, tile_row)
+            )
+
+    def test_window_range(self):
+        #the keys of a window lie between those of its corners
+        window = (2, 7, 3, 6)
+        keys = [
+            self.store.morton_key(c, r) for c in range(window[0], window[1])
+            for r in range(window[2], window[3])
+        ]
+        self.assertEqual(min(keys), self.store.morton_key(2, 3))
+        self.assertEqual(max(keys), self.store.morton_key(6, 5))
+
+
+@requires_psycopg2
+class ExtractWindowsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import gpkg_pg_store
+        self.store = gpkg_pg_store
+
+    def test_windows(self):
+        #tiles of 1, 2, and 4 units from the highest zoom level down
+        cursor = FakeCursor([
+            (2, 4, 4, decimal.Decimal(1), decimal.Decimal(1)),
+            (1, 2, 2, decimal.Decimal(2), decimal.Decimal(2)),
+            (0, 1, 1, decimal.Decimal(4), decimal.Decimal(4)),
+        ])
+        windows = self.store.extract_windows(cursor, "test", (1, 2, 2, 1))
+        self.assertEqual(windows, {
+            2: (1, 3, 2, 3), 1: (0, 2, 1, 2), 0: (0, 1, 0, 1)
+        })
+
+    def test_skipped_zoom_levels(self):
+        #tiles of 2.5 units are no multiple of the highest zoom level, those
+        #of 2 units do not nest into those of 3 units
+        cursor = FakeCursor([
+            (3, 8, 8, 1.0, 1.0), (2, 4, 4, 2.0, 2.0),
+            (1, 3, 3, 3.0, 3.0), (0, 4, 4, 2.5, 2.5),
+        ])
+        with captured_output() as (stdout, stderr):
+            windows = self.store.extract_windows(
+                cursor, "test", (2, 2, 4, 4)
+            )
+        self.assertEqual(windows, {3: (2, 6, 2, 6), 1: (0, 2, 0, 2)})
+        self.assertIn(
+            "zoom level 0 of GeoPackage 'test' are no multiple",
+            stderr.getvalue()
+        )
+        self.assertIn(
+            "zoom level 2 of GeoPackage 'test' do not nest",
+            stderr.getvalue()
+        )
+
+
+@requires_psycopg2
+class ExtractTileMatrixTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import gpkg_pg_store
+        self.store = gpkg_pg_store
+        #256 pixel tiles of zoom levels 0 to 2 covering 1024 units, the
+        #contents cover less
+        self.cursor = FakeCursor([
+            (zoom_level, 2**zoom_level, 2**zoom_level, 256, 256,
+             decimal.Decimal(4 >> zoom_level),
+             decimal.Decimal(4 >> zoom_level),
+             decimal.Decimal(1024 >> zoom_level),
+             decimal.Decimal(1024 >> zoom_level), decimal.Decimal(0),
+             decimal.Decimal(1024),
+             decimal.Decimal(0), decimal.Decimal(100),
+             decimal.Decimal(1000), decimal.Decimal(1024))
+            for zoom_level in range(3)
+        ])
+
+    def test_full(self):
+        rows, offsets, tms_extent, contents_extent = \
+            self.store.extract_tile_matrix(self.cursor, "test")
+        self.assertEqual(rows[2], ("test", 2, 4, 4, 256, 256, 1.0, 1.0))
+        self.assertTrue(isinstance(rows[0][6], float))
+        self.assertEqual(offsets, {0: (0, 0, 0), 1: (1, 0, 0), 2: (2, 0, 0)})
+        self.assertEqual((tms_extent, contents_extent), (None, None))
+
+    def test_windows(self):
+        #zoom level 2 spans the window of zoom level 1 aligned to its tiles
+        rows, offsets, tms_extent, contents_extent = \
+            self.store.extract_tile_matrix(
+                self.cursor, "test", {1: (1, 2, 1, 2), 2: (2, 4, 3, 4)}
+            )
+        self.assertEqual(rows, [
+            ("test", 1, 1, 1, 256, 256, 2.0, 2.0),
+            ("test", 2, 2, 2, 256, 256, 1.0, 1.0),
+        ])
+        self.assertEqual(offsets, {1: (1, 1, 1), 2: (2, 2, 2)})
+        self.assertEqual(tms_extent, (512.0, 0.0, 1024.0, 512.0))
+        self.assertEqual(contents_extent, (512.0, 100.0, 1000.0, 256.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
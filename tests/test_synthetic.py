@@ -0,0 +1,105 @@
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+#
+# Description:
+#
+#   Tests of the synthetic GeoPackages of gpkg-pg_synthetic.py.
+#
+#------------------------------------------------------------------------------
+
+import sqlite3
+import unittest
+import os.path
+
+from support import load_script, captured_output, temporary_directory
+
+
+class GenerateGpkgTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.synthetic = load_script("gpkg-pg_synthetic")
+
+    def generate(self, path, name, **options):
+        filename = os.path.join(path, "%s.gpkg" % name)
+        self.synthetic.generate_gpkg(filename, "synthetic", **options)
+        conn = sqlite3.connect(filename)
+        try:
+            matrices = conn.execute(
+                "SELECT zoom_level, matrix_width, matrix_height FROM "
+                "gpkg_tile_matrix ORDER BY zoom_level;"
+            ).fetchall()
+            tiles = conn.execute(
+                "SELECT zoom_level, tile_column, tile_row, tile_data FROM "
+                "synthetic ORDER BY id;"
+            ).fetchall()
+        finally:
+            conn.close()
+        return matrices, [tile[:3] + (str(tile[3]),) for tile in tiles]
+
+    def test_tiles(self):
+        with temporary_directory() as path:
+            matrices, tiles = self.generate(
+                path, "a", zoom_levels=3, tile_bytes=100
+            )
+        self.assertEqual(matrices, [(0, 2, 1), (1, 4, 2), (2, 8, 4)])
+        self.assertEqual(len(tiles), 2 + 8 + 32)
+        self.assertEqual(len(set(tile[:3] for tile in tiles)), len(tiles))
+        for tile in tiles:
+            self.assertTrue(
+                tile[3].startswith(self.synthetic.PNG_SIGNATURE)
+            )
+
+    def test_reproducible(self):
+        with temporary_directory() as path:
+            a = self.generate(path, "a", zoom_levels=2, seed=1)
+            b = self.generate(path, "b", zoom_levels=2, seed=1)
+            c = self.generate(path, "c", zoom_levels=2, seed=2)
+        self.assertEqual(a, b)
+        self.assertNotEqual(a[1], c[1])
+
+    def test_duplicates(self):
+        with temporary_directory() as path:
+            matrices, tiles = self.generate(
+                path, "a", zoom_levels=3, tile_bytes=100, duplicates=1.0
+            )
+        #every tile after the first repeats it
+        self.assertEqual(len(set(tile[3] for tile in tiles)), 1)
+
+    def test_existing_file(self):
+        with temporary_directory() as path:
+            filename = os.path.join(path, "a.gpkg")
+            open(filename, "w").close()
+            with captured_output() as (stdout, stderr):
+                with self.assertRaises(SystemExit) as cm:
+                    self.synthetic.generate_gpkg(filename, "synthetic")
+        self.assertEqual(cm.exception.code, 1)
+        self.assertIn("already exists", stderr.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
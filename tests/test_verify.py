@@ -0,0 +1,124 @@
+#------------------------------------------------------------------------------
+#
+# Project: PostgreSQL-GeoPackage
+# Authors: Stephan Meissl <stephan.meissl@eox.at>
+#
+#------------------------------------------------------------------------------
+# Copyright (c) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#------------------------------------------------------------------------------
+#
+#
+# Description:
+#
+#   Tests of the checksums and comparisons of gpkg-pg_verify.py.
+#
+#------------------------------------------------------------------------------
+
+import hashlib
+import decimal
+import unittest
+import os.path
+
+from support import (
+    requires_psycopg2, load_script, temporary_directory, create_tiles_gpkg
+)
+
+
+@requires_psycopg2
+class ChecksumsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.verify = load_script("gpkg-pg_verify")
+        self.tiles = [
+            (1, tile_column, tile_row, "tile %i" % tile_column)
+            for tile_column in range(2) for tile_row in range(2)
+        ]
+
+    def pg_hash(self, zoom_level, tile_column, tile_row, tile_data):
+        #Signed bigint of the first 16 hex digits as computed by PostgreSQL
+        value = int(hashlib.md5("%i/%i/%i/%s" % (
+            zoom_level, tile_column, tile_row,
+            hashlib.md5(tile_data).hexdigest()
+        )).hexdigest()[:16], 16)
+        return value - 2**64 if value >= 2**63 else value
+
+    def test_sqlite_checksums(self):
+        with temporary_directory() as path:
+            filename = os.path.join(path, "test.gpkg")
+            create_tiles_gpkg(
+                filename, "test_tiles", self.tiles, [(0, 1, 1), (1, 2, 2)]
+            )
+            checksums = self.verify.sqlite_checksums(
+                (filename, "test_tiles", 1, False)
+            )
+            rows = self.verify.sqlite_checksums(
+                (filename, "test_tiles", 1, True)
+            )
+            empty = self.verify.sqlite_checksums(
+                (filename, "test_tiles", 0, False)
+            )
+        #the sum of the signed hashes of PostgreSQL modulo 2^64 matches
+        self.assertEqual(checksums, {0: (4, sum(
+            self.pg_hash(*tile) for tile in self.tiles
+        ) % self.verify.CHECKSUM_MODULUS)})
+        self.assertEqual(sorted(rows), [0, 1])
+        for tile_row in rows:
+            self.assertEqual(rows[tile_row], (2, sum(
+                self.pg_hash(*tile) for tile in self.tiles
+                if tile[2] == tile_row
+            ) % self.verify.CHECKSUM_MODULUS))
+        self.assertEqual(empty, {})
+
+    def test_order_independent(self):
+        hashes = [self.verify.tile_hash(*tile) for tile in self.tiles]
+        self.assertEqual(
+            sum(hashes) % self.verify.CHECKSUM_MODULUS,
+            sum(reversed(hashes)) % self.verify.CHECKSUM_MODULUS
+        )
+        self.assertNotEqual(
+            self.verify.tile_hash(1, 0, 1, "tile 0"),
+            self.verify.tile_hash(1, 1, 0, "tile 0")
+        )
+
+
+@requires_psycopg2
+class CompareTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.verify = load_script("gpkg-pg_verify")
+
+    def test_rows_equal(self):
+        self.assertTrue(self.verify.rows_equal(
+            [(u"tiles", 1, 0.1)], [("tiles", decimal.Decimal(1),
+                                     decimal.Decimal("0.1"))]
+        ))
+        self.assertFalse(self.verify.rows_equal([(1,)], [(1.001,)]))
+        self.assertFalse(self.verify.rows_equal([(1,)], [(1,), (2,)]))
+
+    def test_format_ranges(self):
+        self.assertEqual(
+            self.verify.format_ranges([7, 1, 3, 2, 9, 8]), "1-3, 7-9"
+        )
+        self.assertEqual(self.verify.format_ranges([4]), "4")
+
+
+if __name__ == "__main__":
+    unittest.main()